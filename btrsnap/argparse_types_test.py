@@ -7,9 +7,8 @@ import unittest
 import datetime
 import argparse
 
-from dateutil.relativedelta import relativedelta
-
 import argparse_types as at
+import dates
 
 
 class Test_DateParser_Function(unittest.TestCase):
@@ -24,18 +23,18 @@ class Test_DateParser_Function(unittest.TestCase):
         string = '4y4m1d2w'
         result = at.date_parser(string)
 
-        self.assertIsInstance(result, relativedelta, 'should return a datetime.timedelta object')
+        self.assertIsInstance(result, dates.Period, 'should return a dates.Period object')
 
     def test_ymd_large_values(self):
         string = '1000y55m71d'
         result = at.date_parser(string)
 
-        self.assertIsInstance(result, relativedelta, 'should return a datetime.timedelta object')
+        self.assertIsInstance(result, dates.Period, 'should return a dates.Period object')
 
     def test_ymd_one_value(self):
         string = '4y'
         result = at.date_parser(string)
-        self.assertIsInstance(result, relativedelta, 'should return a datetime.timedelta object')
+        self.assertIsInstance(result, dates.Period, 'should return a dates.Period object')
 
     def test_ymd_duplicate_value(self):
         string = '99y98y'
@@ -56,7 +55,7 @@ class Test_DateParser_Function(unittest.TestCase):
         today = datetime.date.today()
         string = datetime.date.today().isoformat()
         result = at.date_parser(string)
-        self.assertIsInstance(result, relativedelta, 'should return a datetime.timedelta object')
+        self.assertIsInstance(result, dates.Period, 'should return a dates.Period object')
 
         expected = today - datetime.timedelta()  # timedelta should be 0 for today
         got = today - result
@@ -78,5 +77,32 @@ class Test_DateParser_Function(unittest.TestCase):
         self.assertRaises(argparse.ArgumentTypeError, at.date_parser, string)
 
 
+class Test_PositiveInt_Function(unittest.TestCase):
+
+    def test_positive_int(self):
+        self.assertEqual(at.positive_int('4'), 4)
+
+    def test_zero_or_negative(self):
+        self.assertRaises(argparse.ArgumentTypeError, at.positive_int, '0')
+        self.assertRaises(argparse.ArgumentTypeError, at.positive_int, '-2')
+
+    def test_not_a_number(self):
+        self.assertRaises(argparse.ArgumentTypeError, at.positive_int, 'four')
+
+
+class Test_Percentage_Function(unittest.TestCase):
+
+    def test_percentage(self):
+        self.assertEqual(at.percentage('20%'), 20.0)
+        self.assertEqual(at.percentage('12.5'), 12.5)
+
+    def test_out_of_range(self):
+        self.assertRaises(argparse.ArgumentTypeError, at.percentage, '101%')
+        self.assertRaises(argparse.ArgumentTypeError, at.percentage, '-1')
+
+    def test_not_a_number(self):
+        self.assertRaises(argparse.ArgumentTypeError, at.percentage, 'half')
+
+
 if __name__ == '__main__':
         unittest.main()
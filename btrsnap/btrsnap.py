@@ -9,285 +9,1151 @@ import re
 import datetime
 import subprocess
 import sys
+import threading
+import time
+import bisect
+import collections
+import copy
+import contextlib
+import posixpath
 
 try:
-    from dateutil.relativedelta import relativedelta
+    from . import chunks, compression, dates, streams
+    from .catalog import Catalog
+    from .errors import (BtrsnapError, PathError, TargetError,
+                         TransportError, BtrfsError)
+    from .paths import (TIMESTAMP_PATTERN, Path, SnapPath, snapshot_key,
+                        snapshot_date)
+    from .streams import Relay, Tee, Activity, activity
+    from .transport import Transport, transport_for
 except ImportError:
-    print('You are missing some required packages!\n'
-          'try:'
-          '\n\tpip install python-dateutil')
-    sys.exit(1)
+    import chunks
+    import compression
+    import dates
+    import streams
+    from catalog import Catalog
+    from errors import (BtrsnapError, PathError, TargetError,
+                        TransportError, BtrfsError)
+    from paths import (TIMESTAMP_PATTERN, Path, SnapPath, snapshot_key,
+                       snapshot_date)
+    from streams import Relay, Tee, Activity, activity
+    from transport import Transport, transport_for
+
+# cron runs btrsnap often, so modules that only some subcommands need
+# (sqlite3, hashlib, concurrent.futures, tempfile, the compression codecs)
+# are imported where they are used. btrsnap_benchmark.py --startup checks
+# the import time.
+
+# one subvolume from btrfs subvolume list, None where not listed
+Subvolume = collections.namedtuple('Subvolume', [
+    'id', 'generation', 'top_level', 'parent_uuid', 'received_uuid', 'uuid',
+    'path', 'otime', 'cgeneration'])
+
+# one line of /proc/self/mountinfo that matters here
+Mount = collections.namedtuple('Mount', ['point', 'root', 'source'])
+
+# one line of a StreamArchive manifest
+StreamEntry = collections.namedtuple('StreamEntry',
+                                     ['snapshot', 'parent', 'file', 'bytes'])
 
 
-class BtrsnapError(Exception):
-    '''
-    Root error for the btrsnap module
+class Btrfs(Path):
     '''
-    pass
+    Wrapper class for BTRFS functions
 
+    Args:
+        * Path (str): Path on filesystem
 
-class PathError(BtrsnapError):
-    '''
-    Path does not exist on the filesystem
+    Attributes:
+        * path (str): absolute path
+
+    Raises:
+        * PathError:
     '''
-    pass
 
+    def snap(self, target, timestamp, readonly=True):
+        '''
+        Create a snapshot in self.path
 
-class TargetError(BtrsnapError):
-    '''
-    There is not exactly 1 symlink inside the snapshot directory
-    '''
-    pass
+        Args:
+            * target (str): absolute path of BTRFS subvolume to be cloned.
+            * timestamp (str): name of the snapshot to be created.
+            * readonly (bool): True/False, new snapshot is readonly.
 
+        Raises:
+            * BtrfsError:
+        '''
+        snapshot = os.path.join(self.path, timestamp)
+        if readonly:
+            args = ['btrfs', 'subvolume', 'snapshot', '-r', target, snapshot]
+        else:
+            args = ['btrfs', 'subvolume', 'snapshot', target, snapshot]
 
-class BtrfsError(BtrsnapError):
-    '''
-    btrfs-progs returned a non zero exit code
-    '''
-    pass
+        return_code = subprocess.call(args)
+        if return_code:
+            raise BtrfsError('BTRFS failed to create a snapshot'
+                             ' of {} in \'{}\''.format(target, snapshot))
 
+    def unsnap(self, timestamp):
+        '''
+        Delete a snapshot in self.path
+
+        Args:
+            * timestamp (str): name of the snapshot to be deleted.
+
+        Raises:
+            * BtrfsError:
+        '''
+        snapshot = os.path.join(self.path, timestamp)
+        args = ['btrfs', 'subvolume', 'delete', snapshot]
+        return_code = subprocess.call(args, stderr=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL)
+        if return_code:
+            raise BtrfsError('BTRFS failed to delete the subvolume.'
+                             ' Perhaps you need root permissions')
+
+    def unsnap_many(self, timestamps, commit=None):
+        '''
+        Delete several snapshots in self.path, passing as many of them as
+        the kernel allows to each btrfs-progs call.
+
+        Args:
+            * timestamps (list(str)): names of the snapshots to be deleted.
+            * commit (str): None, 'after' or 'each'. Wait for the deletions
+              to be committed after the last or after each snapshot.
+
+        Raises:
+            * BtrfsError: lists every snapshot that could not be deleted.
+        '''
+        args = ['btrfs', 'subvolume', 'delete']
+        if commit == 'after':
+            args.append('--commit-after')
+        elif commit == 'each':
+            args.append('--commit-each')
+        elif commit is not None:
+            raise BtrsnapError('commit must be one of None, \'after\''
+                               ' or \'each\'')
+
+        snapshots = [os.path.join(self.path, timestamp)
+                     for timestamp in timestamps]
+        failed = [os.path.basename(snapshot) for snapshot in snapshots
+                  if not os.path.lexists(snapshot)]
+        existing = [snapshot for snapshot in snapshots
+                    if os.path.lexists(snapshot)]
+        for chunk in _arg_chunks(args, existing):
+            return_code = subprocess.call(args + chunk,
+                                          stderr=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL)
+            if return_code:
+                # btrfs-progs may stop at the first failure, so retry the
+                # survivors one by one to find out which ones really failed
+                for snapshot in chunk:
+                    if not os.path.lexists(snapshot):
+                        continue
+                    return_code = subprocess.call(args + [snapshot],
+                                                  stderr=subprocess.DEVNULL,
+                                                  stdout=subprocess.DEVNULL)
+                    if return_code:
+                        failed.append(os.path.basename(snapshot))
+        if failed:
+            raise BtrfsError('BTRFS failed to delete {} of {} snapshot(s)'
+                             ' in \'{}\': {}. Perhaps you need root'
+                             ' permissions'.format(len(failed),
+                                                   len(snapshots),
+                                                   self.path,
+                                                   ', '.join(failed)))
+
+    def sync(self):
+        '''
+        Wait until btrfs has finished cleaning up deleted subvolumes on the
+        filesystem holding self.path, so their space shows up as free.
+
+        Raises:
+            * BtrfsError:
+        '''
+        args = ['btrfs', 'subvolume', 'sync', self.path]
+        return_code = subprocess.call(args, stderr=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL)
+        if return_code:
+            raise BtrfsError('BTRFS failed to wait for deleted subvolumes'
+                             ' to be cleaned up in \'{}\''.format(self.path))
+
+    def send(self, snapshot, parent=None, clones=()):
+        '''
+        Send a snapshot using btrfs-progs.
 
-class Path:
+        Args:
+            * snapshot (str): snapshot to be sent relative to self.path.
+            * parent (str): parent snapshot relative to self.path.
+                **must alread be on receiving filesystem.**
+            * clones (list(str)): more snapshots relative to self.path that
+              data may be cloned from.
+                **must alread be on receiving filesystem.**
+
+        Returns:
+            * (subprocess.Popen): can be used to pipe output to receive.
+        '''
+        args = ['btrfs', 'send']
+        if parent:
+            parent = os.path.join(self.path, parent)
+            args.extend(['-p', parent])
+        for clone in clones:
+            args.extend(['-c', os.path.join(self.path, clone)])
+
+        args.append(os.path.join(self.path, snapshot))
+        p1 = subprocess.Popen(args, stdout=subprocess.PIPE)
+        return p1
+
+    def receive(self, p1):
+        '''
+        Receive a snapshot using btrfs-progs. The stream is relayed from the
+        send process to btrfs receive by a :class:`Relay`.
+
+        Args:
+            * p1 (subprocess.Popen): send process
+
+        Returns:
+            * Relay: statistics of the transfer.
+
+        Raises:
+            * BtrfsError:
+        '''
+        return Transport().receive(self.path, p1)
+
+    def receive_from(self, source):
+        '''
+        Receive a snapshot from a stream read from a file descriptor, for
+        example one opened by :meth:`StreamArchive.stream`.
+
+        Args:
+            * source (int): file descriptor to read the stream from.
+
+        Returns:
+            * Relay: statistics of the transfer.
+
+        Raises:
+            * BtrfsError:
+        '''
+        return Transport().receive_from(self.path, source)
+
+
+class SubvolumeIndex:
     '''
-    Base Class for working with filesystem folders
+    The subvolumes of one btrfs filesystem, read with a single ``btrfs
+    subvolume list`` call instead of one call, or stat, per snapshot. Only
+    directories btrfs lists count as snapshots, so a plain directory with a
+    timestamp name is never sent or deleted.
+
+    Args:
+        * subvolumes (list(Subvolume)): see :meth:`parse`.
+        * mount (Mount): where the filesystem is mounted locally, used to
+          turn local paths into the paths btrfs lists. None for a
+          filesystem on the far side of a transport.
     '''
-    def __init__(self, path):
+    list_args = ['-c', '-u', '-R', '-q']
+    # keys btrfs subvolume list prints before the path, by Subvolume field
+    fields = {'ID': 'id', 'gen': 'generation', 'cgen': 'cgeneration',
+              'top level': 'top_level',
+              'parent_uuid': 'parent_uuid', 'received_uuid': 'received_uuid',
+              'uuid': 'uuid'}
+
+    def __init__(self, subvolumes, mount=None):
+        self.subvolumes = list(subvolumes)
+        self.mount = mount
+        self.by_path = dict((sub.path, sub) for sub in self.subvolumes)
+        self.received = set(sub.received_uuid for sub in self.subvolumes
+                            if sub.received_uuid)
+        self.uuids = set(sub.uuid for sub in self.subvolumes if sub.uuid)
+        self.by_directory = collections.defaultdict(dict)
+        for sub in self.subvolumes:
+            directory, name = posixpath.split(sub.path)
+            self.by_directory[directory][name] = sub
+
+    @classmethod
+    def parse(cls, output):
+        '''
+        Args:
+            * output (str): output of ``btrfs subvolume list``.
+
+        Returns:
+            * list(Subvolume)
+
+        Raises:
+            * BtrsnapError: a line cannot be parsed.
+        '''
+        subvolumes = []
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            head, found, path = line.partition(' path ')
+            tokens = head.split()
+            values = dict.fromkeys(Subvolume._fields)
+            values['path'] = path
+            try:
+                if not found:
+                    raise ValueError(line)
+                while tokens:
+                    key = tokens.pop(0)
+                    if key == 'top' and tokens[0] == 'level':
+                        key = ' '.join([key, tokens.pop(0)])
+                    value = tokens.pop(0)
+                    if key == 'otime':
+                        # date and time, or - when unknown
+                        if value != '-':
+                            values['otime'] = datetime.datetime.strptime(
+                                value + ' ' + tokens.pop(0),
+                                '%Y-%m-%d %H:%M:%S')
+                        continue
+                    if key in cls.fields:
+                        values[cls.fields[key]] = value
+                for key in ('id', 'generation', 'top_level', 'cgeneration'):
+                    if values[key] is not None:
+                        values[key] = int(values[key])
+            except (ValueError, IndexError):
+                raise BtrsnapError('cannot parse btrfs subvolume list output:'
+                                   ' {}'.format(line))
+            for key in ('parent_uuid', 'received_uuid', 'uuid'):
+                if values[key] == '-':
+                    values[key] = None
+            subvolumes.append(Subvolume(**values))
+        return subvolumes
+
+    @classmethod
+    def load(cls, path, transport=None, times=False, commit=False):
         '''
-        Verifies that a path exists.
+        List the filesystem PATH is on.
 
         Args:
-            * path (str): a path on a filesystem.
+            * path (str): any path on the filesystem.
+            * transport (Transport): where PATH is, defaults to locally.
+            * times (bool): fill in :attr:`Subvolume.otime`. btrfs only
+              prints creation times when listing nothing but snapshots, so
+              this takes a second call with ``-s``.
+            * commit (bool): commit the running transaction first with
+              ``btrfs filesystem sync``. Generations only move on commit,
+              so without this the last writes may not show.
 
-        Attributes:
-            * path (str): absolute path.
+        Returns:
+            * SubvolumeIndex
 
         Raises:
-            * PathError: invalid path.
+            * BtrsnapError: btrfs subvolume list failed, for example
+              because PATH is not on btrfs or without root permissions.
         '''
-        if os.path.isdir(os.path.expanduser(path)):
-            self.path = os.path.abspath(os.path.expanduser(path))
-        else:
-            raise PathError('{} is not a valid folder name'.format(path))
+        if transport is None:
+            transport = Transport()
+        mount = None if transport.remote else _mount_of(path)
+        if commit:
+            transport.run(['btrfs', 'filesystem', 'sync', path])
+        args = ['btrfs', 'subvolume', 'list'] + cls.list_args
+        subvolumes = cls.parse(transport.run(args + [path]))
+        if times:
+            otimes = dict((sub.id, sub.otime) for sub in
+                          cls.parse(transport.run(args + ['-s', path])))
+            subvolumes = [sub._replace(otime=otimes.get(sub.id))
+                          for sub in subvolumes]
+        return cls(subvolumes, mount)
+
+    def at(self, mount):
+        '''
+        Returns:
+            * SubvolumeIndex: the same filesystem seen through another
+              MOUNT of it, sharing the listing.
+        '''
+        view = copy.copy(self)
+        view.mount = mount
+        return view
 
-    def snapshots(self):
+    def _listed_path(self, path):
+        '''
+        Returns:
+            * str: local PATH as btrfs lists it, None if unknown.
+        '''
+        if self.mount is None:
+            return None
+        relative = os.path.relpath(os.path.realpath(path), self.mount.point)
+        relative = os.path.normpath(os.path.join(self.mount.root, relative))
+        return relative.strip('/')
+
+    def find(self, path):
+        '''
+        Args:
+            * path (str): local path of a subvolume.
+
+        Returns:
+            * Subvolume: None if PATH is not a subvolume of this filesystem.
+        '''
+        return self.by_path.get(self._listed_path(path))
+
+    def children(self, path):
+        '''
+        Args:
+            * path (str): local directory.
+
+        Returns:
+            * dict: :class:`Subvolume` by name for each subvolume directly
+              inside PATH.
         '''
-        List all folders in *self.path* whose name matches the
-        btrsnap timestamp format: yyyy-mm-dd-####.
+        listed = self._listed_path(path)
+        if listed is None:
+            return {}
+        return self.by_directory.get(listed, {})
+
+    def covers(self, path):
+        '''
+        Args:
+            * path (str): local directory.
 
         Returns:
-            * list(str): a list of directories inside self.path that
-              match the btrsnap timestamp YYYY-MM-DD-####
+            * bool: PATH is in the listing, as a subvolume or as the
+              directory of one. Otherwise nothing can be told about what
+              PATH holds, for example under a bind mount or another mount
+              that the listing cannot be matched with.
         '''
-        pattern = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{4}$')
-        contents = os.listdir(path=self.path)
-        contents = [d for d in contents
-                    if os.path.isdir(os.path.join(self.path, d))
-                    and re.search(pattern, d)]
-        contents.sort(reverse=True)
-        return contents
+        listed = self._listed_path(path)
+        return listed is not None and (listed in self.by_path or
+                                       listed in self.by_directory)
 
-    def sub_snap_paths_list(self):
+    def snapshots(self, path):
         '''
+        Args:
+            * path (str): local directory.
+
         Returns:
-            * list(SnapPath): a list of SnapPath objects for each subdirectory
-            inside of self.path.
+            * list(str): subvolumes in PATH named with a btrsnap timestamp,
+              newest first, like :meth:`Path.snapshots`.
         '''
-        return self._list_of_objects(SnapPath)
+        snapshots = [name for name in self.children(path)
+                     if TIMESTAMP_PATTERN.match(name)]
+        snapshots.sort(key=snapshot_key, reverse=True)
+        return snapshots
 
-    def sub_paths_list(self):
+    def has_copy(self, subvolume):
         '''
         Returns:
-            * list(Path): a list of Path objects for each subdirectory
-            inside of self.path.
+            * bool: this filesystem holds a received copy of SUBVOLUME, or
+              the subvolume SUBVOLUME was itself received from, so it can
+              be used as parent or clone source when sending here.
         '''
-        return self._list_of_objects(Path)
+        if subvolume.uuid in self.received:
+            return True
+        return bool(subvolume.received_uuid) and (
+            subvolume.received_uuid in self.received or
+            subvolume.received_uuid in self.uuids)
+
 
-    def _list_of_objects(self, obj):
-        objects = []
-        contents = os.listdir(self.path)
-        contents = [directory for directory in contents
-                    if os.path.isdir(os.path.join(self.path, directory))]
-        for content in contents:
+def _mounts():
+    '''
+    Returns:
+        * list(Mount): mounted filesystems, from /proc/self/mountinfo.
+    '''
+    def unescape(field):
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                      field)
+
+    mounts = []
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index('-')
+            mounts.append(Mount(unescape(fields[4]), unescape(fields[3]),
+                                fields[separator + 2]))
+    return mounts
+
+
+def _mount_of(path):
+    '''
+    Returns:
+        * Mount: the mount PATH is on.
+    '''
+    path = os.path.realpath(path)
+    best = None
+    for mount in _mounts():
+        inside = path == mount.point or path.startswith(
+            mount.point.rstrip('/') + '/')
+        if inside and (best is None or len(mount.point) >= len(best.point)):
+            best = mount
+    return best
+
+
+_index_lock = threading.Lock()
+
+
+def _subvolume_index(path, indexes, transport=None, key=None, times=False,
+                     commit=False):
+    '''
+    Load the SubvolumeIndex of the filesystem PATH is on once, and keep it
+    in INDEXES. Filesystems that cannot be listed are remembered as None.
+
+    Args:
+        * path (str): path on the filesystem.
+        * indexes (dict): cache shared between calls.
+        * transport (Transport): where PATH is, defaults to locally.
+        * key: cache key for a remote PATH. Local paths are keyed by the
+          device they are mounted from, so all mounts of a filesystem share
+          one listing.
+        * times (bool): see :meth:`SubvolumeIndex.load`.
+        * commit (bool): see :meth:`SubvolumeIndex.load`. Only applies if
+          the filesystem is not in INDEXES yet.
+
+    Returns:
+        * SubvolumeIndex: None if btrfs subvolume list failed.
+    '''
+    mount = None
+    if transport is None or not transport.remote:
+        mount = _mount_of(path)
+        key = ('local', mount.source if mount else path)
+    key = (key, times)
+    with _index_lock:
+        if key not in indexes:
             try:
-                objects.append(obj(os.path.join(
-                    self.path, content)))
-            except Exception:
-                pass
-        return objects
+                indexes[key] = SubvolumeIndex.load(path, transport, times,
+                                                   commit)
+            except (BtrsnapError, OSError):
+                indexes[key] = None
+        index = indexes[key]
+    if index is not None and mount is not None and index.mount != mount:
+        index = index.at(mount)
+    return index
 
 
-class SnapPath(Path):
+def _directory_index(path, indexes, times=False, commit=False):
     '''
-    Verifies that path exists, and that it contains exactly one symlink.
+    :func:`_subvolume_index` for a local directory, only where the listing
+    covers the directory, see :meth:`SubvolumeIndex.covers`. Elsewhere the
+    index would find nothing in PATH, which callers would take for a
+    directory without snapshots.
 
-    Agruments:
-        * path (str): path on filesystem
+    Returns:
+        * SubvolumeIndex: None if btrfs subvolume list failed or does not
+          show PATH. Read the directory instead.
+    '''
+    index = _subvolume_index(path, indexes, times=times, commit=commit)
+    if index is not None and not index.covers(path):
+        return None
+    return index
 
-    Attributes:
-        * target (str): Absolute path where the symlink points.
-        * path (str): Absolute path on the filesystem
 
-    Raises:
-        * TargetError:
-        * PathError:
+class BandwidthSchedule:
     '''
-    def __init__(self, path):
-        Path.__init__(self, path)
-        self.target = 'initiate'
+    Transfer rate limits that depend on the time of day. Each spec is
+    either a rate, which applies at any time not covered by a window, or
+    ``HH:MM-HH:MM=RATE`` for a window of local time, which may wrap past
+    midnight. A rate is a number of bytes per second with an optional K,
+    M, G or T suffix (powers of 1024), or ``off`` for no limit. The first
+    matching window wins.
 
-    @property
-    def target(self):
-        return self._target
+        example:
+        ['10M', '08:00-18:00=2M', '18:00-20:00=off']
 
-    @target.setter
-    def target(self, garbage):
-        contents = os.listdir(path=self.path)
-        contents = [link for link in contents
-                    if os.path.islink(os.path.join(self.path, link))]
-        if not len(contents) == 1:
-            raise TargetError('there must be exactly 1 symlink pointing to a'
-                              ' target BTRFS subvolume in snapshot'
-                              ' directory {}'.format(self.path))
-        self._target = os.path.realpath(os.path.abspath(os.path.join(
-                                        self.path, contents[0])))
+    Args:
+        * default (float): bytes per second outside of all windows, None
+          for no limit.
+        * windows (list(tuple)): (start minute, end minute, rate) with
+          minutes counted from midnight.
+    '''
+    # name of the file in a snapshot directory that overrides --bwlimit
+    filename = '.bwlimit'
+
+    def __init__(self, default=None, windows=()):
+        self.default = default
+        self.windows = list(windows)
+
+    def __str__(self):
+        specs = [] if self.default is None else [_format_rate(self.default)]
+        specs.extend('{:02d}:{:02d}-{:02d}:{:02d}={}'.format(
+            start // 60, start % 60, end // 60, end % 60, _format_rate(rate))
+            for start, end, rate in self.windows)
+        return ' '.join(specs) or 'off'
+
+    @classmethod
+    def parse(cls, specs):
+        '''
+        Args:
+            * specs (list(str)): see above.
 
-    def timestamp(self, counter=1):
+        Returns:
+            * BandwidthSchedule
+
+        Raises:
+            * BtrsnapError: a spec cannot be parsed.
         '''
-        Returns the next availible timestamp in self.path
+        default = None
+        windows = []
+        for spec in specs:
+            spec = spec.strip()
+            match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$',
+                             spec)
+            if match is None:
+                default = _parse_rate(spec)
+                continue
+            hours_1, minutes_1, hours_2, minutes_2 = (
+                int(number) for number in match.groups()[:4])
+            start = hours_1 * 60 + minutes_1
+            end = hours_2 * 60 + minutes_2
+            if minutes_1 > 59 or minutes_2 > 59 or start >= 24 * 60 or \
+                    end > 24 * 60 or start == end:
+                raise BtrsnapError('\'{}\' is not a valid time window'
+                                   .format(spec))
+            windows.append((start, end, _parse_rate(match.group(5))))
+        return cls(default, windows)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Read a schedule from a file with one spec per line. Blank lines and
+        lines starting with # are ignored.
 
-        Arguments:
-            * counter (int): start number for last 4 digits of timestamp.
+        Raises:
+            * BtrsnapError: a spec cannot be parsed.
+        '''
+        with open(filename) as f:
+            specs = [line for line in f.read().splitlines()
+                     if line.strip() and not line.lstrip().startswith('#')]
+        try:
+            return cls.parse(specs)
+        except BtrsnapError as err:
+            raise BtrsnapError('{}: {}'.format(filename, err))
+
+    def rate(self, now=None):
+        '''
+        Args:
+            * now (datetime.datetime): defaults to the current local time.
 
         Returns:
-            * (str): next availible timestamp
+            * float: bytes per second allowed at NOW, None for no limit.
         '''
-        today = datetime.date.today()
-        snapshots = self.snapshots()
-        if snapshots:
-            last_snapshot = snapshots[0]
-            is_older_than_last_snapshot = True
-        else:
-            last_snapshot = None
-            is_older_than_last_snapshot = False
-        timestamp = None
-
-        while ((timestamp is None)
-               or (timestamp in snapshots)
-               or (is_older_than_last_snapshot is True)):
-            timestamp = '{}-{:04d}'.format(today.isoformat(), counter)
-            if is_older_than_last_snapshot is True:
-                if timestamp <= last_snapshot:
-                    is_older_than_last_snapshot = True
-                else:
-                    is_older_than_last_snapshot = False
-
-            if counter > 9999:
-                raise Exception('More than 9999 snapshots created today.'
-                                ' Something is probably wrong. Aborting!')
-            counter += 1
-        return timestamp
+        if not self.windows:
+            return self.default
+        if now is None:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default
+
+
+class TokenBucket:
+    '''
+    Limits the rate of one or more transfers. Tokens, one per byte, flow
+    in at the rate of the schedule and collect up to BURST. A transfer
+    takes tokens before moving data and sleeps while it is in debt. One
+    bucket may be shared by transfers running in parallel, which then
+    share the limit.
 
+    Args:
+        * schedule (BandwidthSchedule): rate limits by time of day.
+        * burst (int): most bytes that may pass at full speed after an
+          idle period, and the largest single grant. Defaults to one
+          second at the current rate, at least 64 KiB.
+    '''
+    def __init__(self, schedule, burst=None):
+        self.schedule = schedule
+        self.burst = burst
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _capacity(self, rate):
+        if self.burst:
+            return self.burst
+        return max(int(rate), 64 << 10)
+
+    def acquire(self, size):
+        '''
+        Wait until SIZE bytes, or as many as BURST allows, may be sent.
 
-class Btrfs(Path):
+        Returns:
+            * int: number of bytes granted.
+        '''
+        with self._lock:
+            rate = self.schedule.rate()
+            now = time.monotonic()
+            if rate is None:
+                self._last = now
+                return size
+            capacity = self._capacity(rate)
+            self.tokens = min(capacity,
+                              self.tokens + (now - self._last) * rate)
+            self._last = now
+            size = min(size, capacity)
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return size
+
+    def refund(self, count):
+        '''
+        Return tokens granted by :meth:`acquire` but not used.
+        '''
+        with self._lock:
+            self.tokens += count
+
+
+def _parse_rate(string):
     '''
-    Wrapper class for BTRFS functions
+    Returns:
+        * int: bytes per second, None for ``off``.
+
+    Raises:
+        * BtrsnapError
+    '''
+    if string.strip().lower() == 'off':
+        return None
+    rate = parse_size(string)
+    if not rate:
+        raise BtrsnapError('a rate must be greater than zero, or off')
+    return rate
 
+
+def parse_size(string):
+    '''
     Args:
-        * Path (str): Path on filesystem
+        * string (str): a number of bytes with an optional K, M, G or T
+          suffix (powers of 1024), for example ``512K`` or ``1.5G``.
 
-    Attributes:
-        * path (str): absolute path
+    Returns:
+        * int: bytes.
 
     Raises:
-        * PathError:
+        * BtrsnapError: STRING is not a size.
     '''
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)(?:i?B)?$', string.strip(),
+                     re.IGNORECASE)
+    if match is None:
+        raise BtrsnapError('\'{}\' is not a size, try 512K, 10M or 1G'
+                           .format(string))
+    exponent = ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * 1024 ** exponent)
+
+
+def _format_rate(rate):
+    if rate is None:
+        return 'off'
+    for suffix in ('', 'K', 'M', 'G'):
+        if rate < 1024 or rate % 1024:
+            return '{}{}'.format(int(rate), suffix)
+        rate //= 1024
+    return '{}T'.format(int(rate))
+
+
+class StreamArchive(Path):
+    '''
+    A directory of btrfs send streams stored as plain files, so snapshots
+    can be archived on any filesystem. Every stream is either full or
+    incremental against the stream written before it, and the chain is
+    recorded in a text file named ``MANIFEST``, one line per stream in the
+    order they were written::
 
-    def snap(self, target, timestamp, readonly=True):
-        '''
-        Create a snapshot in self.path
+        snapshot<TAB>parent<TAB>file<TAB>bytes
 
-        Args:
-            * target (str): absolute path of BTRFS subvolume to be cloned.
-            * timestamp (str): name of the snapshot to be created.
-            * readonly (bool): True/False, new snapshot is readonly.
+    where parent is ``-`` for a full stream.
+
+    Streams are written through a :class:`Relay`, so memory use does not
+    depend on their size, and flushed to disk every :attr:`sync_size`
+    bytes. A stream only enters the manifest once it is completely on
+    disk.
+
+    With dedup, a stream is instead split into chunks that are kept once in
+    a :class:`chunks.ChunkStore` in the ``chunks`` subdirectory, and the
+    file named in the manifest lists the chunks of the stream. An archive
+    that has a chunk store keeps using it.
+
+    With compress, stream files are written in the framed format of
+    :class:`compression.Compressor`, and bytes in the manifest is the size
+    of the compressed file. :meth:`stream` tells such files by their magic.
+
+    All kinds of stream can be read from the same archive.
+
+    Args:
+        * path (str): archive directory.
+        * dedup (bool): store new streams in the chunk store.
+        * compress (tuple): (codec, level) to compress new stream files
+          with, see :func:`compression.parse`. Not used with dedup, chunks
+          are compressed already.
+
+    Raises:
+        * PathError: invalid path.
+        * BtrsnapError: both dedup and compress.
+    '''
+    manifest_name = 'MANIFEST'
+    chunks_name = 'chunks'
+    sync_size = 256 << 20
+    # threads hashing and compressing chunks
+    jobs = os.cpu_count() or 1
+
+    def __init__(self, path, dedup=False, compress=None):
+        super().__init__(path)
+        self.dedup = dedup or os.path.isdir(
+            os.path.join(self.path, self.chunks_name))
+        if self.dedup and compress is not None:
+            raise BtrsnapError('\'{}\' stores streams as deduplicated'
+                               ' chunks, which cannot be compressed again'
+                               .format(self.path))
+        self.compress = compress
+
+    @property
+    def chunk_store(self):
+        return chunks.ChunkStore(os.path.join(self.path, self.chunks_name))
+
+    @property
+    def manifest(self):
+        return os.path.join(self.path, self.manifest_name)
+
+    def entries(self):
+        '''
+        Returns:
+            * list(StreamEntry): streams in the order they were written.
 
         Raises:
-            * BtrfsError:
+            * BtrsnapError: the manifest cannot be parsed.
         '''
-        snapshot = os.path.join(self.path, timestamp)
-        if readonly:
-            args = ['btrfs', 'subvolume', 'snapshot', '-r', target, snapshot]
-        else:
-            args = ['btrfs', 'subvolume', 'snapshot', target, snapshot]
+        try:
+            with open(self.manifest) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for number, line in enumerate(lines, 1):
+            fields = line.split('\t')
+            if len(fields) != 4 or not fields[3].isdigit():
+                raise BtrsnapError('{} line {} is corrupt'
+                                   .format(self.manifest, number))
+            parent = None if fields[1] == '-' else fields[1]
+            entries.append(StreamEntry(fields[0], parent, fields[2],
+                                       int(fields[3])))
+        return entries
 
-        return_code = subprocess.call(args)
-        if return_code:
-            raise BtrfsError('BTRFS failed to create a snapshot'
-                             ' of {} in \'{}\''.format(target, snapshot))
+    def snapshots(self):
+        '''
+        Returns:
+            * list(str): snapshots with a stream in the archive, newest
+              first.
+        '''
+        return sorted((entry.snapshot for entry in self.entries()),
+                      key=snapshot_key, reverse=True)
 
-    def unsnap(self, timestamp):
+    def write(self, p1, snapshot, parent=None):
         '''
-        Delete a snapshot in self.path
+        Store the output of a btrfs send process as the stream of SNAPSHOT.
 
         Args:
-            * timestamp (str): name of the snapshot to be deleted.
+            * p1 (subprocess.Popen): send process, see :meth:`Btrfs.send`.
+            * snapshot (str): name of the snapshot being sent.
+            * parent (str): name of the parent snapshot of an incremental
+              stream. **must already be in the archive.**
+
+        Returns:
+            * Relay, chunks.Deduplicator or compression.Compressor:
+              statistics of the transfer.
 
         Raises:
-            * BtrfsError:
+            * BtrfsError: btrfs send failed.
         '''
-        snapshot = os.path.join(self.path, timestamp)
-        args = ['btrfs', 'subvolume', 'delete', snapshot]
-        return_code = subprocess.call(args, stderr=subprocess.DEVNULL,
-                                      stdout=subprocess.DEVNULL)
-        if return_code:
-            raise BtrfsError('BTRFS failed to delete the subvolume.'
-                             ' Perhaps you need root permissions')
+        filename = snapshot + ('.chunks' if self.dedup else '.btrfs')
+        partial = os.path.join(self.path, '.{}.partial'.format(filename))
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if self.dedup:
+                stage = chunks.Deduplicator(p1.stdout.fileno(),
+                                            self.chunk_store, fd,
+                                            jobs=self.jobs)
+                stage.sync_size = self.sync_size
+            elif self.compress is not None:
+                codec, level = self.compress
+                stage = compression.Compressor(p1.stdout.fileno(), fd,
+                                               codec=codec, level=level,
+                                               jobs=self.jobs)
+            else:
+                stage = Relay(p1.stdout.fileno(), fd,
+                              sync_size=self.sync_size)
+            try:
+                with activity.transfer(os.path.join(self.path, filename),
+                                       stage, 'bytes' if isinstance(
+                                           stage, Relay) else 'bytes_in'):
+                    stage.run()
+            finally:
+                p1.stdout.close()
+                p1.wait()
+            if p1.returncode:
+                raise BtrfsError('BTRFS failed to send \'{}\''
+                                 .format(p1.args[-1]))
+            if self.dedup:
+                os.fsync(fd)
+                length = stage.bytes_in
+            elif self.compress is not None:
+                os.fsync(fd)
+                length = stage.bytes_out
+            else:
+                stage.sync()
+                length = stage.bytes
+        except BaseException:
+            os.close(fd)
+            os.unlink(partial)
+            raise
+        os.close(fd)
+        os.rename(partial, os.path.join(self.path, filename))
+        line = '\t'.join([snapshot, parent or '-', filename, str(length)])
+        with open(self.manifest, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        streams.sync_directory(self.path)
+        return stage
+
+    @contextlib.contextmanager
+    def stream(self, entry):
+        '''
+        Open the stream of an archived snapshot for reading.
+
+        Args:
+            * entry (StreamEntry): see :meth:`entries`.
+
+        Yields:
+            * int: file descriptor the stream can be read from.
+
+        Raises:
+            * BtrsnapError: the stream is missing, truncated or corrupt.
+        '''
+        filename = os.path.join(self.path, entry.file)
+        if entry.file.endswith('.chunks'):
+            with self.chunk_store.reader(filename, entry.bytes) as source:
+                yield source
+            return
+        if not os.path.isfile(filename) or \
+                os.path.getsize(filename) != entry.bytes:
+            raise BtrsnapError('stream file \'{}\' is missing or truncated'
+                               .format(filename))
+        with open(filename, 'rb') as f:
+            source = f.fileno()
+            magic = compression.STREAM_MAGIC
+            if os.pread(source, len(magic), 0) != magic:
+                yield source
+                return
+            with compression.pipe_from(lambda sink: compression.Decompressor(
+                    source, sink, jobs=self.jobs)) as (source, stage):
+                yield source
+
+
+class RetentionPolicy:
+    '''
+    Grandfather-father-son retention: keep the newest snapshot of each of
+    the last HOURLY hours, DAILY days, WEEKLY weeks, MONTHLY months and
+    YEARLY years that have snapshots. A snapshot kept by any of the rules
+    is kept.
+
+    Snapshots named YYYY-MM-DD-#### carry no time of day, so for the
+    hourly rule each of their days counts as a single hour.
+
+    Args:
+        * hourly, daily, weekly, monthly, yearly (int): number of periods
+          to keep a snapshot for.
 
-    def send(self, snapshot, parent=None):
+    Raises:
+        * BtrsnapError: a count is not a positive integer.
+    '''
+    periods = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0, yearly=0):
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+        for period in self.periods:
+            count = getattr(self, period)
+            if not isinstance(count, int) or count < 0:
+                raise BtrsnapError('{} must be a positive integer'
+                                   .format(period))
+
+    def __str__(self):
+        return ', '.join('{} {}'.format(getattr(self, period), period)
+                         for period in self.periods if getattr(self, period))
+
+    def split(self, snapshots):
         '''
-        Send a snapshot using btrfs-progs.
+        Decide which snapshots to keep in a single pass over the snapshots,
+        newest first.
 
         Args:
-            * snapshot (str): snapshot to be sent relative to self.path.
-            * parent (str): parent snapshot relative to self.path.
-                **must alread be on receiving filesystem.**
+            * snapshots (list(str)): snapshot names in any order.
 
         Returns:
-            * (subprocess.Popen): can be used to pipe output to receive.
+            * tuple(list(str), list(str)): (keep, delete), both newest first.
         '''
-        args = ['btrfs', 'send']
-        if parent:
-            parent = os.path.join(self.path, parent)
-            args.extend(['-p', parent])
+        ordered = sorted(snapshots, key=snapshot_key, reverse=True)
+        remaining = [getattr(self, period) for period in self.periods]
+        last = [None] * len(self.periods)
+        keep = []
+        delete = []
+        day = None
+        for name in ordered:
+            if name[:10] != day:
+                day = name[:10]
+                week = snapshot_date(name).isocalendar()[:2]
+            if len(name) > len('YYYY-MM-DD-####'):
+                hour = name[:13]
+            else:
+                hour = day
+            keys = (hour, day, week, name[:7], name[:4])
+            kept = False
+            for index, key in enumerate(keys):
+                if remaining[index] and key != last[index]:
+                    last[index] = key
+                    remaining[index] -= 1
+                    kept = True
+            if kept:
+                keep.append(name)
+            else:
+                delete.append(name)
+        return keep, delete
 
-        args.append(os.path.join(self.path, snapshot))
-        p1 = subprocess.Popen(args, stdout=subprocess.PIPE)
-        return p1
 
-    def receive(self, p1):
+class DeletionPlan:
+    '''
+    Snapshots in one snapshot directory selected for deletion. Nothing is
+    deleted until :meth:`execute` is called.
+
+    Args:
+        * path (str): absolute path of the snapshot directory.
+        * keep (list(str)): snapshots that are kept, newest first.
+        * delete (list(str)): snapshots to delete, newest first.
+        * messages (list(str)): description of the rules applied. Those
+          that delete snapshots start with :attr:`planned`, and are
+          reported with :attr:`done` instead once :meth:`execute` ran.
+
+    Attributes:
+        * path, keep, delete, messages: as above.
+    '''
+    planned = 'Would delete'
+    done = 'Deleted'
+
+    def __init__(self, path, keep, delete, messages):
+        self.path = path
+        self.keep = keep
+        self.delete = delete
+        self.messages = messages
+
+    def __str__(self):
+        return '\n'.join(self.messages)
+
+    def execute(self, commit=None, catalog=None):
         '''
-        Receive a snapshot using btrfs-progs.
+        Delete the planned snapshots.
 
         Args:
-            * p1 (subprocess.Popen): send process
+            * commit (str): None, 'after' or 'each'.
+              See :meth:`Btrfs.unsnap_many`
+            * catalog (Catalog): record the deletions in this catalog.
+
+        Returns:
+            * msg (str): results
 
         Raises:
             * BtrfsError:
         '''
-        args = ['btrfs', 'receive', self.path]
-        p2 = subprocess.Popen(args, stdin=p1.stdout,
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output = p2.communicate()
-        p1.stdout.close()
-        if p2.returncode:
-            raise BtrfsError('BTRFS Failed send/receive.'
-                             ' Do you have root permissions?'
-                             ' Are you receiving to the top level'
-                             ' of your BTRFS filesystem?',
-                             output[0], output[1])
+        if self.delete:
+            with activity.deleting(self.path, self.delete):
+                Btrfs(self.path).unsnap_many(self.delete, commit=commit)
+            if catalog is not None:
+                catalog.remove(self.path, self.delete)
+        return '\n'.join(self.done + message[len(self.planned):]
+                         if message.startswith(self.planned) else message
+                         for message in self.messages)
+
+
+def _snapshots(path, catalog=None, index=None):
+    '''
+    Returns:
+        * list(str): snapshots in PATH (a Path object), from CATALOG when
+          one is given, else from INDEX (a SubvolumeIndex) when one is
+          given.
+    '''
+    if catalog is not None:
+        return catalog.snapshots(path.path)
+    if index is not None:
+        return index.snapshots(path.path)
+    return path.snapshots()
+
+
+def _arg_chunks(args, paths, limit=None):
+    '''
+    Split PATHS into lists that can each be appended to ARGS without the
+    command line growing past the kernel's ARG_MAX.
+
+    Args:
+        * args (list(str)): the command that each chunk is appended to.
+        * paths (list(str)): arguments to split up.
+        * limit (int): size budget in bytes, defaults to half of ARG_MAX
+          to leave room for the environment.
+
+    Yields:
+        * list(str): consecutive slices of PATHS.
+    '''
+    if limit is None:
+        try:
+            limit = os.sysconf('SC_ARG_MAX') // 2
+        except (ValueError, OSError):
+            limit = 65536
+    pointer = 8
+
+    def size(arg):
+        return len(os.fsencode(arg)) + 1 + pointer
+
+    base = sum(size(arg) for arg in args)
+    chunk = []
+    used = base
+    for path in paths:
+        if chunk and used + size(path) > limit:
+            yield chunk
+            chunk = []
+            used = base
+        chunk.append(path)
+        used += size(path)
+    if chunk:
+        yield chunk
+
+
+def _run_parallel(func, items, jobs=1):
+    '''
+    Call FUNC once for each item in ITEMS, running at most JOBS calls at
+    the same time. An exception raised for one item does not stop the
+    others.
+
+    Args:
+        * func (callable): called with a single item.
+        * items (list): work items.
+        * jobs (int): maximum number of concurrent calls.
+
+    Returns:
+        * list(tuple): (item, result, error) for each item, in the same
+          order as ITEMS. error is None on success, otherwise it is the
+          exception that was raised and result is None.
+    '''
+    if not isinstance(jobs, int) or jobs < 1:
+        raise BtrsnapError('jobs must be a positive integer')
+
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as err:
+            return item, None, err
+
+    if jobs == 1 or len(items) <= 1:
+        return [call(item) for item in items]
+    import concurrent.futures
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(call, items))
 
-def snap(path, readonly=True):
+
+def snap(path, readonly=True, catalog=None, precise=False,
+         if_changed=False, indexes=None):
     '''
     Creates a snapshot inside PATH with format YYYY-MM-DD-####
     of the subvolume pointed to by the symlink inside PATH.
@@ -295,78 +1161,311 @@ def snap(path, readonly=True):
     Args:
         * path (str): path on filesystem
         * readonly (bool): create readonly snapshot?
+        * catalog (Catalog): record the new snapshot in this catalog.
+        * precise (bool): name the snapshot YYYY-MM-DD-HHMMSS-ffff instead.
+          Without it, the snapshot is still named so on a day that already
+          has a precise one, see :meth:`SnapPath.timestamp`.
+        * if_changed (bool): do not create a snapshot if the target has not
+          been written to since the newest snapshot of it was taken. Where
+          this cannot be told, because ``btrfs subvolume list`` fails, the
+          snapshot is created.
+        * indexes (dict): cache of :class:`SubvolumeIndex` by filesystem,
+          used with IF_CHANGED.
+
+    Returns:
+        * str: why no snapshot was created, None if one was.
     '''
-    snappath = SnapPath(path)
+    snappath = SnapPath(path, catalog)
     btrfs = Btrfs(snappath.path)
-    btrfs.snap(snappath.target, snappath.timestamp(), readonly=readonly)
+    with snappath.lock():
+        if if_changed:
+            newest = _unchanged_since(snappath,
+                                      {} if indexes is None else indexes)
+            if newest is not None:
+                return '\'{}\' has not changed since {} ... not creating a' \
+                    ' snapshot'.format(snappath.target, newest)
+        timestamp = snappath.timestamp(precise=precise)
+        btrfs.snap(snappath.target, timestamp, readonly=readonly)
+    if catalog is not None:
+        catalog.add(snappath.path, timestamp)
+
+
+def _unchanged_since(snappath, indexes):
+    '''
+    Compare the generation of the target of SNAPPATH, the last transaction
+    that wrote to it, with the generation its newest snapshot was created
+    in.
 
+    Args:
+        * snappath (SnapPath)
+        * indexes (dict): see :func:`_subvolume_index`.
 
-def unsnap(path, keep=None, date=None):
+    Returns:
+        * str: the newest snapshot if it is a snapshot of the target and
+          the target has not been written to since, else None.
     '''
-    Delete all but most recent KEEP snapshots inside PATH
-    OR
-    Delete all snapshots created on or before DATE
+    index = _directory_index(snappath.path, indexes, commit=True)
+    target_index = _subvolume_index(snappath.target, indexes, commit=True)
+    if index is None or target_index is None:
+        return None
+    snapshots = index.snapshots(snappath.path)
+    target = target_index.find(snappath.target)
+    if not snapshots or target is None:
+        return None
+    newest = index.children(snappath.path)[snapshots[0]]
+    if newest.parent_uuid != target.uuid or newest.cgeneration is None:
+        # the symlink has been pointed at another subvolume since
+        return None
+    if target.generation > newest.cgeneration:
+        return None
+    return snapshots[0]
+
+
+def free_space(path):
+    '''
+    Args:
+        * path (str): path on filesystem.
+
+    Returns:
+        * float: percentage of the filesystem holding PATH that is free.
+    '''
+    stat = os.statvfs(path)
+    if not stat.f_blocks:
+        return 100.0
+    return 100.0 * stat.f_bavail / stat.f_blocks
+
+
+def unsnap_free(paths, free, commit=None, catalog=None, batch=1):
+    '''
+    Delete the oldest snapshots across PATHS until at least FREE percent
+    of the filesystem is free. After each batch btrsnap waits for btrfs to
+    reclaim the space before checking again, so no more snapshots are
+    deleted than needed. The newest snapshot in each directory is never
+    deleted.
+
+    Args:
+        * paths (list(Path)): snapshot directories.
+        * free (float): target percentage of free space.
+        * commit (str): None, 'after' or 'each'. See :meth:`Btrfs.unsnap_many`
+        * catalog (Catalog): list snapshots from, and record deletions in,
+          this catalog.
+        * batch (int): number of snapshots deleted between checks.
+
+    Returns:
+        * msg (str): results
+
+    Raises:
+        * BtrfsError: a deletion failed. The message also tells what was
+          deleted before, and those snapshots are removed from CATALOG.
+    '''
+    if not 0 <= free <= 100:
+        raise BtrsnapError('free must be a percentage between 0 and 100')
+    if not isinstance(batch, int) or batch < 1:
+        raise BtrsnapError('batch must be a positive integer')
+
+    candidates = []
+    for path in paths:
+        snapshots = _snapshots(path, catalog)
+        candidates.extend((snapshot_key(snapshot), path.path, snapshot)
+                          for snapshot in snapshots[1:])
+    candidates.sort()
+
+    deleted = collections.OrderedDict()
+    index = 0
+    while index < len(candidates):
+        chunk = collections.OrderedDict()
+        size = 0
+        enough = {}
+        while index < len(candidates) and size < batch:
+            key, path, snapshot = candidates[index]
+            index += 1
+            if path not in enough:
+                enough[path] = free_space(path) >= free
+            if not enough[path]:
+                chunk.setdefault(path, []).append(snapshot)
+                size += 1
+        for path, snapshots in chunk.items():
+            error = None
+            try:
+                with activity.deleting(path, snapshots):
+                    Btrfs(path).unsnap_many(snapshots, commit=commit)
+            except BtrfsError as err:
+                error = err
+                # those deleted before the failure are gone all the same
+                snapshots = [snapshot for snapshot in snapshots
+                             if not os.path.lexists(os.path.join(path,
+                                                                 snapshot))]
+            if catalog is not None and snapshots:
+                catalog.remove(path, snapshots)
+            if snapshots:
+                deleted.setdefault(path, []).extend(snapshots)
+            if error is not None:
+                msg = ['Deleted {} snapshot(s) from "{}" to free space'
+                       .format(len(snapshots), path)
+                       for path, snapshots in deleted.items()]
+                msg.append(str(error))
+                raise BtrfsError('\n'.join(msg))
+        for path in chunk:
+            Btrfs(path).sync()
+
+    msg = []
+    for path, snapshots in deleted.items():
+        msg.append('Deleted {} snapshot(s) from "{}" to free space'
+                   .format(len(snapshots), path))
+    if not deleted:
+        msg.append('There is already {}% or more free space ...'
+                   ' not deleting any'.format(free))
+    for path in paths:
+        available = free_space(path.path)
+        if available < free:
+            msg.append('Only {:.1f}% free space left for "{}" after deleting'
+                       ' all but the newest snapshots'.format(available,
+                                                              path.path))
+    return '\n'.join(msg)
+
+
+def split_by_date(snapshots, cutoff):
+    '''
+    Split snapshot names into those created after CUTOFF and those
+    created on or before it. Each name is parsed once into a day ordinal
+    and the boundary is found with a binary search.
+
+    Args:
+        * snapshots (list(str)): snapshot names in any order.
+        * cutoff (int): ordinal of the last day to be deleted, see
+          :func:`dates.cutoff`. A :class:`datetime.date` works too.
+
+    Returns:
+        * tuple(list(str), list(str)): (newer, older), both newest first.
+    '''
+    ordered = sorted(snapshots, key=snapshot_key)
+    ordinals = []
+    last_day = None
+    for name in ordered:
+        if name[:10] != last_day:
+            last_day = name[:10]
+            ordinal = snapshot_date(name).toordinal()
+        ordinals.append(ordinal)
+    if isinstance(cutoff, datetime.date):
+        cutoff = cutoff.toordinal()
+    index = bisect.bisect_right(ordinals, cutoff)
+    newer = ordered[index:]
+    older = ordered[:index]
+    newer.reverse()
+    older.reverse()
+    return newer, older
+
+
+def plan_unsnap(path, keep=None, date=None, catalog=None, policy=None,
+                indexes=None):
+    '''
+    Work out which snapshots :func:`unsnap` would delete, without deleting
+    anything.
 
     Args:
         * path (str): path on filesystem
         * keep (int): number of snapshots to keep
-        * date (dateutil.relativedelta.relativedelta): set to some date
-            in the past
+        * date (dates.Period): delete snapshots created on or before the
+          day it reaches back to. Anything that can be subtracted from a
+          date, such as ``dateutil.relativedelta``, works too.
+        * catalog (Catalog): list snapshots from this catalog.
+        * policy (RetentionPolicy): delete the snapshots this policy does
+          not keep.
+        * indexes (dict): cache of :class:`SubvolumeIndex` by filesystem.
+          Without a catalog, snapshots are listed from the index of the
+          filesystem PATH is on where it can be read and shows PATH, so
+          only real subvolumes are considered.
 
     Returns:
-        * msg (str): results
+        * DeletionPlan: the snapshots to keep and delete.
     '''
     snappath = Path(path)
-    btrfs = Btrfs(snappath.path)
-    snapshots = snappath.snapshots()
-    msg = ""
+    index = None
+    if catalog is None:
+        index = _directory_index(snappath.path,
+                                 {} if indexes is None else indexes)
+    snapshots = _snapshots(snappath, catalog, index)
+    delete = []
+    messages = []
     if keep is not None:
-        if not keep >= 0 or not isinstance(keep, int):
+        if not isinstance(keep, int) or not keep >= 0:
             raise Exception('keep must be a positive integer')
         if len(snapshots) > keep:
-            snaps_to_delete = snapshots[keep:]
-            for snapshot in snaps_to_delete:
-                btrfs.unsnap(snapshot)
-            msg = 'Deleted {} snapshot(s) from "{}". {} kept'.format(
-                len(snaps_to_delete), snappath.path, keep)
+            delete = snapshots[keep:]
+            snapshots = snapshots[:keep]
+            messages.append('{} {} snapshot(s) from "{}". {} kept'
+                            .format(DeletionPlan.planned, len(delete),
+                                    snappath.path, keep))
         else:
-            msg = ('There are {} or less snapshots in "{}" ...'
-                   ' not deleting any'.format(keep, snappath.path)
-                   )
+            messages.append('There are {} or less snapshots in "{}" ...'
+                            ' not deleting any'.format(keep, snappath.path))
     if date is not None:
-        today = datetime.date.today()
-        delta_today = today - date
-
-        snapshots.sort()
-        snapshots_deleted = 0
-        while snapshots:
-            snap = snapshots.pop()
-            snap_date = snap.split('-')
-            year, month, day = snap_date[:-1]
-            snap_datetime_date = relativedelta(year=int(year),
-                                               month=int(month),
-                                               day=int(day)
-                                               )
-            delta_snap = today - snap_datetime_date
-            if delta_today >= delta_snap:
-                btrfs.unsnap(snap)
-                snapshots_deleted += 1
-            msg = ('Deleted {} snapshot(s) from "{}"'
-                   '\n\t created on or before {}'
-                   .format(snapshots_deleted,
-                           snappath.path,
-                           delta_today.isoformat()
-                           )
-                   )
-        if not msg:
-            msg = ('There are no snapshot(s) as old or older than "{}"'
-                   ' in "{}" ... not deleting any'
-                   .format(delta_today.isoformat(), snappath.path))
+        cutoff = dates.cutoff(date)
+        snapshots, older = split_by_date(snapshots, cutoff)
+        if older:
+            messages.append('{} {} snapshot(s) from "{}"'
+                            '\n\t created on or before {}'
+                            .format(DeletionPlan.planned, len(older),
+                                    snappath.path, dates.isoformat(cutoff)))
+            delete = sorted(delete + older, key=snapshot_key, reverse=True)
+        else:
+            messages.append('There are no snapshot(s) as old or older than'
+                            ' "{}" in "{}" ... not deleting any'
+                            .format(dates.isoformat(cutoff), snappath.path))
+    if policy is not None:
+        snapshots, unwanted = policy.split(snapshots)
+        if unwanted:
+            messages.append('{} {} snapshot(s) from "{}". {} kept by'
+                            ' policy: {}'.format(DeletionPlan.planned,
+                                                 len(unwanted),
+                                                 snappath.path,
+                                                 len(snapshots), policy))
+            delete = sorted(delete + unwanted, key=snapshot_key,
+                            reverse=True)
+        else:
+            messages.append('All snapshots in "{}" are kept by policy: {}'
+                            ' ... not deleting any'.format(snappath.path,
+                                                           policy))
+    return DeletionPlan(snappath.path, snapshots, delete, messages)
+
+
+def unsnap(path, keep=None, date=None, commit=None, catalog=None,
+           policy=None, free=None, indexes=None):
+    '''
+    Delete all but most recent KEEP snapshots inside PATH
+    OR
+    Delete all snapshots created on or before DATE
+    OR
+    Delete all snapshots not kept by POLICY
+    OR
+    Delete the oldest snapshots until FREE percent of the filesystem is free
+
+    Args:
+        * path (str): path on filesystem
+        * keep (int): number of snapshots to keep
+        * date (dates.Period): see :func:`plan_unsnap`.
+        * commit (str): None, 'after' or 'each'. See :meth:`Btrfs.unsnap_many`
+        * catalog (Catalog): list snapshots from, and record deletions in,
+          this catalog.
+        * policy (RetentionPolicy): grandfather-father-son retention policy
+        * free (float): percentage of free space to reach. See
+          :func:`unsnap_free`
+        * indexes (dict): see :func:`plan_unsnap`
 
+    Returns:
+        * msg (str): results
+    '''
+    plan = plan_unsnap(path, keep=keep, date=date, catalog=catalog,
+                       policy=policy, indexes=indexes)
+    msg = plan.execute(commit=commit, catalog=catalog)
+    if free is not None:
+        msg = '\n'.join(filter(None, [msg, unsnap_free(
+            [Path(path)], free, commit=commit, catalog=catalog)]))
     return msg
 
 
-def unsnap_deep(path, keep=None, date=None):
+def unsnap_deep(path, keep=None, date=None, commit=None, catalog=None,
+                policy=None, free=None):
     '''
     Delete all but KEEP snapshots from each directory
     inside of path
@@ -374,8 +1473,12 @@ def unsnap_deep(path, keep=None, date=None):
     Args:
         * path (str): path on filesystem
         * keep (int): number of snapshots to keep
-        * date (dateutil.relativedelta.relativedelta): set to some date
-            in the past
+        * date (dates.Period): see :func:`plan_unsnap`.
+        * commit (str): None, 'after' or 'each'. See :meth:`Btrfs.unsnap_many`
+        * catalog (Catalog): see :func:`unsnap`
+        * policy (RetentionPolicy): see :func:`unsnap`
+        * free (float): percentage of free space to reach, deleting the
+          oldest snapshots across all subdirectories first.
 
     Returns:
         * msg (str): results
@@ -386,43 +1489,80 @@ def unsnap_deep(path, keep=None, date=None):
     if len(path_objects) == 0:
         msg = 'No subdirectories found in \'{}\''.format(parent_path.path)
         return msg
-    for path in path_objects:
-        msg.append(unsnap(path.path, keep=keep, date=date))
-    return '\n'.join(msg)
-
-
-def snap_deep(path, readonly=True):
+    if keep is not None or date is not None or policy is not None:
+        # list each filesystem once for all subdirectories
+        indexes = {}
+        for path in path_objects:
+            msg.append(unsnap(path.path, keep=keep, date=date,
+                              commit=commit, catalog=catalog, policy=policy,
+                              indexes=indexes))
+    if free is not None:
+        msg.append(unsnap_free(path_objects, free, commit=commit,
+                               catalog=catalog))
+    return '\n'.join(filter(None, msg))
+
+
+def snap_deep(path, readonly=True, jobs=1, catalog=None, precise=False,
+              if_changed=False):
     '''
     Create a snapshot in each subdirectory in PATH.
 
     Args:
         * path (str): path on filesystem
         * readonly (bool): Create readonly snapshots?
+        * jobs (int): maximum number of snapshots created at the same time.
+        * catalog (Catalog): record the new snapshots in this catalog.
+        * precise (bool): name snapshots YYYY-MM-DD-HHMMSS-ffff instead.
+        * if_changed (bool): see :func:`snap`. The filesystems involved are
+          listed once for all subdirectories.
 
     Returns:
         * msg (str): results
     '''
     snap_deep = Path(path)
-    snap_paths = snap_deep.sub_snap_paths_list()
+    snap_paths = snap_deep.sub_snap_paths_list(catalog)
     if len(snap_paths) == 0:
         msg = 'No snapshot directories found in \'{}\''.format(snap_deep.path)
         return msg
-    for snap_path in snap_paths:
-        snap(snap_path.path, readonly=readonly)
+    snap_paths.sort(key=lambda snap_path: snap_path.path)
+
+    indexes = {}
+
+    def worker(snap_path):
+        return snap(snap_path.path, readonly=readonly, catalog=catalog,
+                    precise=precise, if_changed=if_changed, indexes=indexes)
 
+    results = _run_parallel(worker, snap_paths, jobs=jobs)
+    msg = []
+    errors = 0
+    skipped = 0
+    for snap_path, result, error in results:
+        if error is not None:
+            msg.append('Error: \'{}\': {}'.format(snap_path.path, error))
+            errors += 1
+        elif result is not None:
+            skipped += 1
+    summary = 'Created {} of {} snapshot(s) in \'{}\''.format(
+        len(results) - errors - skipped, len(results), snap_deep.path)
+    if skipped:
+        summary += ', {} skipped'.format(skipped)
+    msg.append(summary)
+    return '\n'.join(msg)
 
-def show_snaps(path):
+
+def show_snaps(path, catalog=None):
     '''
     List snapshots inside PATH.
 
     Args:
         * path (str): path on filesystem.
+        * catalog (Catalog): list snapshots from this catalog.
 
     Returns:
         * msg (str): results
     '''
     path = Path(path)
-    snapshots = path.snapshots()
+    snapshots = _snapshots(path, catalog)
     msg = []
 
     msg.append('\n"{}"'.format(path.path))
@@ -436,12 +1576,17 @@ def show_snaps(path):
     return '\n'.join(msg)
 
 
-def show_snaps_deep(path):
+def show_snaps_deep(path, catalog=None, indexes=None):
     '''
-    Recursively list snapshots inside PATH.
+    Recursively list snapshots inside PATH. Where the filesystem can be
+    listed with ``btrfs subvolume list``, only real subvolumes are shown,
+    each with its creation time and generation, and received copies are
+    marked as such.
 
     Args:
         * path (str): Path on filesystem.
+        * catalog (Catalog): list snapshots from this catalog.
+        * indexes (dict): cache of :class:`SubvolumeIndex` by filesystem.
 
     Returns:
         * msg (str): results
@@ -451,8 +1596,12 @@ def show_snaps_deep(path):
     overall_path_count = 0
     parent_path = Path(path)
     sub_paths_list = parent_path.sub_paths_list()
+    if indexes is None:
+        indexes = {}
     for p in sub_paths_list:
-        snapshots = p.snapshots()
+        index = _directory_index(p.path, indexes, times=True)
+        snapshots = _snapshots(p, catalog, index)
+        subvolumes = index.children(p.path) if index is not None else {}
         msg.append('\n\'{}\'/'.format(p.path))
         if snapshots:
             newest = snapshots[0]
@@ -460,7 +1609,8 @@ def show_snaps_deep(path):
             msg.append('\t{} snapshot(s): Newest = {}, Oldest = {}'.format(
                 len(snapshots), newest[:-5], oldest[:-5]))
             for snapshot in snapshots:
-                msg.append('\t\t{}'.format(snapshot))
+                msg.append('\t\t{}'.format(_describe_subvolume(
+                    snapshot, subvolumes.get(snapshot))))
                 overall_snapshot_count += 1
         else:
             msg.append('\t\tNo snapshots')
@@ -472,84 +1622,478 @@ def show_snaps_deep(path):
     return '\n'.join(msg)
 
 
-def send_receive(send_path, receive_path):
+def _describe_subvolume(name, subvolume):
+    '''
+    Returns:
+        * str: NAME followed by what the index knows about SUBVOLUME.
+    '''
+    if subvolume is None:
+        return name
+    fields = [name]
+    if subvolume.otime is not None:
+        fields.append('created {}'.format(subvolume.otime))
+    fields.append('generation {}'.format(subvolume.generation))
+    if subvolume.received_uuid:
+        fields.append('received')
+    return '\t'.join(fields)
+
+
+def send_receive(send_path, receive_path, catalog=None, transport=None,
+                 bwlimit=None, indexes=None):
     '''
-    Send snapshots from one BTRFS PATH to another.
+    Send snapshots from one BTRFS PATH to another, or to several.
 
     Args:
         * send_path: path to snapshot to send
-        * receive_path: path to receive snapshot in.
+        * receive_path (str or list(str)): path, or paths, to receive
+          snapshots in. Each one gets the snapshots it is missing. When
+          several need the same snapshot against the same parent, a single
+          btrfs send feeds all of them through a :class:`Tee`.
+        * catalog (Catalog): list snapshots from, and record received
+          snapshots in, this catalog.
+        * transport (Transport): run btrfs receive, and list RECEIVE_PATH,
+          through this transport, see :func:`transport_for`. RECEIVE_PATH
+          is a path on the receiving side. The catalog then only records
+          which snapshots were sent.
+        * bwlimit (TokenBucket): limit the transfer rate. A
+          :attr:`BandwidthSchedule.filename` file in SEND_PATH replaces it
+          with a bucket of its own for this directory.
+        * indexes (dict): cache of :class:`SubvolumeIndex` by filesystem,
+          shared between calls. Where both filesystems can be listed, each
+          stream is sent against the closest snapshot the receiving side
+          holds a copy of, found by UUID, with neighbouring copies as
+          clone sources. Otherwise snapshots are matched by name.
 
     Returns:
         * (str): results
+
+    Raises:
+        * BtrfsError: with several RECEIVE_PATHs, raised once the others
+          are up to date, listing the paths that failed.
     '''
-    send = SnapPath(send_path)
-    receive = Path(receive_path)
+    send = SnapPath(send_path, catalog)
     send_btr = Btrfs(send.path)
-    receive_btr = Btrfs(receive.path)
+    override = os.path.join(send.path, BandwidthSchedule.filename)
+    if os.path.isfile(override):
+        bwlimit = TokenBucket(BandwidthSchedule.load(override),
+                              burst=bwlimit.burst if bwlimit else None)
+    if transport is None:
+        transport = Transport()
+    if indexes is None:
+        indexes = {}
+    fan_out = not isinstance(receive_path, str)
+    receive_paths = list(receive_path) if fan_out else [receive_path]
+    if not transport.remote:
+        receive_paths = [Path(path).path for path in receive_paths]
+    sent = dict.fromkeys(receive_paths, 0)
+    failures = collections.OrderedDict()
+    transfers = []
+
+    def received(snapshot, parent, path):
+        sent[path] += 1
+        if catalog is not None:
+            if not transport.remote:
+                catalog.add(path, snapshot, parent=parent)
+            catalog.add_replica(send.path, snapshot, transport.describe(path))
+
+    def transfer(snapshot, parent, clones, paths):
+        p1 = send_btr.send(snapshot, parent, clones)
+        if len(paths) == 1:
+            try:
+                relay = transport.receive(paths[0], p1, limiter=bwlimit)
+            except BtrfsError as err:
+                if not fan_out:
+                    raise
+                return {paths[0]: err}
+            errors = {}
+        else:
+            relay, errors = transport.receive_many(paths, p1,
+                                                   limiter=bwlimit)
+        for path in paths:
+            if path not in errors:
+                received(snapshot, parent, path)
+        if fan_out:
+            transfers.append('\t{} to {}: {}'.format(
+                snapshot, ', '.join(transport.describe(path)
+                                    for path in paths
+                                    if path not in errors), relay))
+        else:
+            transfers.append('\t{}: {}'.format(snapshot, relay))
+        return errors
+
+    with transport:
+        send_index = _directory_index(send.path, indexes)
+        snapshots = _snapshots(send, catalog, send_index)
+        if send_index is not None:
+            subvolumes = dict(
+                (snapshot, send_index.find(os.path.join(send.path, snapshot)))
+                for snapshot in snapshots)
+        chains = collections.OrderedDict()
+        for path in receive_paths:
+            if transport.remote:
+                existing = transport.snapshots(path)
+                index = _subvolume_index(
+                    path, indexes, transport,
+                    key=transport.describe(posixpath.dirname(path)))
+            else:
+                index = _subvolume_index(path, indexes)
+                # without PATH in the listing, the index still tells which
+                # snapshots the filesystem has copies of, but not the
+                # names in PATH
+                existing = _snapshots(Path(path), catalog,
+                                      _directory_index(path, indexes))
+            if send_index is None or index is None:
+                chain = [(snapshot, parent, ()) for snapshot, parent
+                         in _send_chain(snapshots, existing)]
+            else:
+                chain = _uuid_send_chain(snapshots, existing, subvolumes,
+                                         index)
+            chains[path] = collections.deque(chain)
+        for (snapshot, parent, clones), paths in _fan_out(chains):
+            errors = transfer(snapshot, parent, clones, paths)
+            for path, error in errors.items():
+                # every later stream needs the one that failed as parent
+                chains[path].clear()
+                failures[path] = error
+
+    msg = []
+    for path in receive_paths:
+        destination = transport.describe(path)
+        if sent[path]:
+            msg.append('{} snapshots copied from \'{}\' to \'{}\''.format(
+                sent[path], send.path, destination))
+        elif path not in failures:
+            msg.append('No new snapshots to copy from \'{}\' to \'{}\''
+                       .format(send.path, destination))
+    msg.extend(transfers)
+    for path, error in failures.items():
+        msg.append('Failed to copy to \'{}\': {}'.format(
+            transport.describe(path), error))
+    if failures:
+        raise BtrfsError('\n'.join(msg))
+    return '\n'.join(msg)
 
-    send_set = set(send.snapshots())
-    receive_set = set(receive.snapshots())
-    diff = send_set - receive_set
-    diff = list(diff)
-    diff.sort()
-    union = send_set & receive_set
-    union = list(union)
-    union.sort()
 
-    number_sent = len(diff)
+def _fan_out(chains):
+    '''
+    Merge the send chains of several destinations.
 
-    if diff:
-        if (union) and (union[-1] < diff[0]):
-            parent, snapshot = union[-1], diff[0]
-        else:
-            parent, snapshot = None, diff[0]
-
-        p1 = send_btr.send(snapshot, parent)
-        receive_btr.receive(p1)
-        while diff:
-            if len(diff) >= 2:
-                parent, snapshot = diff.pop(0), diff[0]
-                p1 = send_btr.send(snapshot, parent)
-                receive_btr.receive(p1)
-            else:
-                diff.pop(0)
-        msg = '{} snapshots copied from \'{}\' to \'{}\''.format(
-            number_sent, send.path, receive.path)
+    Args:
+        * chains (dict): deque of (snapshot, parent, clones) for each
+          destination, see :func:`_uuid_send_chain`. Consumed as the
+          generator advances, and may be cleared in between to stop sending
+          to a destination.
+
+    Yields:
+        * tuple: ((snapshot, parent, clones), list of destinations) oldest
+          snapshot first. Destinations that need the same snapshot against
+          the same parent and clone sources are grouped.
+    '''
+    while True:
+        heads = [(path, chain[0]) for path, chain in chains.items() if chain]
+        if not heads:
+            return
+        head = min((pair for _, pair in heads),
+                   key=lambda pair: snapshot_key(pair[0]))
+        paths = [path for path, pair in heads if pair == head]
+        yield head, paths
+        for path in paths:
+            if chains[path]:
+                chains[path].popleft()
+
+
+def _send_chain(sent, received):
+    '''
+    Work out which snapshots to send, and the parent of each incremental
+    stream. The first new snapshot is sent against the newest snapshot
+    both sides have, if that is older, and every following one against the
+    snapshot sent before it.
+
+    Args:
+        * sent (list(str)): snapshots on the sending side.
+        * received (list(str)): snapshots already on the receiving side.
+
+    Returns:
+        * list(tuple): (snapshot, parent) in the order they must be sent.
+          parent is None for a full stream.
+    '''
+    received = set(received)
+    diff = sorted(set(sent) - received, key=snapshot_key)
+    union = sorted(received.intersection(sent), key=snapshot_key)
+    if not diff:
+        return []
+    if union and snapshot_key(union[-1]) < snapshot_key(diff[0]):
+        parent = union[-1]
     else:
-        msg = 'No new snapshots to copy from \'{}\' to \'{}\''.format(
-            send.path, receive.path)
-    return msg
+        parent = None
+    chain = []
+    for snapshot in diff:
+        chain.append((snapshot, parent))
+        parent = snapshot
+    return chain
+
+
+def _uuid_send_chain(sent, received, subvolumes, index):
+    '''
+    Work out which snapshots to send like :func:`_send_chain`, but pick
+    parents by what the receiving filesystem really holds: any snapshot it
+    has a received copy of, whatever the copy is called, is a valid parent.
+    Each stream is sent against the nearest older such snapshot, or the
+    nearest newer one if there is none, and the nearest ones on either side
+    besides the parent are passed as clone sources.
+
+    Args:
+        * sent (list(str)): snapshots on the sending side.
+        * received (list(str)): snapshots already on the receiving side.
+        * subvolumes (dict): :class:`Subvolume` of each snapshot in SENT,
+          None where unknown.
+        * index (SubvolumeIndex): the receiving filesystem.
+
+    Returns:
+        * list(tuple): (snapshot, parent, clones) in the order they must be
+          sent. parent is None for a full stream, clones a tuple of at most
+          two snapshots.
+    '''
+    diff = sorted(set(sent) - set(received), key=snapshot_key)
+    copies = sorted((snapshot for snapshot in sent
+                     if subvolumes.get(snapshot) is not None and
+                     index.has_copy(subvolumes[snapshot])),
+                    key=snapshot_key)
+    keys = [snapshot_key(snapshot) for snapshot in copies]
+    chain = []
+    for snapshot in diff:
+        key = snapshot_key(snapshot)
+        at = bisect.bisect_left(keys, key)
+        if copies[at:at + 1] == [snapshot]:
+            # a copy under another name, send it anyway but not against
+            # itself
+            del copies[at], keys[at]
+        older = copies[max(at - 2, 0):at]
+        newer = copies[at:at + 1]
+        if older:
+            parent = older.pop()
+        elif newer:
+            parent = newer.pop()
+        else:
+            parent = None
+        clones = tuple(newer + older)
+        chain.append((snapshot, parent, clones))
+        # sent snapshots are copies by the time the next one goes
+        keys.insert(at, key)
+        copies.insert(at, snapshot)
+    return chain
+
 
+def send_to_dir(send_path, archive_path, catalog=None, dedup=False,
+                compress=None):
+    '''
+    Write the send stream of every snapshot in SEND_PATH that is not yet
+    in ARCHIVE_PATH to a file, see :class:`StreamArchive`. The archive can
+    be on any filesystem and is replayed with :func:`restore`.
+
+    Args:
+        * send_path (str): snapshot directory to send from.
+        * archive_path (str): directory to write stream files to.
+        * catalog (Catalog): list snapshots from, and record archived
+          snapshots in, this catalog.
+        * dedup (bool): store the streams in a :class:`chunks.ChunkStore`.
+        * compress (tuple): (codec, level) to compress the stream files
+          with, see :func:`compression.parse`.
+
+    Returns:
+        * (str): results
+    '''
+    send = SnapPath(send_path, catalog)
+    archive = StreamArchive(archive_path, dedup=dedup, compress=compress)
+    send_btr = Btrfs(send.path)
+    transfers = []
+
+    with archive.lock():
+        chain = _send_chain(_snapshots(send, catalog), archive.snapshots())
+        for snapshot, parent in chain:
+            relay = archive.write(send_btr.send(snapshot, parent), snapshot,
+                                  parent)
+            transfers.append('\t{}: {}'.format(snapshot, relay))
+            if catalog is not None:
+                catalog.add_replica(send.path, snapshot, archive.path)
+    if chain:
+        msg = '{} snapshots written from \'{}\' to \'{}\''.format(
+            len(chain), send.path, archive.path)
+        return '\n'.join([msg] + transfers)
+    return 'No new snapshots to write from \'{}\' to \'{}\''.format(
+        send.path, archive.path)
+
+
+def restore(archive_path, receive_path, catalog=None):
+    '''
+    Replay the streams of a :class:`StreamArchive` into btrfs receive, in
+    the order they were written. Snapshots already in RECEIVE_PATH are
+    skipped.
+
+    Args:
+        * archive_path (str): directory written by :func:`send_to_dir`.
+        * receive_path (str): path to receive snapshots in.
+        * catalog (Catalog): list snapshots from, and record received
+          snapshots in, this catalog.
+
+    Returns:
+        * (str): results
 
-def send_receive_deep(send_path, receive_path):
+    Raises:
+        * BtrsnapError: a stream file is missing or truncated, or the
+          parent of an incremental stream is not in RECEIVE_PATH.
+    '''
+    archive = StreamArchive(archive_path)
+    receive = Path(receive_path)
+    receive_btr = Btrfs(receive.path)
+    present = set(_snapshots(receive, catalog))
+    transfers = []
+
+    for entry in archive.entries():
+        if entry.snapshot in present:
+            continue
+        if entry.parent is not None and entry.parent not in present:
+            raise BtrsnapError('cannot restore {}: its parent {} is not in'
+                               ' \'{}\''.format(entry.snapshot, entry.parent,
+                                                receive.path))
+        with archive.stream(entry) as source:
+            relay = receive_btr.receive_from(source)
+        present.add(entry.snapshot)
+        transfers.append('\t{}: {}'.format(entry.snapshot, relay))
+        if catalog is not None:
+            catalog.add(receive.path, entry.snapshot, parent=entry.parent)
+    if transfers:
+        msg = '{} snapshots restored from \'{}\' to \'{}\''.format(
+            len(transfers), archive.path, receive.path)
+        return '\n'.join([msg] + transfers)
+    return 'No snapshots to restore from \'{}\' to \'{}\''.format(
+        archive.path, receive.path)
+
+
+def send_receive_deep(send_path, receive_path, catalog=None, jobs=1,
+                      transport=None, bwlimit=None):
     '''
     Send all snapshots in subdirectories of send_path to receive_path.
+    Snapshots of one subdirectory are always sent in order, as each one is
+    the incremental parent of the next, but up to JOBS subdirectories are
+    sent at the same time.
 
     Args:
         * send_path (str): absolute path holding one or more snapshot
                          directories.
-        * receive_path (str): absolute path to receive snapshot directories in.
+        * receive_path (str or list(str)): absolute path, or paths, to
+          receive snapshot directories in, see :func:`send_receive`.
+        * catalog (Catalog): see :func:`send_receive`
+        * jobs (int): maximum number of subdirectories sent at the same time.
+        * transport (Transport): see :func:`send_receive`. A connection the
+          transport keeps open is shared by all subdirectories.
+        * bwlimit (TokenBucket): see :func:`send_receive`. The limit is
+          shared by all subdirectories sent at the same time.
 
     Returns:
         * (str): results.
     '''
-    snap_deep = Path(send_path)
-    snappaths = snap_deep.sub_snap_paths_list()
-    snappaths = [snappath.path for snappath in snappaths]
-    receive_path = Path(receive_path)
-    receive_path = receive_path.path
-    receive_paths = [os.path.join(receive_path, s.split(os.path.sep)[-1]) for
-                     s in snappaths]
-    msg = []
+    snappaths = Path(send_path).sub_snap_paths_list(catalog)
+    # list each filesystem once for all subdirectories
+    indexes = {}
+    if transport is None:
+        return _transfer_deep(send_receive, [s.path for s in snappaths],
+                              receive_path, catalog, jobs, bwlimit=bwlimit,
+                              indexes=indexes)
+    with transport:
+        return _transfer_deep(send_receive, [s.path for s in snappaths],
+                              receive_path, catalog, jobs,
+                              transport=transport, bwlimit=bwlimit,
+                              indexes=indexes)
+
+
+def send_to_dir_deep(send_path, archive_path, catalog=None, jobs=1,
+                     dedup=False, compress=None):
+    '''
+    Archive each snapshot directory below SEND_PATH in a subdirectory of
+    the same name in ARCHIVE_PATH, see :func:`send_to_dir`.
+
+    Args:
+        * send_path (str): absolute path holding one or more snapshot
+                         directories.
+        * archive_path (str): directory to create the archives in.
+        * catalog (Catalog): see :func:`send_to_dir`
+        * jobs (int): maximum number of subdirectories written at the same
+          time.
+        * dedup (bool): see :func:`send_to_dir`. Each subdirectory gets a
+          chunk store of its own.
+        * compress (tuple): see :func:`send_to_dir`.
+
+    Returns:
+        * (str): results.
+    '''
+    snappaths = Path(send_path).sub_snap_paths_list(catalog)
+    return _transfer_deep(send_to_dir, [s.path for s in snappaths],
+                          archive_path, catalog, jobs, dedup=dedup,
+                          compress=compress)
+
+
+def restore_deep(archive_path, receive_path, catalog=None, jobs=1):
+    '''
+    Restore every archive written by :func:`send_to_dir_deep` into a
+    subdirectory of the same name in RECEIVE_PATH, see :func:`restore`.
+
+    Args:
+        * archive_path (str): directory holding one archive per
+          subdirectory.
+        * receive_path (str): absolute path to receive snapshot directories
+          in.
+        * catalog (Catalog): see :func:`restore`
+        * jobs (int): maximum number of subdirectories restored at the same
+          time.
+
+    Returns:
+        * (str): results.
+    '''
+    archives = [p for p in Path(archive_path).sub_paths_list()
+                if os.path.isfile(StreamArchive(p.path).manifest)]
+    return _transfer_deep(restore, [a.path for a in archives],
+                          receive_path, catalog, jobs)
 
-    for p in receive_paths:
-        if not os.path.isdir(p):
-            os.mkdir(p)
 
-    args = zip(snappaths, receive_paths)
-    for send_path, receive_path in args:
-        msg.append(send_receive(send_path, receive_path))
+def _transfer_deep(func, sources, destination, catalog, jobs, transport=None,
+                   **kwargs):
+    '''
+    Call FUNC(source, destination/<name of source>, catalog=CATALOG,
+    **KWARGS) for each of SOURCES, creating the destination subdirectories
+    as needed. Errors are reported per source. With a remote TRANSPORT,
+    DESTINATION is on the receiving side and TRANSPORT is passed on to
+    FUNC. DESTINATION may be a list, FUNC is then given a list too.
+    '''
+    sources = sorted(sources)
+    msg = []
+    fan_out = not isinstance(destination, str)
+    roots = list(destination) if fan_out else [destination]
+
+    if transport is not None and transport.remote:
+        targets = [[posixpath.join(root, os.path.basename(s))
+                    for root in roots] for s in sources]
+        transport.makedirs([p for paths in targets for p in paths])
+        kwargs['transport'] = transport
+    else:
+        roots = [Path(root).path for root in roots]
+        targets = [[os.path.join(root, os.path.basename(s))
+                    for root in roots] for s in sources]
+        for paths in targets:
+            for p in paths:
+                if not os.path.isdir(p):
+                    os.mkdir(p)
+    destinations = [paths if fan_out else paths[0] for paths in targets]
+
+    def worker(paths):
+        return func(paths[0], paths[1], catalog=catalog, **kwargs)
+
+    args = list(zip(sources, destinations))
+    for paths, result, error in _run_parallel(worker, args, jobs=jobs):
+        if error is not None:
+            msg.append('Error: \'{}\': {}'.format(paths[0], error))
+        else:
+            msg.append(result)
     return '\n'.join(msg)
 
 
@@ -557,18 +2101,87 @@ def main():
     '''
     Command Line Interface.
     '''
+    parser = _parser(_subcommand(sys.argv[1:]))
+    args = parser.parse_args()
+
+    if args.catalog:
+        try:
+            args.catalog = Catalog(args.catalog)
+        except BtrsnapError as err:
+            parser.error(str(err))
+
+    try:
+        args.func(args)
+    except AttributeError:
+        parser.parse_args([''])
+
+
+def _subcommand(argv):
+    '''
+    Args:
+        * argv (list(str)): command line arguments without the program name.
+
+    Returns:
+        * str: the first argument that is not an option of the main parser,
+          which names the subcommand, or None.
+    '''
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument == '--catalog':
+            # its value
+            next(arguments, None)
+        elif not argument.startswith('-'):
+            return argument
+    return None
+
+
+def _parser(command=None):
+    '''
+    Build the command line parser. Each subcommand sets ``func`` in the
+    parsed arguments, which runs it and prints the results to
+    ``args.output``, standard output by default. ``args.failed`` is set if
+    it raised an error.
 
+    Args:
+        * command (str): only build the parser of this subcommand, see
+          :func:`_subcommand`. All of them are built if it is None or not
+          a subcommand, so the help lists them all.
+
+    Returns:
+        * argparse.ArgumentParser
+    '''
     import argparse
 
-    from . import argparse_types
+    try:
+        from . import argparse_types
+    except ImportError:
+        import argparse_types
 
-    def caller(func, *args, **kargs):
+    def caller(args, func, *fargs, **kargs):
         try:
-            msg = func(*args, **kargs)
+            msg = func(*fargs, **kargs)
             if msg:
-                print(msg)
+                print(msg, file=args.output)
         except Exception as err:
-            print('Error:', err)
+            print('Error:', err, file=args.output)
+            args.failed = True
+
+    def retention_policy(args):
+        counts = dict((period, getattr(args, 'keep_' + period) or 0)
+                      for period in RetentionPolicy.periods)
+        if not any(counts.values()):
+            return None
+        return RetentionPolicy(**counts)
+
+    def add_policy_arguments(subparser, description):
+        group = subparser.add_argument_group('Retention policy', description)
+        for period in RetentionPolicy.periods:
+            group.add_argument('--keep-' + period,
+                               type=argparse_types.positive_int,
+                               metavar='N',
+                               help='keep the newest snapshot of each of'
+                               ' the last N {} periods'.format(period)
+                               )
 
     def run_snap(args):
         keep = None
@@ -577,42 +2190,167 @@ def main():
             keep = args.keep[0]
         if (args.date):
             date = args.date[0]
+        policy = retention_policy(args)
+        prune = (keep is not None) or (date is not None) or policy
         if not args.recursive:
-            caller(snap, args.snap_path[0])
-            if (keep is not None) or (date is not None):
-                caller(unsnap, args.snap_path[0], keep=keep, date=date)
+            caller(args, snap, args.snap_path[0], catalog=args.catalog,
+                   precise=args.precise, if_changed=args.if_changed)
+            if prune:
+                caller(args, unsnap, args.snap_path[0], keep=keep,
+                       date=date, commit=args.commit, catalog=args.catalog,
+                       policy=policy)
         if args.recursive:
-            caller(snap_deep, args.snap_path[0])
-            if (keep is not None) or (date is not None):
-                caller(unsnap_deep, args.snap_path[0], keep=keep, date=date)
+            caller(args, snap_deep, args.snap_path[0], jobs=args.jobs,
+                   catalog=args.catalog, precise=args.precise,
+                   if_changed=args.if_changed)
+            if prune:
+                caller(args, unsnap_deep, args.snap_path[0], keep=keep,
+                       date=date, commit=args.commit, catalog=args.catalog,
+                       policy=policy)
 
     def run_list(args):
         if not args.recursive:
-            caller(show_snaps, args.snap_path[0])
+            caller(args, show_snaps, args.snap_path[0], catalog=args.catalog)
         else:
-            caller(show_snaps_deep, args.snap_path[0])
+            caller(args, show_snaps_deep, args.snap_path[0],
+                   catalog=args.catalog)
 
     def run_send(args):
+        receive_path = args.receive_path
+        if len(receive_path) == 1:
+            receive_path = receive_path[0]
+        if args.to_dir:
+            if len(args.receive_path) > 1:
+                parser.error('--to-dir takes a single directory')
+            if args.transport or args.bwlimit or args.burst:
+                parser.error('--transport, --bwlimit and --burst cannot be'
+                             ' used with --to-dir')
+            if args.dedup and args.compress:
+                parser.error('--compress cannot be used with --dedup, the'
+                             ' chunks are compressed already')
+            if args.recursive:
+                caller(args, send_to_dir_deep, args.send_path[0],
+                       args.receive_path[0], catalog=args.catalog,
+                       jobs=args.jobs, dedup=args.dedup,
+                       compress=args.compress)
+            else:
+                caller(args, send_to_dir, args.send_path[0],
+                       args.receive_path[0], catalog=args.catalog,
+                       dedup=args.dedup, compress=args.compress)
+            return
+        if args.dedup:
+            parser.error('--dedup requires --to-dir')
+        if args.compress and not args.transport:
+            parser.error('--compress requires --to-dir or --transport')
+
+        try:
+            transport = transport_for(args.transport, args.compress)
+        except (ValueError, TransportError) as err:
+            parser.error('argument --transport: {}'.format(err))
+
+        bwlimit = None
+        if args.bwlimit:
+            bwlimit = TokenBucket(BandwidthSchedule.parse(args.bwlimit),
+                                  burst=args.burst)
+        elif args.burst:
+            parser.error('--burst requires --bwlimit')
+
         if not args.recursive:
-            caller(send_receive, args.send_path[0], args.receive_path[0])
+            caller(args, send_receive, args.send_path[0], receive_path,
+                   catalog=args.catalog, transport=transport, bwlimit=bwlimit)
+
+        if args.recursive:
+            caller(args, send_receive_deep, args.send_path[0], receive_path,
+                   catalog=args.catalog, jobs=args.jobs, transport=transport,
+                   bwlimit=bwlimit)
 
+    def run_restore(args):
         if args.recursive:
-            caller(send_receive_deep, args.send_path[0], args.receive_path[0])
+            caller(args, restore_deep, args.archive_path[0],
+                   args.receive_path[0], catalog=args.catalog, jobs=args.jobs)
+        else:
+            caller(args, restore, args.archive_path[0], args.receive_path[0],
+                   catalog=args.catalog)
 
     def run_delete(args):
+        # make sure that one of the mutually_exclusive arguments is supplied
+        if ((not args.date) and (not args.keep)
+                and not retention_policy(args)
+                and args.free_target is None):
+            parser.error('you must supply either --keep, --date,'
+                         ' --free-target or a retention policy')
         keep = None
         date = None
         if args.keep:
             keep = args.keep[0]
         if args.date:
             date = args.date[0]
+        policy = retention_policy(args)
         if args.recursive:
-            caller(unsnap_deep, args.snap_path[0], keep=keep, date=date)
+            caller(args, unsnap_deep, args.snap_path[0], keep=keep, date=date,
+                   commit=args.commit, catalog=args.catalog, policy=policy,
+                   free=args.free_target)
         else:
-            caller(unsnap, args.snap_path[0], keep=keep, date=date)
+            caller(args, unsnap, args.snap_path[0], keep=keep, date=date,
+                   commit=args.commit, catalog=args.catalog, policy=policy,
+                   free=args.free_target)
 
-    def no_subparser(args):
-        parser.parse_args([''])
+    def run_filter(stage):
+        # stdout carries the stream, so errors go to stderr
+        try:
+            stage.run()
+        except Exception as err:
+            print('Error:', err, file=sys.stderr)
+            sys.exit(1)
+
+    def run_compress(args):
+        run_filter(compression.Compressor(sys.stdin.fileno(),
+                                          sys.stdout.fileno(),
+                                          codec=args.codec, level=args.level,
+                                          jobs=args.jobs))
+
+    def run_decompress(args):
+        run_filter(compression.Decompressor(sys.stdin.fileno(),
+                                            sys.stdout.fileno(),
+                                            jobs=args.jobs))
+
+    def import_daemon():
+        try:
+            from . import daemon
+        except ImportError:
+            import daemon
+        return daemon
+
+    def run_daemon(args):
+        daemon = import_daemon()
+        caller(args, daemon.run, args.schedule[0], max_jobs=args.jobs,
+               catalog=args.catalog, control=args.socket)
+
+    def run_status(args):
+        daemon = import_daemon()
+        if args.path and not args.trigger:
+            parser.error('--path needs --trigger')
+        caller(args, daemon.control, args.socket[0], command=args.trigger,
+               snap_path=args.path)
+
+    def bwlimit_spec(string):
+        try:
+            BandwidthSchedule.parse([string])
+        except BtrsnapError as err:
+            raise argparse.ArgumentTypeError(err)
+        return string
+
+    def size(string):
+        try:
+            return parse_size(string)
+        except BtrsnapError as err:
+            raise argparse.ArgumentTypeError(err)
+
+    def compress_spec(string):
+        try:
+            return compression.parse(string)
+        except BtrsnapError as err:
+            raise argparse.ArgumentTypeError(err)
 
     parser = argparse.ArgumentParser(
         prog='btrsnap',
@@ -652,151 +2390,459 @@ def main():
     parser.add_argument('--version', action='version',
                         version='%(prog)s 2.0.0'
                         )
+    parser.add_argument('--catalog',
+                        metavar='FILE',
+                        help='keep track of snapshots in an SQLite catalog'
+                        ' stored in FILE, which is created if needed. Speeds'
+                        ' up listing large snapshot trees'
+                        )
     subparsers = parser.add_subparsers(title='sub-commands')
 
-    subparser_snap = subparsers.add_parser('snap',
-                                           description='Creates a new'
-                                           ' timestamped BTRFS snapshot'
-                                           ' inside of PATH. The snapshot will'
-                                           ' be a snapshot of the BTRFS'
-                                           ' subvolume pointed to by the'
-                                           ' symbolic link in PATH.',
-                                           help='creates new timestamped BTRFS'
-                                           ' snapshot'
-                                           )
-    subparser_snap.add_argument('-r', '--recursive',
-                                action='store_true',
-                                help='instead, create a snapshot inside of'
-                                ' each directory located inside of PATH'
-                                )
-    subparser_snap.add_argument('snap_path',
-                                nargs=1,
-                                metavar='PATH',
-                                help='a directory on a BTRFS file system with'
-                                ' a symlink pointing to a BTRFS subvolume'
-                                )
-    group_snap = subparser_snap.add_argument_group('Mutually Exclusive',
-                                                   '(Optional) - Choose 1')
-    mutually_exclusive_snap = group_snap.add_mutually_exclusive_group()
-    mutually_exclusive_snap.add_argument('-k', '--keep',
-                                         nargs=1,
-                                         type=int,
-                                         metavar='N',
-                                         help='after creating, delete all'
-                                         ' but N snapshots'
-                                         )
-    mutually_exclusive_snap.add_argument('-d', '--date',
-                                         nargs=1,
-                                         type=argparse_types.date_parser,
-                                         metavar='YYYY-MM-DD or ?y?m?d?w',
-                                         help='after creating, delete all'
-                                         ' snapshots created on or before the'
-                                         ' entered date. You may enter dates'
-                                         ' as ISO format or use the alternate'
-                                         ' syntax ?y?m?d?w where ? can be'
-                                         ' any positive intager and indicates'
-                                         ' the number of years, months, days,'
-                                         ' and weeks respectively',
-                                         )
-    subparser_snap.set_defaults(func=run_snap)
-
-    subparser_list = subparsers.add_parser('list',
-                                           description='Show timestamped'
-                                           ' snapshots in PATH.',
-                                           help='show timestamped snapshots'
-                                           )
-    subparser_list.add_argument('snap_path',
-                                nargs=1,
-                                metavar='PATH',
-                                help='a directory on a BTRFS filesystem'
-                                ' that contains snapshots created by btrsnap.'
-                                )
-    subparser_list.add_argument('-r', '--recursive',
-                                action='store_true',
-                                help='instead, show summary statistics for all'
-                                ' subdirectories in PATH'
-                                )
-    subparser_list.set_defaults(func=run_list)
-
-    subparser_delete = subparsers.add_parser('delete',
-                                             description='Delete all but KEEP'
-                                             ' snapshots from PATH, or delete'
-                                             ' all snapshots created on or'
-                                             ' or before DATE',
-                                             help='delete snapshots'
+    def add_snap():
+        subparser_snap = subparsers.add_parser('snap',
+                                               description='Creates a new'
+                                               ' timestamped BTRFS snapshot'
+                                               ' inside of PATH. The snapshot'
+                                               ' will be a snapshot of the'
+                                               ' BTRFS subvolume pointed to'
+                                               ' by the symbolic link in'
+                                               ' PATH.',
+                                               help='creates new timestamped'
+                                               ' BTRFS snapshot'
+                                               )
+        subparser_snap.add_argument('-r', '--recursive',
+                                    action='store_true',
+                                    help='instead, create a snapshot inside of'
+                                    ' each directory located inside of PATH'
+                                    )
+        subparser_snap.add_argument('-j', '--jobs',
+                                    type=argparse_types.positive_int,
+                                    default=1,
+                                    metavar='N',
+                                    help='with --recursive, create up to N'
+                                    ' snapshots at the same time'
+                                    )
+        subparser_snap.add_argument('snap_path',
+                                    nargs=1,
+                                    metavar='PATH',
+                                    help='a directory on a BTRFS file system'
+                                    ' with a symlink pointing to a BTRFS'
+                                    ' subvolume'
+                                    )
+        group_snap = subparser_snap.add_argument_group('Mutually Exclusive',
+                                                       '(Optional) - Choose 1')
+        mutually_exclusive_snap = group_snap.add_mutually_exclusive_group()
+        mutually_exclusive_snap.add_argument('-k', '--keep',
+                                             nargs=1,
+                                             type=int,
+                                             metavar='N',
+                                             help='after creating, delete all'
+                                             ' but N snapshots'
                                              )
-    subparser_delete.add_argument('-r', '--recursive',
-                                  action='store_true',
-                                  help='instead delete all but KEEP snapshots'
-                                  ' from each subdirectory')
-    subparser_delete.add_argument('snap_path',
-                                  nargs=1,
-                                  metavar='PATH',
-                                  help='a directory on a BTRFS filesystem'
-                                  ' that contains snapshots created by'
-                                  ' btrsnap'
-                                  )
-    group = subparser_delete.add_argument_group('Mutually Exclusive',
-                                                '(Required) - Choose 1')
-    mutually_exclusive = group.add_mutually_exclusive_group()
-    mutually_exclusive.add_argument('-k', '--keep',
-                                  nargs=1,
-                                  type=int,
-                                  metavar='N',
-                                  help='keep N snapshots when deleting',
-                                  )
-    mutually_exclusive.add_argument('-d', '--date',
-                                  nargs=1,
-                                  type=argparse_types.date_parser,
-                                  metavar='YYYY-MM-DD or ?y?m?d?w',
-                                  help='delete all snapshots created on or'
-                                  ' before the entered date. You may enter '
-                                  ' dates as ISO format or use the'
-                                  ' alternate syntax ?y?m?d?w where ? can be'
-                                  ' any positive intager and indicates the'
-                                  ' number of years, months, days, and weeks'
-                                  ' respectively',
-                                  )
-    subparser_delete.set_defaults(func=run_delete)
-
-    subparser_send = subparsers.add_parser('send',
-                                           description='Send all snapshots'
-                                           ' from SendPATH to ReceivePATH if'
-                                           ' not present.',
-                                           help='uses BTRFS send/receive to'
-                                           ' smartly send snapshots from one'
-                                           ' BTRFS filesystem to another'
-                                           )
-    subparser_send.add_argument('-r', '--recursive',
-                                action='store_true',
-                                help='instead, send snapshots from each sub'
-                                ' directory of SendPATH to a subdirectory of'
-                                ' the same name in ReceivePATH. Subdirectories'
-                                ' are automatically created if needed'
-                                )
-    subparser_send.add_argument('send_path',
-                                nargs=1,
-                                metavar='SendPATH',
-                                help='a directory on a BTRFS filesystem that'
-                                ' contains snapshots created by btrsnap')
-    subparser_send.add_argument('receive_path',
-                                nargs=1,
-                                metavar='ReceivePATH',
-                                help='a directory on a BTRFS filesystem that'
-                                ' will receive snapshots')
-    subparser_send.set_defaults(func=run_send)
-
-    args = parser.parse_args()
-
-    # make sure that one of the mutually_exclusive arguments is supplied
-    if hasattr(args, 'func') and (args.func is run_delete):
-        if (not args.date) and (not args.keep):
-            parser.error('you must supply either --keep or --date')
+        mutually_exclusive_snap.add_argument('-d', '--date',
+                                             nargs=1,
+                                             type=argparse_types.date_parser,
+                                             metavar='YYYY-MM-DD or ?y?m?d?w',
+                                             help='after creating, delete all'
+                                             ' snapshots created on or before'
+                                             ' the entered date. You may'
+                                             ' enter dates as ISO format or'
+                                             ' use the alternate syntax'
+                                             ' ?y?m?d?w where ? can be any'
+                                             ' positive intager and indicates'
+                                             ' the number of years, months,'
+                                             ' days, and weeks respectively',
+                                             )
+        subparser_snap.add_argument('-p', '--precise',
+                                    action='store_true',
+                                    help='name the snapshot'
+                                    ' YYYY-MM-DD-HHMMSS-ffff instead of'
+                                    ' YYYY-MM-DD-####, allowing many'
+                                    ' snapshots a second. Used anyway on a'
+                                    ' day that already has such a snapshot'
+                                    )
+        subparser_snap.add_argument('--if-changed',
+                                    action='store_true',
+                                    help='do not create a snapshot of a'
+                                    ' subvolume that has not been written to'
+                                    ' since its newest snapshot. Needs root'
+                                    ' permissions'
+                                    )
+        subparser_snap.add_argument('--commit',
+                                    choices=['after', 'each'],
+                                    help='when deleting, wait until the'
+                                    ' deletion is committed after the last'
+                                    ' snapshot or after each snapshot'
+                                    )
+        add_policy_arguments(subparser_snap, '(Optional) - after creating,'
+                             ' delete all snapshots not kept by these rules')
+        subparser_snap.set_defaults(func=run_snap)
+
+    def add_list():
+        subparser_list = subparsers.add_parser('list',
+                                               description='Show timestamped'
+                                               ' snapshots in PATH.',
+                                               help='show timestamped'
+                                               ' snapshots'
+                                               )
+        subparser_list.add_argument('snap_path',
+                                    nargs=1,
+                                    metavar='PATH',
+                                    help='a directory on a BTRFS filesystem'
+                                    ' that contains snapshots created by'
+                                    ' btrsnap.'
+                                    )
+        subparser_list.add_argument('-r', '--recursive',
+                                    action='store_true',
+                                    help='instead, show summary statistics'
+                                    ' for all subdirectories in PATH'
+                                    )
+        subparser_list.set_defaults(func=run_list)
+
+    def add_delete():
+        subparser_delete = subparsers.add_parser('delete',
+                                                 description='Delete all but'
+                                                 ' KEEP snapshots from PATH,'
+                                                 ' or delete all snapshots'
+                                                 ' created on or or before'
+                                                 ' DATE',
+                                                 help='delete snapshots'
+                                                 )
+        subparser_delete.add_argument('-r', '--recursive',
+                                      action='store_true',
+                                      help='instead delete all but KEEP'
+                                      ' snapshots'
+                                      ' from each subdirectory')
+        subparser_delete.add_argument('snap_path',
+                                      nargs=1,
+                                      metavar='PATH',
+                                      help='a directory on a BTRFS filesystem'
+                                      ' that contains snapshots created by'
+                                      ' btrsnap'
+                                      )
+        group = subparser_delete.add_argument_group('Mutually Exclusive',
+                                                    '(Required) - Choose 1')
+        mutually_exclusive = group.add_mutually_exclusive_group()
+        mutually_exclusive.add_argument('-k', '--keep',
+                                        nargs=1,
+                                        type=int,
+                                        metavar='N',
+                                        help='keep N snapshots when deleting',
+                                        )
+        mutually_exclusive.add_argument('-d', '--date',
+                                        nargs=1,
+                                        type=argparse_types.date_parser,
+                                        metavar='YYYY-MM-DD or ?y?m?d?w',
+                                        help='delete all snapshots created on'
+                                        ' or before the entered date. You may'
+                                        ' enter  dates as ISO format or use'
+                                        ' the alternate syntax ?y?m?d?w where'
+                                        ' ? can be any positive intager and'
+                                        ' indicates the number of years,'
+                                        ' months, days, and weeks'
+                                        ' respectively',
+                                        )
+        subparser_delete.add_argument('--commit',
+                                      choices=['after', 'each'],
+                                      help='wait until the deletion is'
+                                      ' committed after the last snapshot or'
+                                      ' after each snapshot'
+                                      )
+        add_policy_arguments(subparser_delete, 'Instead of, or as well as,'
+                             ' --keep or --date: delete all snapshots not kept'
+                             ' by these rules')
+        subparser_delete.add_argument('--free-target',
+                                      type=argparse_types.percentage,
+                                      metavar='N%',
+                                      help='instead of, or as well as, the'
+                                      ' options above: delete the oldest'
+                                      ' snapshots, across all subdirectories'
+                                      ' with --recursive, until N%% of the'
+                                      ' filesystem is free. The newest'
+                                      ' snapshot in each directory is always'
+                                      ' kept'
+                                      )
+        subparser_delete.set_defaults(func=run_delete)
+
+    def add_send():
+        subparser_send = subparsers.add_parser('send',
+                                               description='Send all'
+                                               ' snapshots from SendPATH to'
+                                               ' ReceivePATH if not present.',
+                                               help='uses BTRFS send/receive'
+                                               ' to smartly send snapshots'
+                                               ' from one BTRFS filesystem to'
+                                               ' another'
+                                               )
+        subparser_send.add_argument('-r', '--recursive',
+                                    action='store_true',
+                                    help='instead, send snapshots from each'
+                                    ' sub directory of SendPATH to a'
+                                    ' subdirectory of the same name in'
+                                    ' ReceivePATH. Subdirectories are'
+                                    ' automatically created if needed'
+                                    )
+        subparser_send.add_argument('-j', '--jobs',
+                                    type=argparse_types.positive_int,
+                                    default=1,
+                                    metavar='N',
+                                    help='with --recursive, send up to N'
+                                    ' subdirectories at the same time'
+                                    )
+        subparser_send.add_argument('--to-dir',
+                                    action='store_true',
+                                    help='instead of receiving the snapshots,'
+                                    ' write their send streams to files in'
+                                    ' ReceivePATH, which may be on any'
+                                    ' filesystem. Restore them with btrsnap'
+                                    ' restore'
+                                    )
+        subparser_send.add_argument('--transport',
+                                    metavar='CMD',
+                                    help='run btrfs receive, and list'
+                                    ' ReceivePATH, through the command prefix'
+                                    ' CMD, for example "ssh'
+                                    ' backup.example.com". ReceivePATH is'
+                                    ' then a path on the far side. One ssh'
+                                    ' connection is reused for everything'
+                                    ' sent'
+                                    )
+        subparser_send.add_argument('--bwlimit',
+                                    action='append',
+                                    type=bwlimit_spec,
+                                    metavar='RATE',
+                                    help='limit the transfer to RATE bytes'
+                                    ' per second, with an optional K, M, G or'
+                                    ' T suffix. Give HH:MM-HH:MM=RATE, more'
+                                    ' than once if needed, to set a different'
+                                    ' RATE, or off, during a time of day. A'
+                                    ' .bwlimit file in a snapshot directory,'
+                                    ' holding the same values one per line,'
+                                    ' overrides this for that directory'
+                                    )
+        subparser_send.add_argument('--burst',
+                                    type=size,
+                                    metavar='SIZE',
+                                    help='with --bwlimit, let up to SIZE bytes'
+                                    ' through at full speed after an idle'
+                                    ' period (default: one second worth)'
+                                    )
+        subparser_send.add_argument('--dedup',
+                                    action='store_true',
+                                    help='with --to-dir, split the streams'
+                                    ' into chunks and store each distinct'
+                                    ' chunk only once, compressed. Once used,'
+                                    ' the archive keeps storing streams this'
+                                    ' way'
+                                    )
+        subparser_send.add_argument('--compress',
+                                    type=compress_spec,
+                                    metavar='ALGO[:LEVEL]',
+                                    help='compress the streams with zlib, bz2'
+                                    ' or lzma, at LEVEL if given: the files'
+                                    ' written with --to-dir, or the streams'
+                                    ' sent with --transport, which are then'
+                                    ' decompressed by btrsnap decompress on'
+                                    ' the far side'
+                                    )
+        subparser_send.add_argument('send_path',
+                                    nargs=1,
+                                    metavar='SendPATH',
+                                    help='a directory on a BTRFS filesystem'
+                                    ' that'
+                                    ' contains snapshots created by btrsnap')
+        subparser_send.add_argument('receive_path',
+                                    nargs='+',
+                                    metavar='ReceivePATH',
+                                    help='a directory on a BTRFS filesystem'
+                                    ' that will receive snapshots. Give more'
+                                    ' than one to send each snapshot to all'
+                                    ' of them with'
+                                    ' a single btrfs send')
+        subparser_send.set_defaults(func=run_send)
+
+    def add_restore():
+        subparser_restore = subparsers.add_parser('restore',
+                                                  description='Replay the'
+                                                  ' streams written by send'
+                                                  ' --to-dir from ArchivePATH'
+                                                  ' into ReceivePATH, in'
+                                                  ' order. Snapshots already'
+                                                  ' in ReceivePATH are'
+                                                  ' skipped.',
+                                                  help='receive snapshots'
+                                                  ' from stream files written'
+                                                  ' by send --to-dir'
+                                                  )
+        subparser_restore.add_argument('-r', '--recursive',
+                                       action='store_true',
+                                       help='instead, restore each sub'
+                                       ' directory of ArchivePATH to a'
+                                       ' subdirectory of the same name in'
+                                       ' ReceivePATH. Subdirectories are'
+                                       ' automatically created if needed'
+                                       )
+        subparser_restore.add_argument('-j', '--jobs',
+                                       type=argparse_types.positive_int,
+                                       default=1,
+                                       metavar='N',
+                                       help='with --recursive, restore up to N'
+                                       ' subdirectories at the same time'
+                                       )
+        subparser_restore.add_argument('archive_path',
+                                       nargs=1,
+                                       metavar='ArchivePATH',
+                                       help='a directory written by btrsnap'
+                                       ' send'
+                                       ' --to-dir')
+        subparser_restore.add_argument('receive_path',
+                                       nargs=1,
+                                       metavar='ReceivePATH',
+                                       help='a directory on a BTRFS filesystem'
+                                       ' that will receive snapshots')
+        subparser_restore.set_defaults(func=run_restore)
+
+    def add_compress():
+        subparser_compress = subparsers.add_parser('compress',
+                                                   description='Compress a'
+                                                   ' btrfs send stream read'
+                                                   ' from standard input into'
+                                                   ' the btrsnap framed'
+                                                   ' format on standard'
+                                                   ' output. Chunks are'
+                                                   ' compressed in parallel.',
+                                                   help='compress a btrfs send'
+                                                   ' stream'
+                                                   )
+        subparser_compress.add_argument('-c', '--codec',
+                                        choices=list(compression.CODECS),
+                                        default='zlib',
+                                        help='compression codec (default:'
+                                        ' zlib)'
+                                        )
+        subparser_compress.add_argument('-l', '--level',
+                                        type=int,
+                                        metavar='N',
+                                        help='compression level, defaults to'
+                                        ' the codec\'s default'
+                                        )
+        subparser_compress.add_argument('-j', '--jobs',
+                                        type=argparse_types.positive_int,
+                                        default=os.cpu_count() or 1,
+                                        metavar='N',
+                                        help='compress up to N chunks at the'
+                                        ' same time (default: number of CPUs)'
+                                        )
+        subparser_compress.set_defaults(func=run_compress)
+
+    def add_decompress():
+        subparser_decompress = subparsers.add_parser('decompress',
+                                                     description='Decompress'
+                                                     ' a stream written by'
+                                                     ' btrsnap compress from'
+                                                     ' standard input to'
+                                                     ' standard output, for'
+                                                     ' example to pipe into'
+                                                     ' btrfs receive.',
+                                                     help='decompress a stream'
+                                                     ' written by btrsnap'
+                                                     ' compress'
+                                                     )
+        subparser_decompress.add_argument('-j', '--jobs',
+                                          type=argparse_types.positive_int,
+                                          default=os.cpu_count() or 1,
+                                          metavar='N',
+                                          help='decompress up to N chunks at'
+                                          ' the same time (default: number of'
+                                          ' CPUs)'
+                                          )
+        subparser_decompress.set_defaults(func=run_decompress)
+
+    def add_daemon():
+        subparser_daemon = subparsers.add_parser('daemon',
+                                                 description='Run the btrsnap'
+                                                 ' commands in SCHEDULE at'
+                                                 ' their intervals until'
+                                                 ' stopped. Directory'
+                                                 ' contents are kept in'
+                                                 ' memory between runs, and'
+                                                 ' two commands never work on'
+                                                 ' the same directory at'
+                                                 ' once.',
+                                                 help='run snap, delete and'
+                                                 ' send on a schedule'
+                                                 )
+        subparser_daemon.add_argument('-j', '--jobs',
+                                      type=argparse_types.positive_int,
+                                      default=1,
+                                      metavar='N',
+                                      help='run up to N commands at the same'
+                                      ' time (default: 1)'
+                                      )
+        subparser_daemon.add_argument('--socket',
+                                      metavar='SOCKET',
+                                      help='answer status requests and'
+                                      ' triggers on the Unix domain socket'
+                                      ' SOCKET, see btrsnap status'
+                                      )
+        subparser_daemon.add_argument('schedule',
+                                      nargs=1,
+                                      metavar='SCHEDULE',
+                                      help='file with one command per line:'
+                                      ' an interval such as 15m, 1h or 1d'
+                                      ' followed by btrsnap snap, delete,'
+                                      ' send or restore arguments'
+                                      )
+        subparser_daemon.set_defaults(func=run_daemon)
+
+    def add_status():
+        subparser_status = subparsers.add_parser('status',
+                                                 description='Show what a'
+                                                 ' running btrsnap daemon is'
+                                                 ' doing, as JSON: its jobs,'
+                                                 ' the newest snapshot of'
+                                                 ' each directory, and the'
+                                                 ' deletions and transfers in'
+                                                 ' progress. Or make jobs run'
+                                                 ' now.',
+                                                 help='query or trigger a'
+                                                 ' running daemon'
+                                                 )
+        subparser_status.add_argument('-t', '--trigger',
+                                      choices=('snap', 'delete', 'send',
+                                               'restore'),
+                                      help='run the jobs of this command now'
+                                      )
+        subparser_status.add_argument('-p', '--path',
+                                      metavar='PATH',
+                                      help='with --trigger, only the jobs'
+                                      ' working on PATH'
+                                      )
+        subparser_status.add_argument('socket',
+                                      nargs=1,
+                                      metavar='SOCKET',
+                                      help='control socket of the daemon, see'
+                                      ' btrsnap daemon --socket'
+                                      )
+        subparser_status.set_defaults(func=run_status)
+    commands = collections.OrderedDict([
+        ('snap', add_snap),
+        ('list', add_list),
+        ('delete', add_delete),
+        ('send', add_send),
+        ('restore', add_restore),
+        ('compress', add_compress),
+        ('decompress', add_decompress),
+        ('daemon', add_daemon),
+        ('status', add_status),
+        ])
+    for name, add in commands.items():
+        # building every subparser costs more than parsing the arguments
+        if command not in commands or name == command:
+            add()
+    parser.set_defaults(output=None, failed=False)
+    return parser
 
-    try:
-        args.func(args)
-    except AttributeError:
-        no_subparser(args)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+'''
+Benchmarks for the parts of btrsnap that have to scale to very large
+snapshot directories. They work on synthetic data and do not need a BTRFS
+filesystem.
+
+With ``--startup``, only the start-up cost is measured, the part that
+matters when cron runs btrsnap thousands of times a day, and the exit
+status is 1 if it is over budget.
+
+    example:
+    python btrsnap_benchmark.py
+    python btrsnap_benchmark.py --startup
+'''
+import datetime
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import time
+
+try:
+    from dateutil.relativedelta import relativedelta
+except ImportError:
+    # only needed for the baseline of the split_by_date benchmark
+    relativedelta = None
+
+import btrsnap
+import chunks
+
+# milliseconds. Raise a budget only together with the change that needs it
+STARTUP_BUDGET = {
+    # python -X importtime, cumulative time of btrsnap and what it imports
+    'import': 40,
+    # building the parser of the one subcommand invoked
+    'parser': 1,
+}
+# imported only by the subcommands that need them, see btrsnap.py
+LAZY_MODULES = ('argparse', 'concurrent.futures', 'dateutil', 'hashlib',
+                'lzma', 'queue', 'shutil', 'sqlite3', 'tempfile')
+# self and cumulative microseconds, then the indented module name
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$')
+
+
+def synthetic_snapshots(count, per_day=24):
+    '''
+    Returns:
+        * list(str): COUNT snapshot names, PER_DAY a day, oldest first.
+    '''
+    start = datetime.date(2000, 1, 1).toordinal()
+    return ['{}-{:04d}'.format(
+        datetime.date.fromordinal(start + n // per_day).isoformat(),
+        n % per_day + 1) for n in range(count)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def relativedelta_loop(snapshots, date):
+    '''
+    The per-snapshot relativedelta comparison unsnap used before the
+    ordinal retention engine, kept here for comparison.
+    '''
+    today = datetime.date.today()
+    delta_today = today - date
+    snapshots = sorted(snapshots)
+    older = []
+    while snapshots:
+        snap = snapshots.pop()
+        year, month, day = snap.split('-')[:-1]
+        delta_snap = today - relativedelta(year=int(year), month=int(month),
+                                           day=int(day))
+        if delta_today >= delta_snap:
+            older.append(snap)
+    return older
+
+
+def benchmark_split_by_date(count=1000000, baseline_count=100000):
+    snapshots = synthetic_snapshots(count)
+    cutoff = btrsnap.snapshot_date(snapshots[count // 2])
+
+    seconds, (newer, older) = timed(btrsnap.split_by_date, snapshots, cutoff)
+    print('split_by_date:      {:>9} snapshots in {:.3f}s'
+          ' ({:.2f} us/snapshot)'.format(count, seconds,
+                                         seconds / count * 1e6))
+
+    if relativedelta is None:
+        print('relativedelta loop: skipped, python-dateutil not installed')
+        return
+    sample = snapshots[:baseline_count]
+    date = relativedelta(year=cutoff.year, month=cutoff.month,
+                         day=cutoff.day)
+    seconds, _ = timed(relativedelta_loop, sample, date)
+    print('relativedelta loop: {:>9} snapshots in {:.3f}s'
+          ' ({:.2f} us/snapshot)'.format(baseline_count, seconds,
+                                         seconds / baseline_count * 1e6))
+
+
+def chunk_and_hash(data, block_size):
+    '''
+    The hot loop of chunks.Deduplicator, without the thread pool and the store:
+    split DATA into content-defined chunks block by block, and hash them.
+    '''
+    chunker = chunks.Chunker()
+    digests = []
+    rest = b''
+    view = memoryview(data)
+    for start in range(0, len(data), block_size):
+        block = view[start:start + block_size]
+        pieces, rest = chunker.split(rest + block,
+                                     final=start + block_size >= len(data))
+        digests.extend(hashlib.sha256(chunk).digest() for chunk in pieces)
+    return digests
+
+
+def benchmark_chunking(size=256 << 20):
+    data = os.urandom(size)
+    block_size = chunks.Chunker.block_size
+
+    seconds, digests = timed(chunk_and_hash, data, block_size)
+    print('chunk and hash:     {:>9} MiB in {:.3f}s ({:.0f} MiB/s,'
+          ' {} chunks)'.format(size >> 20, seconds,
+                               size / seconds / (1 << 20), len(digests)))
+
+    # an insertion near the start should only change the first chunk
+    _, shifted = timed(chunk_and_hash, b'shift' + data, block_size)
+    shared = len(set(digests) & set(shifted))
+    print('after a 5 byte insertion {:.2%} of the chunks are unchanged'
+          .format(shared / len(digests)))
+
+
+def import_times(runs=5):
+    '''
+    Import btrsnap in RUNS fresh interpreters under ``python -X importtime``.
+
+    Returns:
+        * tuple: (float, set(str)) the fastest cumulative import time of
+          btrsnap in milliseconds, and the modules it imported.
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    modules = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                 'import btrsnap'], cwd=directory,
+                                stderr=subprocess.PIPE, check=True,
+                                universal_newlines=True).stderr
+        for line in output.splitlines():
+            match = IMPORTTIME_PATTERN.match(line)
+            if match is None:
+                continue
+            modules.add(match.group(2))
+            if match.group(2) == 'btrsnap':
+                cumulative = int(match.group(1)) / 1000
+                best = cumulative if best is None else min(best, cumulative)
+    return best, modules
+
+
+def benchmark_startup(runs=5, budget=STARTUP_BUDGET):
+    '''
+    Returns:
+        * list(str): what went over BUDGET.
+    '''
+    failures = []
+    milliseconds, modules = import_times(runs)
+    print('import btrsnap:     {:>9.1f} ms (budget {} ms)'.format(
+        milliseconds, budget['import']))
+    if milliseconds > budget['import']:
+        failures.append('import btrsnap takes {:.1f} ms'.format(milliseconds))
+    eager = sorted(module for module in LAZY_MODULES if module in modules)
+    if eager:
+        failures.append('import btrsnap imports ' + ', '.join(eager))
+
+    timings = {}
+    for command in ('list', None):
+        seconds = min(timed(btrsnap._parser, command)[0]
+                      for _ in range(runs * 10))
+        timings[command] = seconds * 1000
+    print('parser for list:    {:>9.2f} ms (budget {} ms), all'
+          ' subcommands {:.2f} ms'.format(timings['list'], budget['parser'],
+                                          timings[None]))
+    if timings['list'] > budget['parser']:
+        failures.append('building the parser takes {:.2f} ms'
+                        .format(timings['list']))
+    for failure in failures:
+        print('over budget:', failure)
+    return failures
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--startup']:
+        sys.exit(1 if benchmark_startup() else 0)
+    benchmark_split_by_date()
+    benchmark_chunking()
+    benchmark_startup()
@@ -17,10 +17,12 @@ import datetime
 import subprocess
 import re
 import glob
-
-from dateutil.relativedelta import relativedelta
+import sys
 
 import btrsnap
+import compression
+import dates
+import transport
 
 
 def get_test_dir():
@@ -116,6 +118,110 @@ class Test_functions_(unittest.TestCase):
         for snapshot in s_snaps:
             self.assertIn(snapshot, r_snaps, '{} snapshot was not received'.format(snapshot))
 
+    def test_sendreceive_transport(self):
+        send_path = self.snap_dir1
+        receive_path = self.receive_dir
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+
+        # sh -c stands in for ssh
+        sh = transport.CommandTransport(['sh', '-c'])
+        btrsnap.send_receive(send_path, receive_path, transport=sh)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(receive_path).snapshots())
+
+    def test_sendreceive_transport_compress(self):
+        send_path = self.snap_dir1
+        receive_path = self.receive_dir
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+
+        sh = transport.CommandTransport(['sh', '-c'], compress=('zlib', 1))
+        # btrsnap is not necessarily installed where the tests run
+        sh.decompress_command = [sys.executable, btrsnap.__file__,
+                                 'decompress']
+        msg = btrsnap.send_receive(send_path, receive_path, transport=sh)
+        self.assertIn('compressed', msg)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(receive_path).snapshots())
+
+    def test_sendreceive_not_covered(self):
+        send_path = self.snap_dir1
+        receive_path = self.receive_dir
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 5)]
+        for name in names[:3]:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+        btrsnap.send_receive(send_path, receive_path)
+        subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, names[3])])
+
+        # the filesystem lists, but shows neither directory
+        mount = btrsnap._mount_of(self.test_dir)
+        indexes = {(('local', mount.source), False):
+                   btrsnap.SubvolumeIndex([], mount)}
+        msg = btrsnap.send_receive(send_path, receive_path, indexes=indexes)
+        self.assertIn('1 snapshots copied', msg)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(receive_path).snapshots())
+
+    def test_sendreceive_deep_bwlimit(self):
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for send_path in (self.snap_dir1, self.snap_dir2):
+            for name in names:
+                subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+        with open(os.path.join(self.snap_dir2, '.bwlimit'), 'w') as f:
+            f.write('64M\n')
+
+        bucket = btrsnap.TokenBucket(btrsnap.BandwidthSchedule.parse(['128M']))
+        msg = btrsnap.send_receive_deep(self.parent_snap_dir, self.receive_dir,
+                                        jobs=2, bwlimit=bucket)
+        self.assertIn('throttled', msg)
+        for sub in ('snap_dir1', 'snap_dir2'):
+            r_snaps = btrsnap.Path(os.path.join(self.receive_dir, sub)).snapshots()
+            self.assertEqual(sorted(names, reverse=True), r_snaps,
+                             'not all paths were transfered')
+
+    def test_sendreceive_deep_transport(self):
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for send_path in (self.snap_dir1, self.snap_dir2):
+            for name in names:
+                subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+
+        sh = transport.CommandTransport(['sh', '-c'])
+        btrsnap.send_receive_deep(self.parent_snap_dir, self.receive_dir,
+                                  jobs=2, transport=sh)
+        for sub in ('snap_dir1', 'snap_dir2'):
+            r_snaps = btrsnap.Path(os.path.join(self.receive_dir, sub)).snapshots()
+            self.assertEqual(sorted(names, reverse=True), r_snaps,
+                             'not all paths were transfered')
+
+    def test_sendreceive_fan_out(self):
+        send_path = self.snap_dir1
+        receive_path = self.receive_dir
+        second_receive_path = os.path.join(self.test_dir, 'receive_dir2')
+        os.mkdir(second_receive_path)
+        self.addCleanup(lambda: [subprocess.call(['btrfs', 'subvolume', 'delete', f]) for f in glob.glob(second_receive_path + '/*')])
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+        btrsnap.send_receive(send_path, receive_path)
+        subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, self.timestamp + '-0004')])
+        names.append(self.timestamp + '-0004')
+
+        msg = btrsnap.send_receive(send_path, [receive_path, second_receive_path])
+        # the newest snapshot is sent once to both
+        self.assertIn('to 2 destinations', msg)
+        for path in (receive_path, second_receive_path):
+            self.assertEqual(sorted(names, reverse=True),
+                             btrsnap.Path(path).snapshots())
+
     def test_sendreceive_deep(self):
         send_paths = self.parent_snap_dir
         send_path = self.snap_dir1
@@ -154,6 +260,124 @@ class Test_functions_(unittest.TestCase):
         for sub in s_snaps:
             self.assertIn(sub, r_snaps, '{} snapshot was not received'.format(sub))
 
+    def test_sendreceive_deep_jobs(self):
+        send_paths = self.parent_snap_dir
+        send_path = self.snap_dir1
+        second_send_path = self.snap_dir2
+        receive_path = self.receive_dir
+        link_path = self.link_dir
+        timestamp = self.timestamp
+
+        # create some snapshots
+        names = ['{}-000{}'.format(timestamp, count) for count in range(1, 6)]
+        for name in names:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', link_path, os.path.join(send_path, name)])
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', link_path, os.path.join(second_send_path, name)])
+
+        btrsnap.send_receive_deep(send_paths, receive_path, jobs=2)
+
+        for sub in ('snap_dir1', 'snap_dir2'):
+            r_snaps = btrsnap.Path(os.path.join(receive_path, sub)).snapshots()
+            self.assertEqual(sorted(names, reverse=True), r_snaps,
+                             'not all paths were transfered')
+
+    def test_send_to_dir_restore(self):
+        send_path = self.snap_dir1
+        receive_path = self.receive_dir
+        link_path = self.link_dir
+        archive_path = os.path.join(self.test_dir, 'archive')
+        os.mkdir(archive_path)
+
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names[:2]:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', link_path, os.path.join(send_path, name)])
+        btrsnap.send_to_dir(send_path, archive_path)
+        subprocess.call(['btrfs', 'subvolume', 'snap', '-r', link_path, os.path.join(send_path, names[2])])
+        btrsnap.send_to_dir(send_path, archive_path)
+
+        entries = btrsnap.StreamArchive(archive_path).entries()
+        self.assertEqual(names, [entry.snapshot for entry in entries])
+        self.assertEqual([None] + names[:2],
+                         [entry.parent for entry in entries])
+
+        btrsnap.restore(archive_path, receive_path)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(receive_path).snapshots())
+
+    def test_send_to_dir_compress_restore(self):
+        archive_path = os.path.join(self.test_dir, 'archive')
+        os.mkdir(archive_path)
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names[:2]:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(self.snap_dir1, name)])
+        btrsnap.send_to_dir(self.snap_dir1, archive_path,
+                            compress=('lzma', 1))
+        # compressed and plain streams in one archive
+        subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(self.snap_dir1, names[2])])
+        btrsnap.send_to_dir(self.snap_dir1, archive_path)
+
+        with open(os.path.join(archive_path, names[0] + '.btrfs'), 'rb') as f:
+            self.assertEqual(compression.STREAM_MAGIC, f.read(8))
+        btrsnap.restore(archive_path, self.receive_dir)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(self.receive_dir).snapshots())
+
+    def test_send_to_dir_dedup_restore(self):
+        archive_path = os.path.join(self.test_dir, 'archive')
+        os.mkdir(archive_path)
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for name in names:
+            subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(self.snap_dir1, name)])
+
+        btrsnap.send_to_dir(self.snap_dir1, archive_path, dedup=True)
+        self.assertTrue(os.path.isdir(os.path.join(archive_path, 'chunks')))
+        btrsnap.restore(archive_path, self.receive_dir)
+        self.assertEqual(sorted(names, reverse=True),
+                         btrsnap.Path(self.receive_dir).snapshots())
+
+    def test_send_to_dir_restore_deep(self):
+        archive_path = os.path.join(self.test_dir, 'archive')
+        os.mkdir(archive_path)
+        names = ['{}-000{}'.format(self.timestamp, count)
+                 for count in range(1, 4)]
+        for send_path in (self.snap_dir1, self.snap_dir2):
+            for name in names:
+                subprocess.call(['btrfs', 'subvolume', 'snap', '-r', self.link_dir, os.path.join(send_path, name)])
+
+        btrsnap.send_to_dir_deep(self.parent_snap_dir, archive_path, jobs=2)
+        btrsnap.restore_deep(archive_path, self.receive_dir, jobs=2)
+
+        for sub in ('snap_dir1', 'snap_dir2'):
+            r_snaps = btrsnap.Path(os.path.join(self.receive_dir, sub)).snapshots()
+            self.assertEqual(sorted(names, reverse=True), r_snaps,
+                             'not all paths were restored')
+
+    def test_snap_deep_if_changed(self):
+        parent_path = self.parent_snap_dir
+        # a snapshot bumps the generation of its target, so each directory
+        # needs a target of its own
+        target2 = os.path.join(self.receive_dir, 'target2')
+        subprocess.call(['btrfs', 'subvolume', 'create', target2])
+        os.unlink(os.path.join(self.snap_dir2, 'target'))
+        os.symlink(target2, os.path.join(self.snap_dir2, 'target'))
+
+        def count():
+            return [len([x for x in os.listdir(d) if x != 'target'])
+                    for d in (self.snap_dir1, self.snap_dir2)]
+
+        btrsnap.snap_deep(parent_path, if_changed=True)
+        self.assertEqual([1, 1], count())
+        output = btrsnap.snap_deep(parent_path, if_changed=True)
+        self.assertEqual([1, 1], count())
+        self.assertIn('2 skipped', output)
+        with open(os.path.join(self.link_dir, 'new_file'), 'w') as f:
+            f.write('changed')
+        btrsnap.snap_deep(parent_path, if_changed=True)
+        self.assertEqual([2, 1], count())
+
     def test_unsnap_deep_keep(self):
         parent_path = self.parent_snap_dir
         first_send_path = self.snap_dir1
@@ -214,11 +438,11 @@ class Test_functions_(unittest.TestCase):
             self.assertEqual(len(snaps), expected,
                              "Wrong number of snapshots survived")
         # delete yesterday's
-        btrsnap.unsnap_deep(parent_path, keep=None, date=relativedelta(days=1))
+        btrsnap.unsnap_deep(parent_path, keep=None, date=dates.Period(days=1))
         assert_snap_count(5)
 
         # delete today's
-        btrsnap.unsnap_deep(parent_path, keep=None, date=relativedelta(days=0))
+        btrsnap.unsnap_deep(parent_path, keep=None, date=dates.Period(days=0))
         assert_snap_count(0)
 
 
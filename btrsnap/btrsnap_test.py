@@ -14,10 +14,14 @@ import os
 import shutil
 import datetime
 import subprocess
-
-from dateutil.relativedelta import relativedelta
+import threading
+import sys
+import collections
+import types
 
 import btrsnap
+import chunks
+import dates
 
 
 def get_test_dir():
@@ -63,6 +67,10 @@ class Test_Path_Class(unittest.TestCase):
         path = btrsnap.Path('~')
         self.assertEqual(path.path, os.path.expanduser('~'))
 
+    def test_free_space(self):
+        free = btrsnap.free_space(self.test_dir)
+        self.assertTrue(0 <= free <= 100)
+
     def test_path_relative_path(self):
         test_dir = self.test_dir
         rel_path = 'empty_path'
@@ -166,6 +174,31 @@ class Test_SnapPath_Class(unittest.TestCase):
         self.assertEqual(timestamps, snap.snapshots(),
                          'bogus folders should be ignored')
 
+    def test_SnapPath_scan(self):
+        snap_dir = self.snap_dir
+        timestamps = sorted(self.timestamps, reverse=True)
+        os.mkdir(os.path.join(snap_dir, 'some-unrelated-dir'))
+        open(os.path.join(snap_dir, '2013-01-01-0001'), 'w').close()
+
+        scan = btrsnap.SnapPath(snap_dir).scan()
+        self.assertEqual(timestamps, scan.snapshots)
+        self.assertEqual(['target'], scan.links)
+        self.assertEqual(sorted(timestamps + ['some-unrelated-dir', 'target']),
+                         sorted(scan.directories))
+
+    def test_SnapPath_snapshots_precise(self):
+        snap_dir = self.snap_dir
+        precise = ['2012-01-01-235959-0001', '2012-02-01-000000-0000']
+        for folder in precise:
+            os.mkdir(os.path.join(snap_dir, folder))
+        expected = ['2012-02-01-000000-0000', '2012-02-01-0002',
+                    '2012-02-01-0001', '2012-01-01-235959-0001',
+                    '2012-01-01-0002', '2012-01-01-0001']
+
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertEqual(expected, snap.snapshots(),
+                         'precise snapshots sort after daily ones')
+
     def test_SnapPath_ensure_symlink_exists(self):
         snap_dir = self.snap_dir
         os.unlink(os.path.join(snap_dir, 'target'))
@@ -208,6 +241,46 @@ class Test_SnapPath_Class(unittest.TestCase):
         os.mkdir(os.path.join(snap_dir, second))
         self.assertEqual(third, snap.timestamp())
 
+    def test_SnapPath_timestamp_precise(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today().isoformat()
+
+        snap = btrsnap.SnapPath(snap_dir)
+        first = snap.timestamp(precise=True)
+        self.assertRegex(first, r'^{}-\d{{6}}-\d{{4}}$'.format(today))
+
+        os.mkdir(os.path.join(snap_dir, first))
+        second = snap.timestamp(precise=True)
+        self.assertGreater(second, first)
+
+    def test_SnapPath_timestamp_precise_same_instant(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today().isoformat()
+        last = today + '-235959-9998'
+
+        os.mkdir(os.path.join(snap_dir, last))
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertEqual(today + '-235959-9999', snap.timestamp(precise=True))
+
+    def test_SnapPath_timestamp_after_precise(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today().isoformat()
+
+        os.mkdir(os.path.join(snap_dir, today + '-000000-0000'))
+        snap = btrsnap.SnapPath(snap_dir)
+        for precise in (False, True):
+            timestamp = snap.timestamp(precise=precise)
+            self.assertEqual(len(today + '-000000-0000'), len(timestamp))
+            self.assertGreater(timestamp, today + '-000000-0000')
+
+    def test_SnapPath_timestamp_newer_than_today(self):
+        snap_dir = self.snap_dir
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+
+        os.mkdir(os.path.join(snap_dir, tomorrow.isoformat() + '-0001'))
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertRaises(btrsnap.BtrsnapError, snap.timestamp)
+
     def test_SnapPath_timestamp_9999_or_less(self):
         snap_dir = self.snap_dir
         today = datetime.date.today()
@@ -219,6 +292,607 @@ class Test_SnapPath_Class(unittest.TestCase):
         self.assertRaises(Exception, snap.timestamp)
 
 
+class Test_Retention_Class(unittest.TestCase):
+
+    test_dir = get_test_dir()
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    timestamps = ['2012-01-01-0001',
+                  '2012-01-01-0002',
+                  '2012-02-01-0001',
+                  '2012-02-01-120000-0000',
+                  '2012-03-01-0001']
+
+    def setUp(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        timestamps = self.timestamps
+
+        os.mkdir(test_dir)
+        os.mkdir(snap_dir)
+        for folder in timestamps:
+            os.mkdir(os.path.join(snap_dir, folder))
+
+    def tearDown(self):
+        test_dir = self.test_dir
+        shutil.rmtree(test_dir)
+
+    def test_split_by_date(self):
+        newer, older = btrsnap.split_by_date(self.timestamps,
+                                             datetime.date(2012, 2, 1))
+        self.assertEqual(['2012-03-01-0001'], newer)
+        self.assertEqual(['2012-02-01-120000-0000', '2012-02-01-0001',
+                          '2012-01-01-0002', '2012-01-01-0001'], older)
+
+    def test_split_by_date_nothing_older(self):
+        newer, older = btrsnap.split_by_date(self.timestamps,
+                                             datetime.date(2011, 12, 31))
+        self.assertEqual(sorted(self.timestamps, key=btrsnap.snapshot_key,
+                                reverse=True), newer)
+        self.assertEqual([], older)
+
+    def test_plan_unsnap_keep(self):
+        snap_dir = self.snap_dir
+        plan = btrsnap.plan_unsnap(snap_dir, keep=2)
+        self.assertEqual(['2012-03-01-0001', '2012-02-01-120000-0000'],
+                         plan.keep)
+        self.assertEqual(['2012-02-01-0001', '2012-01-01-0002',
+                          '2012-01-01-0001'], plan.delete)
+        self.assertEqual(sorted(self.timestamps, key=btrsnap.snapshot_key,
+                                reverse=True),
+                         btrsnap.Path(snap_dir).snapshots(),
+                         'planning should not delete anything')
+        self.assertIn('Would delete 3 snapshot(s) from "{}"'.format(snap_dir),
+                      str(plan))
+        self.assertNotIn('Deleted', str(plan))
+
+    def test_plan_unsnap_date(self):
+        snap_dir = self.snap_dir
+        plan = btrsnap.plan_unsnap(snap_dir,
+                                   date=dates.Period(
+                                       date=datetime.date(2012, 1, 31)))
+        self.assertEqual(['2012-01-01-0002', '2012-01-01-0001'], plan.delete)
+        self.assertIn('2012-01-31', str(plan))
+
+
+class Test_RetentionPolicy_Class(unittest.TestCase):
+
+    def test_RetentionPolicy_daily_weekly(self):
+        # two snapshots a day for 21 days, ending on Sunday 2014-06-29
+        start = datetime.date(2014, 6, 9)
+        snapshots = ['{}-{:04d}'.format(
+            (start + datetime.timedelta(days=day)).isoformat(), number)
+            for day in range(21) for number in (1, 2)]
+        policy = btrsnap.RetentionPolicy(daily=3, weekly=3)
+
+        keep, delete = policy.split(snapshots)
+        self.assertEqual(['2014-06-29-0002', '2014-06-28-0002',
+                          '2014-06-27-0002', '2014-06-22-0002',
+                          '2014-06-15-0002'], keep)
+        self.assertEqual(len(snapshots), len(keep) + len(delete))
+        self.assertFalse(set(keep) & set(delete))
+
+    def test_RetentionPolicy_hourly_precise(self):
+        snapshots = ['2014-06-29-100000-0000', '2014-06-29-103000-0000',
+                     '2014-06-29-110000-0000', '2014-06-29-0001']
+        policy = btrsnap.RetentionPolicy(hourly=3)
+
+        keep, delete = policy.split(snapshots)
+        self.assertEqual(['2014-06-29-110000-0000', '2014-06-29-103000-0000',
+                          '2014-06-29-0001'], keep)
+        self.assertEqual(['2014-06-29-100000-0000'], delete)
+
+    def test_RetentionPolicy_monthly_yearly(self):
+        snapshots = ['2012-12-31-0001', '2013-01-01-0001', '2013-06-01-0001',
+                     '2013-06-15-0001', '2014-01-01-0001']
+        policy = btrsnap.RetentionPolicy(monthly=2, yearly=3)
+
+        keep, delete = policy.split(snapshots)
+        self.assertEqual(['2014-01-01-0001', '2013-06-15-0001',
+                          '2012-12-31-0001'], keep)
+
+    def test_RetentionPolicy_invalid(self):
+        self.assertRaises(btrsnap.BtrsnapError, btrsnap.RetentionPolicy,
+                          daily=-1)
+
+
+class Test_Relay_Class(unittest.TestCase):
+
+    test_dir = get_test_dir()
+    source = os.path.join(test_dir, 'source')
+    destination = os.path.join(test_dir, 'destination')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 17))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def relay(self, **kwargs):
+        with open(self.destination, 'wb') as out:
+            p1 = subprocess.Popen(['cat', self.source],
+                                  stdout=subprocess.PIPE)
+            p2 = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=out)
+            relay = btrsnap.Relay(p1.stdout.fileno(), p2.stdin.fileno(),
+                                  **kwargs)
+            relay.run()
+            p1.stdout.close()
+            p2.stdin.close()
+            p1.wait()
+            p2.wait()
+        return relay
+
+    def test_Relay_copies_stream(self):
+        relay = self.relay()
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(expected, f.read())
+        self.assertEqual(len(expected), relay.bytes)
+        self.assertGreater(relay.rate, 0)
+        self.assertIn('MiB', str(relay))
+
+    def test_Relay_file_to_file(self):
+        with open(self.source, 'rb') as source:
+            with open(self.destination, 'wb') as sink:
+                relay = btrsnap.Relay(source.fileno(), sink.fileno())
+                relay.run()
+        self.assertEqual(os.path.getsize(self.source), relay.bytes)
+        self.assertEqual(os.path.getsize(self.source),
+                         os.path.getsize(self.destination))
+
+
+class Test_Activity_Class(unittest.TestCase):
+
+    def test_Activity_transfer(self):
+        activity = btrsnap.Activity()
+        stage = types.SimpleNamespace(bytes=0)
+        with activity.transfer('/backup', stage):
+            stage.bytes = 1000
+            transfer, = activity.transfers()
+            self.assertEqual('/backup', transfer['destination'])
+            self.assertEqual(1000, transfer['bytes'])
+            self.assertGreater(transfer['bytes_per_second'], 0)
+        self.assertEqual([], activity.transfers())
+
+    def test_Activity_deleting(self):
+        activity = btrsnap.Activity()
+        with activity.deleting('/a', ['2012-01-01-0001']):
+            with activity.deleting('/a', ['2012-01-01-0002']):
+                self.assertEqual(
+                    {'/a': ['2012-01-01-0001', '2012-01-01-0002']},
+                    activity.deletions())
+            self.assertEqual({'/a': ['2012-01-01-0001']},
+                             activity.deletions())
+        self.assertEqual({}, activity.deletions())
+
+
+class Test_StreamArchive_Class(unittest.TestCase):
+
+    test_dir = get_test_dir()
+    source = os.path.join(test_dir, 'source')
+    archive_dir = os.path.join(test_dir, 'archive')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.archive_dir)
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(1024 * 1024 + 5))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_StreamArchive_write(self):
+        archive = btrsnap.StreamArchive(self.archive_dir)
+        archive.sync_size = 64 * 1024
+        self.assertEqual([], archive.entries())
+        for snapshot, parent in (('2016-01-01-0001', None),
+                                 ('2016-01-02-0001', '2016-01-01-0001')):
+            p1 = subprocess.Popen(['cat', self.source],
+                                  stdout=subprocess.PIPE)
+            relay = archive.write(p1, snapshot, parent)
+            self.assertEqual(os.path.getsize(self.source), relay.bytes)
+        self.assertEqual([btrsnap.StreamEntry('2016-01-01-0001', None,
+                                              '2016-01-01-0001.btrfs',
+                                              relay.bytes),
+                          btrsnap.StreamEntry('2016-01-02-0001',
+                                              '2016-01-01-0001',
+                                              '2016-01-02-0001.btrfs',
+                                              relay.bytes)],
+                         archive.entries())
+        self.assertEqual(['2016-01-02-0001', '2016-01-01-0001'],
+                         archive.snapshots())
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        with open(os.path.join(self.archive_dir,
+                               '2016-01-02-0001.btrfs'), 'rb') as f:
+            self.assertEqual(expected, f.read())
+
+    def test_StreamArchive_write_failed_send(self):
+        archive = btrsnap.StreamArchive(self.archive_dir)
+        p1 = subprocess.Popen(['false'], stdout=subprocess.PIPE)
+        self.assertRaises(btrsnap.BtrfsError, archive.write, p1,
+                          '2016-01-01-0001')
+        self.assertEqual([], os.listdir(self.archive_dir))
+
+    def read_stream(self, archive, entry):
+        data = []
+        with archive.stream(entry) as source:
+            for block in iter(lambda: os.read(source, 65536), b''):
+                data.append(block)
+        return b''.join(data)
+
+    def test_StreamArchive_dedup(self):
+        archive = btrsnap.StreamArchive(self.archive_dir, dedup=True)
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        for snapshot in ('2016-01-01-0001', '2016-01-02-0001'):
+            p1 = subprocess.Popen(['cat', self.source],
+                                  stdout=subprocess.PIPE)
+            stats = archive.write(p1, snapshot)
+        # the second stream is made of chunks that are already stored
+        self.assertEqual(0, stats.new_chunks)
+        self.assertEqual(0, stats.bytes_out)
+        self.assertEqual(len(expected), stats.bytes_in)
+        self.assertTrue(btrsnap.StreamArchive(self.archive_dir).dedup)
+        for entry in archive.entries():
+            self.assertEqual('.chunks', os.path.splitext(entry.file)[1])
+            self.assertEqual(expected, self.read_stream(archive, entry))
+
+    def test_StreamArchive_dedup_corrupt_chunk(self):
+        archive = btrsnap.StreamArchive(self.archive_dir, dedup=True)
+        p1 = subprocess.Popen(['cat', self.source], stdout=subprocess.PIPE)
+        archive.write(p1, '2016-01-01-0001')
+        entry = archive.entries()[0]
+        with open(os.path.join(self.archive_dir, entry.file), 'rb') as f:
+            digest = f.read(chunks.ChunkStore.digest_size)
+        with open(archive.chunk_store.filename(digest), 'r+b') as f:
+            f.seek(5)
+            f.write(b'garbage')
+        self.assertRaises(btrsnap.BtrsnapError, self.read_stream, archive,
+                          entry)
+
+    def test_StreamArchive_compress(self):
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        archive = btrsnap.StreamArchive(self.archive_dir,
+                                        compress=('zlib', 1))
+        p1 = subprocess.Popen(['cat', self.source], stdout=subprocess.PIPE)
+        stats = archive.write(p1, '2016-01-01-0001')
+        self.assertEqual(len(expected), stats.bytes_in)
+        p1 = subprocess.Popen(['cat', self.source], stdout=subprocess.PIPE)
+        btrsnap.StreamArchive(self.archive_dir).write(p1, '2016-01-02-0001')
+        compressed, plain = archive.entries()
+        self.assertEqual(stats.bytes_out, compressed.bytes)
+        self.assertEqual(len(expected), plain.bytes)
+        for entry in (compressed, plain):
+            self.assertEqual(expected, self.read_stream(archive, entry))
+        self.assertRaises(btrsnap.BtrsnapError, btrsnap.StreamArchive,
+                          self.archive_dir, dedup=True, compress=('zlib', 1))
+
+    def test_StreamArchive_corrupt_manifest(self):
+        archive = btrsnap.StreamArchive(self.archive_dir)
+        with open(archive.manifest, 'w') as f:
+            f.write('2016-01-01-0001\t-\n')
+        self.assertRaises(btrsnap.BtrsnapError, archive.entries)
+
+    def test_send_chain(self):
+        sent = ['2016-01-01-0001', '2016-01-02-0001', '2016-01-03-0001']
+        self.assertEqual([('2016-01-01-0001', None),
+                          ('2016-01-02-0001', '2016-01-01-0001'),
+                          ('2016-01-03-0001', '2016-01-02-0001')],
+                         btrsnap._send_chain(sent, []))
+        self.assertEqual([('2016-01-03-0001', '2016-01-02-0001')],
+                         btrsnap._send_chain(sent, sent[:2]))
+        self.assertEqual([], btrsnap._send_chain(sent, sent))
+
+
+class Test_SubvolumeIndex_Class(unittest.TestCase):
+
+    listing = (
+        'ID 256 gen 40 top level 5 parent_uuid - received_uuid -'
+        ' uuid u1 path snaps/home/2016-01-01-0001\n'
+        'ID 257 gen 41 top level 5 parent_uuid - received_uuid -'
+        ' uuid u2 path snaps/home/2016-01-02-0001\n'
+        'ID 258 gen 42 top level 5 parent_uuid - received_uuid -'
+        ' uuid u3 path snaps/home/2016-01-03-0001\n'
+        'ID 259 gen 43 top level 5 parent_uuid - received_uuid -'
+        ' uuid u4 path snaps/home/2016-01-04-0001\n')
+    sent = ['2016-01-01-0001', '2016-01-02-0001', '2016-01-03-0001',
+            '2016-01-04-0001']
+    test_dir = get_test_dir()
+
+    def tearDown(self):
+        if os.path.isdir(self.test_dir):
+            shutil.rmtree(self.test_dir)
+
+    def setUp(self):
+        mount = btrsnap.Mount('/mnt/pool', '/', '/dev/sda')
+        self.send = btrsnap.SubvolumeIndex(
+            btrsnap.SubvolumeIndex.parse(self.listing), mount)
+        self.subvolumes = dict(
+            (s, self.send.find(os.path.join('/mnt/pool/snaps/home', s)))
+            for s in self.sent)
+
+    def receiving(self, *uuids):
+        lines = ['ID {0} gen 7 top level 5 parent_uuid -'
+                 ' received_uuid {1} uuid r{0} path backup/{0}'
+                 .format(i, uuid) for i, uuid in enumerate(uuids)]
+        return btrsnap.SubvolumeIndex(
+            btrsnap.SubvolumeIndex.parse('\n'.join(lines)))
+
+    def test_parse(self):
+        subvolumes = btrsnap.SubvolumeIndex.parse(
+            'ID 257 gen 31 cgen 20 top level 5 otime 2016-01-01 10:00:00'
+            ' parent_uuid - received_uuid abc uuid def path dir/with path\n')
+        self.assertEqual([btrsnap.Subvolume(
+            257, 31, 5, None, 'abc', 'def', 'dir/with path',
+            datetime.datetime(2016, 1, 1, 10, 0), 20)], subvolumes)
+        self.assertRaises(btrsnap.BtrsnapError, btrsnap.SubvolumeIndex.parse,
+                          'ID x gen 1 top level 5 path a')
+
+    def test_find(self):
+        self.assertEqual('u2', self.subvolumes['2016-01-02-0001'].uuid)
+        self.assertIsNone(self.send.find('/mnt/pool/other'))
+        self.assertIsNone(self.receiving().find('/mnt/pool/other'))
+
+    def test_snapshots(self):
+        index = btrsnap.SubvolumeIndex(btrsnap.SubvolumeIndex.parse(
+            self.listing + 'ID 260 gen 44 top level 5 parent_uuid -'
+            ' received_uuid - uuid u5 path snaps/home/work\n'),
+            btrsnap.Mount('/mnt/home', '/snaps', '/dev/sda'))
+        self.assertEqual(list(reversed(self.sent)),
+                         index.snapshots('/mnt/home/home'))
+        self.assertEqual(5, len(index.children('/mnt/home/home')))
+        self.assertEqual([], index.snapshots('/mnt/home'))
+        self.assertEqual([], btrsnap.SubvolumeIndex(
+            index.subvolumes).snapshots('/mnt/home/home'))
+
+    def test_covers(self):
+        self.assertTrue(self.send.covers('/mnt/pool/snaps/home'))
+        self.assertTrue(self.send.covers(
+            '/mnt/pool/snaps/home/2016-01-01-0001'))
+        self.assertFalse(self.send.covers('/mnt/pool/snaps/other'))
+        self.assertFalse(self.receiving().covers('/mnt/pool/snaps/home'))
+
+    def test_plan_unsnap_not_covered(self):
+        snap_dir = os.path.join(self.test_dir, 'snaps')
+        os.makedirs(snap_dir)
+        for snapshot in self.sent:
+            os.mkdir(os.path.join(snap_dir, snapshot))
+        mount = btrsnap._mount_of(self.test_dir)
+        # the filesystem lists, but not the directory, as under a bind mount
+        indexes = {(('local', mount.source), False):
+                   btrsnap.SubvolumeIndex(btrsnap.SubvolumeIndex.parse(
+                       self.listing), mount)}
+        plan = btrsnap.plan_unsnap(snap_dir, keep=1, indexes=indexes)
+        self.assertEqual(self.sent[:3], sorted(plan.delete))
+
+    def test_describe_subvolume(self):
+        sub = btrsnap.Subvolume(1, 7, 5, None, 'r', 'u', 'a',
+                                datetime.datetime(2016, 1, 2, 3, 4, 5), 7)
+        self.assertEqual('a\tcreated 2016-01-02 03:04:05\tgeneration 7'
+                         '\treceived', btrsnap._describe_subvolume('a', sub))
+        self.assertEqual('a\tgeneration 7', btrsnap._describe_subvolume(
+            'a', sub._replace(otime=None, received_uuid=None)))
+        self.assertEqual('a', btrsnap._describe_subvolume('a', None))
+
+    def test_unchanged_since(self):
+        snap_dir = os.path.join(self.test_dir, 'snaps')
+        target = os.path.join(self.test_dir, 'target')
+        os.makedirs(snap_dir)
+        os.mkdir(target)
+        os.symlink(target, os.path.join(snap_dir, 'target'))
+        mount = btrsnap._mount_of(self.test_dir)
+        listed = btrsnap.SubvolumeIndex([], mount)._listed_path
+
+        def unchanged(generation, parent_uuid='t'):
+            index = btrsnap.SubvolumeIndex(btrsnap.SubvolumeIndex.parse(
+                'ID 256 gen 50 top level 5 parent_uuid - received_uuid -'
+                ' uuid t path {}\n'
+                'ID 257 gen 30 cgen 30 top level 5 parent_uuid {}'
+                ' received_uuid - uuid s1 path {}/2016-01-01-0001\n'
+                'ID 258 gen 40 cgen 40 top level 5 parent_uuid {}'
+                ' received_uuid - uuid s2 path {}/2016-01-02-0001\n'.format(
+                    listed(target), parent_uuid, listed(snap_dir),
+                    parent_uuid, listed(snap_dir)).replace(
+                        'gen 50', 'gen {}'.format(generation))), mount)
+            indexes = {(('local', mount.source), False): index}
+            return btrsnap._unchanged_since(btrsnap.SnapPath(snap_dir),
+                                            indexes)
+
+        self.assertEqual('2016-01-02-0001', unchanged(40))
+        self.assertIsNone(unchanged(41))
+        self.assertIsNone(unchanged(40, parent_uuid='other'))
+        # nothing known: always snapshot
+        self.assertIsNone(btrsnap._unchanged_since(
+            btrsnap.SnapPath(snap_dir),
+            {(('local', mount.source), False): None}))
+
+    def test_renamed_parent(self):
+        # the receiving side holds 2016-01-02 under another name
+        chain = btrsnap._uuid_send_chain(self.sent, [], self.subvolumes,
+                                         self.receiving('u2'))
+        self.assertEqual([
+            ('2016-01-01-0001', '2016-01-02-0001', ()),
+            ('2016-01-02-0001', '2016-01-01-0001', ()),
+            ('2016-01-03-0001', '2016-01-02-0001', ('2016-01-01-0001',)),
+            ('2016-01-04-0001', '2016-01-03-0001', ('2016-01-02-0001',)),
+            ], chain)
+
+    def test_clone_sources(self):
+        chain = btrsnap._uuid_send_chain(
+            self.sent, ['2016-01-01-0001', 'x', '2016-01-04-0001'],
+            self.subvolumes, self.receiving('u1', 'u4'))
+        self.assertEqual([
+            ('2016-01-02-0001', '2016-01-01-0001', ('2016-01-04-0001',)),
+            ('2016-01-03-0001', '2016-01-02-0001',
+             ('2016-01-04-0001', '2016-01-01-0001')),
+            ], chain)
+
+    def test_name_is_not_a_copy(self):
+        # same name, but not received from this side: send in full
+        chain = btrsnap._uuid_send_chain(self.sent[:2], self.sent[:1],
+                                         self.subvolumes, self.receiving())
+        self.assertEqual([('2016-01-02-0001', None, ())], chain)
+
+    def test_received_copy(self):
+        # a snapshot the sending side received itself matches its source
+        sub = btrsnap.Subvolume(1, 1, 5, None, 'orig', 'mine', 'a', None,
+                                None)
+        self.assertTrue(self.receiving('orig').has_copy(sub))
+        index = btrsnap.SubvolumeIndex([btrsnap.Subvolume(
+            2, 1, 5, None, None, 'orig', 'b', None, None)])
+        self.assertTrue(index.has_copy(sub))
+        self.assertFalse(self.receiving('other').has_copy(sub))
+
+
+class Test_Tee_Class(unittest.TestCase):
+
+    test_dir = get_test_dir()
+    source = os.path.join(test_dir, 'source')
+    destinations = [os.path.join(test_dir, 'destination1'),
+                    os.path.join(test_dir, 'destination2')]
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(5 * 1024 * 1024 + 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def tee(self, commands):
+        outputs = [open(path, 'wb') for path in self.destinations]
+        p1 = subprocess.Popen(['cat', self.source], stdout=subprocess.PIPE)
+        receivers = [subprocess.Popen(command, stdin=subprocess.PIPE,
+                                      stdout=out)
+                     for command, out in zip(commands, outputs)]
+        tee = btrsnap.Tee(p1.stdout.fileno(),
+                          [p.stdin.fileno() for p in receivers])
+        tee.queue_size = 2
+        tee.run()
+        p1.stdout.close()
+        p1.wait()
+        for receiver, out in zip(receivers, outputs):
+            receiver.stdin.close()
+            receiver.wait()
+            out.close()
+        return tee
+
+    def test_Tee_copies_stream(self):
+        tee = self.tee([['cat'], ['cat']])
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        for path in self.destinations:
+            with open(path, 'rb') as f:
+                self.assertEqual(expected, f.read())
+        self.assertEqual(len(expected), tee.bytes)
+        self.assertEqual({}, tee.errors)
+        self.assertIn('2 destinations', str(tee))
+
+    def test_Tee_failed_sink(self):
+        tee = self.tee([['head', '-c', '10'], ['cat']])
+        self.assertEqual([1], [index + 1 for index in tee.errors])
+        self.assertEqual(10, os.path.getsize(self.destinations[0]))
+        self.assertEqual(os.path.getsize(self.source),
+                         os.path.getsize(self.destinations[1]))
+
+    def test_fan_out(self):
+        chains = collections.OrderedDict([
+            ('a', collections.deque([('s1', None), ('s2', 's1'),
+                                     ('s3', 's2')])),
+            ('b', collections.deque([('s2', 's1'), ('s3', 's2')])),
+            ('c', collections.deque([('s3', None)])),
+            ])
+        self.assertEqual([(('s1', None), ['a']),
+                          (('s2', 's1'), ['a', 'b']),
+                          (('s3', 's2'), ['a', 'b']),
+                          (('s3', None), ['c'])],
+                         list(btrsnap._fan_out(chains)))
+
+
+class Test_Bandwidth_Class(unittest.TestCase):
+
+    test_dir = get_test_dir()
+    source = os.path.join(test_dir, 'source')
+    destination = os.path.join(test_dir, 'destination')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_parse_size(self):
+        self.assertEqual(512, btrsnap.parse_size('512'))
+        self.assertEqual(512 * 1024, btrsnap.parse_size('512K'))
+        self.assertEqual(3 * 1024 ** 2 // 2, btrsnap.parse_size('1.5m'))
+        self.assertEqual(2 * 1024 ** 3, btrsnap.parse_size('2GiB'))
+        for size in ('', 'M', '1X', '-1K'):
+            self.assertRaises(btrsnap.BtrsnapError, btrsnap.parse_size, size)
+
+    def test_BandwidthSchedule_rate(self):
+        schedule = btrsnap.BandwidthSchedule.parse(
+            ['10M', '22:00-06:00=off', '08:00-18:00=1M'])
+        at = lambda hour, minute=0: schedule.rate(
+            datetime.datetime(2016, 1, 1, hour, minute))
+        self.assertIsNone(at(23))
+        self.assertIsNone(at(5, 59))
+        self.assertEqual(10 * 1024 ** 2, at(6))
+        self.assertEqual(1024 ** 2, at(8))
+        self.assertEqual(10 * 1024 ** 2, at(18))
+        self.assertEqual('10M 22:00-06:00=off 08:00-18:00=1M', str(schedule))
+        self.assertIsNone(btrsnap.BandwidthSchedule().rate())
+
+    def test_BandwidthSchedule_Exception(self):
+        for spec in ('24:00-01:00=1M', '08:00-08:00=1M', '08:60-09:00=1M',
+                     '08:00-09:00=', '0', 'fast'):
+            self.assertRaises(btrsnap.BtrsnapError,
+                              btrsnap.BandwidthSchedule.parse, [spec])
+
+    def test_BandwidthSchedule_load(self):
+        filename = os.path.join(self.test_dir, '.bwlimit')
+        with open(filename, 'w') as f:
+            f.write('# business hours\n\n08:00-18:00=512K\n4M\n')
+        schedule = btrsnap.BandwidthSchedule.load(filename)
+        self.assertEqual('4M 08:00-18:00=512K', str(schedule))
+
+    def relay(self, limiter):
+        with open(self.destination, 'wb') as out:
+            p1 = subprocess.Popen(['cat', self.source],
+                                  stdout=subprocess.PIPE)
+            p2 = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=out)
+            relay = btrsnap.Relay(p1.stdout.fileno(), p2.stdin.fileno(),
+                                  limiter=limiter)
+            relay.run()
+            p1.stdout.close()
+            p2.stdin.close()
+            p1.wait()
+            p2.wait()
+        self.assertEqual(os.path.getsize(self.source),
+                         os.path.getsize(self.destination))
+        return relay
+
+    def test_TokenBucket_limits_Relay(self):
+        schedule = btrsnap.BandwidthSchedule(4 * 1024 * 1024)
+        bucket = btrsnap.TokenBucket(schedule, burst=128 * 1024)
+        relay = self.relay(bucket)
+        # 1 MiB at 4 MiB/s, starting with an empty bucket
+        self.assertGreater(relay.seconds, 0.2)
+        self.assertGreater(relay.throttled, 0.1)
+        self.assertIn('throttled', str(relay))
+
+    def test_TokenBucket_unlimited(self):
+        bucket = btrsnap.TokenBucket(btrsnap.BandwidthSchedule())
+        self.assertEqual(1 << 30, bucket.acquire(1 << 30))
+        relay = self.relay(bucket)
+        self.assertLess(relay.throttled, 0.1)
+
+
 class Test_SnapDeep_Class(unittest.TestCase):
     test_dir = get_test_dir()
     link_dir = os.path.join(test_dir, 'link_dir')
@@ -366,6 +1040,73 @@ class Test_Btrfs_Class(unittest.TestCase):
         btrfs = btrsnap.Btrfs(snap_dir)
         self.assertRaises(btrsnap.BtrfsError, btrfs.unsnap, bogus)
 
+    def test_Btrfs_unsnap_many(self):
+        snap_dir = self.snap_dir
+        snap_names = ['test{}'.format(number) for number in range(5)]
+        for snap_name in snap_names:
+            subprocess.call(['btrfs', 'subvolume', 'create',
+                             os.path.join(snap_dir, snap_name)])
+
+        btrfs = btrsnap.Btrfs(snap_dir)
+        btrfs.unsnap_many(snap_names, commit='after')
+
+        for snap_name in snap_names:
+            self.assertFalse(os.path.isdir(os.path.join(snap_dir, snap_name)))
+
+    def test_Btrfs_unsnap_many_Exception(self):
+        snap_dir = self.snap_dir
+        snap_name = 'test'
+        bogus = 'bogus_dir'
+        subprocess.call(['btrfs', 'subvolume', 'create',
+                         os.path.join(snap_dir, snap_name)])
+
+        btrfs = btrsnap.Btrfs(snap_dir)
+        with self.assertRaises(btrsnap.BtrfsError) as context:
+            btrfs.unsnap_many([bogus, snap_name])
+        self.assertIn(bogus, str(context.exception),
+                      'failed snapshots should be listed')
+        self.assertNotIn(snap_name + ',', str(context.exception))
+        self.assertFalse(os.path.isdir(os.path.join(snap_dir, snap_name)))
+
+
+class Test_Startup_Class(unittest.TestCase):
+
+    def modules(self, code):
+        code = 'import sys, btrsnap; {}; print(" ".join(sys.modules))'.format(
+            code)
+        return subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True).split()
+
+    def test_lazy_imports(self):
+        lazy = ['concurrent.futures', 'dateutil', 'hashlib', 'sqlite3',
+                'tempfile']
+        for module in lazy + ['argparse', 'lzma', 'shutil']:
+            self.assertNotIn(module, self.modules('pass'))
+        # argparse needs shutil, which imports the compression modules
+        for module in lazy:
+            self.assertNotIn(module, self.modules('btrsnap._parser("list")'))
+
+    def test_subcommand(self):
+        self.assertEqual('list', btrsnap._subcommand(['list', '/a']))
+        self.assertEqual('send', btrsnap._subcommand(
+            ['--catalog', 'list', 'send', '/a', '/b']))
+        self.assertEqual('snap', btrsnap._subcommand(
+            ['--catalog=list', 'snap', '/a']))
+        self.assertIsNone(btrsnap._subcommand(['--version']))
+        self.assertIsNone(btrsnap._subcommand(['--catalog']))
+
+    def test_parser(self):
+        args = btrsnap._parser('delete').parse_args(
+            ['--catalog', 'c', 'delete', '-k', '2', '/a'])
+        self.assertEqual([2], args.keep)
+        self.assertRaises(SystemExit, btrsnap._parser('delete').parse_args,
+                          ['list', '/a'])
+        # every subcommand when the one asked for is not known
+        args = btrsnap._parser('nonsense').parse_args(['list', '/a'])
+        self.assertEqual(['/a'], args.snap_path)
+
 
 class Test_functions_(unittest.TestCase):
     test_dir = get_test_dir()
@@ -411,6 +1152,44 @@ class Test_functions_(unittest.TestCase):
         subprocess.call(['btrfs', 'subvolume', 'delete', first])
         subprocess.call(['btrfs', 'subvolume', 'delete', second])
 
+    def test_snap_precise_then_daily(self):
+        snap_dir = self.snap_dir
+
+        self.assertIsNone(btrsnap.snap(snap_dir, readonly=False,
+                                       precise=True))
+        self.assertIsNone(btrsnap.snap(snap_dir, readonly=False))
+        snapshots = btrsnap.Path(snap_dir).snapshots()
+        self.assertEqual(2, len(snapshots))
+        # a daily name would sort before the precise snapshot
+        for snapshot in snapshots:
+            self.assertEqual(len('YYYY-MM-DD-HHMMSS-ffff'), len(snapshot))
+
+        # cleanup
+        for snapshot in snapshots:
+            subprocess.call(['btrfs', 'subvolume', 'delete',
+                             os.path.join(snap_dir, snapshot)])
+
+    def test_snap_concurrent(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        expected = [os.path.join(snap_dir, '{}-{:04d}'.format(timestamp, n))
+                    for n in range(1, 5)]
+
+        threads = [threading.Thread(target=btrsnap.snap, args=(snap_dir,),
+                                    kwargs={'readonly': False})
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for snapshot in expected:
+            self.assertTrue(os.path.isdir(snapshot))
+
+        # cleanup
+        for snapshot in expected:
+            subprocess.call(['btrfs', 'subvolume', 'delete', snapshot])
+
     def test_unsnap_keep(self):
         snap_dir = self.snap_dir
         link_dir = self.link_dir
@@ -421,7 +1200,9 @@ class Test_functions_(unittest.TestCase):
         subprocess.call(['btrfs', 'subvolume', 'snap', link_dir, first])
         subprocess.call(['btrfs', 'subvolume', 'snap', link_dir, second])
 
-        btrsnap.unsnap(snap_dir, keep=1)
+        msg = btrsnap.unsnap(snap_dir, keep=1)
+        self.assertEqual('Deleted 1 snapshot(s) from "{}". 1 kept'
+                         .format(snap_dir), msg)
         self.assertFalse(os.path.isdir(first))
         self.assertTrue(os.path.isdir(second))
 
@@ -464,14 +1245,90 @@ class Test_functions_(unittest.TestCase):
         subprocess.call(['btrfs', 'subvolume', 'snap', link_dir, first])
         subprocess.call(['btrfs', 'subvolume', 'snap', link_dir, second])
 
-        btrsnap.unsnap(snap_dir, date=relativedelta(days=1))
+        btrsnap.unsnap(snap_dir, date=dates.Period(days=1))
         self.assertTrue(os.path.isdir(first))
         self.assertFalse(os.path.isdir(second))
 
-        btrsnap.unsnap(snap_dir, date=relativedelta(days=0))
+        btrsnap.unsnap(snap_dir, date=dates.Period(days=0))
         self.assertFalse(os.path.isdir(first))
         self.assertFalse(os.path.isdir(second))
 
+    def test_unsnap_free(self):
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        snapshots = [os.path.join(snap_dir, '{}-{:04d}'.format(timestamp, n))
+                     for n in range(1, 4)]
+        for snapshot in snapshots:
+            subprocess.call(['btrfs', 'subvolume', 'snap', link_dir,
+                             snapshot])
+
+        btrsnap.unsnap(snap_dir, free=0)
+        for snapshot in snapshots:
+            self.assertTrue(os.path.isdir(snapshot))
+
+        # the filesystem can never be 100% free, so all but the newest go
+        btrsnap.unsnap(snap_dir, free=100)
+        self.assertFalse(os.path.isdir(snapshots[0]))
+        self.assertFalse(os.path.isdir(snapshots[1]))
+        self.assertTrue(os.path.isdir(snapshots[2]))
+
+        # cleanup
+        btrsnap.unsnap(snap_dir, keep=0)
+
+    def test_unsnap_free_warnings(self):
+        paths = [btrsnap.Path(self.snap_dir), btrsnap.Path(self.receive_dir)]
+        msg = btrsnap.unsnap_free(paths, 100)
+        for path in paths:
+            self.assertIn('free space left for "{}"'.format(path.path), msg)
+
+    def test_unsnap_free_error(self):
+        snap_dir = self.snap_dir
+        timestamp = datetime.date.today().isoformat()
+        snapshots = [os.path.join(snap_dir, '{}-{:04d}'.format(timestamp, n))
+                     for n in range(1, 4)]
+        subprocess.call(['btrfs', 'subvolume', 'snap', self.link_dir,
+                         snapshots[0]])
+        # not a subvolume, and not empty either, so it cannot be deleted
+        os.mkdir(snapshots[1])
+        open(os.path.join(snapshots[1], 'file'), 'w').close()
+        os.mkdir(snapshots[2])
+
+        with self.assertRaises(btrsnap.BtrfsError) as context:
+            btrsnap.unsnap_free([btrsnap.Path(snap_dir)], 100)
+        self.assertIn('Deleted 1 snapshot(s) from "{}"'.format(snap_dir),
+                      str(context.exception))
+        self.assertFalse(os.path.isdir(snapshots[0]))
+
+    def test_unsnap_free_error_in_batch(self):
+        snap_dir = self.snap_dir
+        timestamp = datetime.date.today().isoformat()
+        snapshots = [os.path.join(snap_dir, '{}-{:04d}'.format(timestamp, n))
+                     for n in range(1, 4)]
+        subprocess.call(['btrfs', 'subvolume', 'snap', self.link_dir,
+                         snapshots[0]])
+        os.mkdir(snapshots[1])
+        open(os.path.join(snapshots[1], 'file'), 'w').close()
+        os.mkdir(snapshots[2])
+        db = btrsnap.Catalog(':memory:')
+        removed = []
+        remove = db.remove
+
+        def record(path, names):
+            removed.extend(names)
+            remove(path, names)
+
+        db.remove = record
+        # both deletions are in one batch, and only the second one fails
+        with self.assertRaises(btrsnap.BtrfsError) as context:
+            btrsnap.unsnap_free([btrsnap.Path(snap_dir)], 100, catalog=db,
+                                batch=2)
+        self.assertIn('Deleted 1 snapshot(s) from "{}"'.format(snap_dir),
+                      str(context.exception))
+        self.assertEqual([os.path.basename(snapshots[0])], removed)
+        db.close()
+
     def test_snapdeep(self):
         test_dir = self.test_dir
         snap_dir = self.snap_dir
@@ -485,6 +1342,25 @@ class Test_functions_(unittest.TestCase):
         # cleanup
         subprocess.call(['btrfs', 'subvolume', 'delete', first])
 
+    def test_snapdeep_jobs(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        first = os.path.join(snap_dir, timestamp + '-0001')
+        bad_snap_dir = os.path.join(test_dir, 'bad_snap_dir')
+        os.mkdir(bad_snap_dir)
+        os.symlink(os.path.join(test_dir, 'bogus'),
+                   os.path.join(bad_snap_dir, 'target'))
+
+        output = btrsnap.snap_deep(test_dir, readonly=False, jobs=4)
+        self.assertTrue(os.path.isdir(first))
+        self.assertIn(bad_snap_dir, output,
+                      'failed directories should be reported')
+
+        # cleanup
+        subprocess.call(['btrfs', 'subvolume', 'delete', first])
+
     def test_snapdeep_no_snappaths(self):
         test_dir = self.test_dir
         snap_dir = self.snap_dir
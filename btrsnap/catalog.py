@@ -0,0 +1,264 @@
+'''
+Keeps a record of snapshots in an SQLite database, so directories are only
+read again once they changed. sqlite3 is imported when a catalog is opened.
+'''
+
+import os
+import threading
+import time
+
+try:
+    from .errors import BtrsnapError
+    from .paths import Path, SnapPath, snapshot_key
+except ImportError:
+    from errors import BtrsnapError
+    from paths import Path, SnapPath, snapshot_key
+
+
+class Catalog:
+    '''
+    Optional on-disk record of snapshots, kept in an SQLite database.
+
+    The catalog remembers which snapshots exist in each snapshot
+    directory, when btrsnap created them, the parent they were sent from
+    and where they were replicated to. A directory is only read again when
+    its modification time differs from the one stored with the last scan,
+    so out-of-band changes are still picked up.
+
+    Args:
+        * filename (str): database file, created if it does not exist.
+          ``:memory:`` keeps the catalog in memory for the life of the
+          process, see :mod:`btrsnap.daemon`.
+        * watcher (inotify.Watcher): tells when directories change. A
+          directory is then read again only once it changed, even if its
+          modification time did not, and the targets of snapshot
+          directories are kept in memory, see :meth:`target`. Only useful
+          to a long-running process.
+
+    Attributes:
+        * filename (str): absolute path of the database file.
+        * watcher (inotify.Watcher)
+
+    Raises:
+        * BtrsnapError: the database could not be opened.
+    '''
+    # a directory modified this close to a scan may change again without
+    # its mtime changing, so it is not trusted until it is scanned again
+    racy_seconds = 2
+
+    def __init__(self, filename, watcher=None):
+        if filename != ':memory:':
+            filename = os.path.abspath(os.path.expanduser(filename))
+        self.filename = filename
+        self.watcher = watcher
+        self._lock = threading.Lock()
+        self._stamps = {}
+        self._targets = {}
+        # directory: newest snapshot, filled from the database on first use
+        self._newest = None
+        import sqlite3
+
+        try:
+            self._db = sqlite3.connect(self.filename,
+                                       check_same_thread=False)
+            with self._db:
+                self._db.executescript('''
+                    CREATE TABLE IF NOT EXISTS directories (
+                        path TEXT PRIMARY KEY,
+                        mtime_ns INTEGER);
+                    CREATE TABLE IF NOT EXISTS snapshots (
+                        directory TEXT,
+                        name TEXT,
+                        created REAL,
+                        parent TEXT,
+                        PRIMARY KEY (directory, name));
+                    CREATE TABLE IF NOT EXISTS replicas (
+                        directory TEXT,
+                        name TEXT,
+                        destination TEXT,
+                        PRIMARY KEY (directory, name, destination));
+                    ''')
+        except sqlite3.Error as err:
+            raise BtrsnapError('could not open catalog \'{}\': {}'
+                               .format(self.filename, err))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def reconcile(self, path):
+        '''
+        Bring the catalog entries for PATH in line with the filesystem.
+        With a watcher, nothing is done, not even a stat, while PATH has
+        not changed since the last scan. Without one, or when the watcher
+        cannot tell, PATH is only read if its modification time changed.
+
+        Args:
+            * path (str): absolute path of a snapshot directory.
+
+        Returns:
+            * tuple(list(str), list(str)): snapshots added and removed.
+        '''
+        stamp = None if self.watcher is None else self.watcher.stamp(path)
+        with self._lock:
+            if stamp is not None and self._stamps.get(path) == stamp:
+                return [], []
+            mtime_ns = os.stat(path).st_mtime_ns
+            row = self._db.execute('SELECT mtime_ns FROM directories'
+                                   ' WHERE path = ?', (path,)).fetchone()
+            # the watcher also sees changes the mtime does not show
+            if stamp is None and row is not None and row[0] == mtime_ns:
+                return [], []
+            on_disk = set(Path(path).scan().snapshots)
+            known = set(name for name, in self._db.execute(
+                'SELECT name FROM snapshots WHERE directory = ?', (path,)))
+            added = sorted(on_disk - known)
+            removed = sorted(known - on_disk)
+            if time.time() - mtime_ns / 1e9 < self.racy_seconds:
+                mtime_ns = None
+            with self._db:
+                self._db.executemany('INSERT INTO snapshots (directory, name)'
+                                     ' VALUES (?, ?)',
+                                     ((path, name) for name in added))
+                self._forget(path, removed)
+                self._db.execute('INSERT OR REPLACE INTO directories'
+                                 ' (path, mtime_ns) VALUES (?, ?)',
+                                 (path, mtime_ns))
+            self._added(path, added)
+            self._stamps[path] = stamp
+        return added, removed
+
+    def target(self, path):
+        '''
+        Catalog version of :attr:`paths.SnapPath.target`. With a watcher
+        the target is kept in memory until the snapshot directory changes,
+        otherwise the directory is read every time.
+
+        Args:
+            * path (str): absolute path of a snapshot directory.
+
+        Returns:
+            * str: absolute path the symlink in PATH points to.
+
+        Raises:
+            * TargetError:
+            * PathError:
+        '''
+        stamp = None if self.watcher is None else self.watcher.stamp(path)
+        with self._lock:
+            cached = self._targets.get(path)
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            return cached[1]
+        target = SnapPath(path).target
+        with self._lock:
+            self._targets[path] = (stamp, target)
+        return target
+
+    def snapshots(self, path):
+        '''
+        Catalog version of :meth:`paths.Path.snapshots`.
+
+        Args:
+            * path (str): absolute path of a snapshot directory.
+
+        Returns:
+            * list(str): snapshots in PATH, newest first.
+        '''
+        self.reconcile(path)
+        with self._lock:
+            snapshots = [name for name, in self._db.execute(
+                'SELECT name FROM snapshots WHERE directory = ?', (path,))]
+        snapshots.sort(key=snapshot_key, reverse=True)
+        return snapshots
+
+    def newest(self):
+        '''
+        The newest snapshot of every directory in the catalog, as last
+        recorded. Nothing is read from the filesystem, and the database is
+        only read the first time: the answer is then kept up to date by
+        :meth:`reconcile`, :meth:`add` and :meth:`remove`, so changes made
+        to the database by other processes are not seen.
+
+        Returns:
+            * dict: name of the newest snapshot, by directory.
+        '''
+        with self._lock:
+            if self._newest is None:
+                self._newest = {}
+                rows = self._db.execute('SELECT directory, name'
+                                        ' FROM snapshots')
+                for path, name in rows:
+                    self._added(path, [name])
+            return dict(self._newest)
+
+    def add(self, path, name, parent=None):
+        '''
+        Record a snapshot created or received by btrsnap.
+
+        Args:
+            * path (str): absolute path of the snapshot directory.
+            * name (str): name of the snapshot.
+            * parent (str): snapshot it was sent incrementally from.
+        '''
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO snapshots'
+                             ' (directory, name, created, parent)'
+                             ' VALUES (?, ?, ?, ?)',
+                             (path, name, time.time(), parent))
+            self._added(path, [name])
+
+    def remove(self, path, names):
+        '''
+        Forget snapshots deleted by btrsnap.
+
+        Args:
+            * path (str): absolute path of the snapshot directory.
+            * names (list(str)): names of the deleted snapshots.
+        '''
+        with self._lock, self._db:
+            self._forget(path, names)
+
+    def add_replica(self, path, name, destination):
+        '''
+        Record that a snapshot was sent to another snapshot directory.
+
+        Args:
+            * path (str): absolute path of the sending snapshot directory.
+            * name (str): name of the snapshot.
+            * destination (str): absolute path of the receiving directory.
+        '''
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO replicas'
+                             ' (directory, name, destination)'
+                             ' VALUES (?, ?, ?)', (path, name, destination))
+
+    def replicas(self, path, name):
+        '''
+        Returns:
+            * list(str): directories that snapshot NAME in PATH was sent to.
+        '''
+        with self._lock:
+            return [destination for destination, in self._db.execute(
+                'SELECT destination FROM replicas'
+                ' WHERE directory = ? AND name = ? ORDER BY destination',
+                (path, name))]
+
+    def _added(self, path, names):
+        if self._newest is None or not names:
+            return
+        newest = max(names, key=snapshot_key)
+        if path not in self._newest or \
+                snapshot_key(newest) > snapshot_key(self._newest[path]):
+            self._newest[path] = newest
+
+    def _forget(self, path, names):
+        if self._newest is not None and self._newest.get(path) in names:
+            del self._newest[path]
+        names = [(path, name) for name in names]
+        self._db.executemany('DELETE FROM snapshots'
+                             ' WHERE directory = ? AND name = ?', names)
+        self._db.executemany('DELETE FROM replicas'
+                             ' WHERE directory = ? AND name = ?', names)
+        if self._newest is not None and path not in self._newest:
+            self._added(path, [name for name, in self._db.execute(
+                'SELECT name FROM snapshots WHERE directory = ?', (path,))])
@@ -0,0 +1,97 @@
+'''
+Tests for the snapshot catalog. No btrfs is needed.
+'''
+import unittest
+import os
+import shutil
+import tempfile
+
+import btrsnap
+import catalog
+
+
+class Test_Catalog_Class(unittest.TestCase):
+
+    timestamps = ['2012-01-01-0001',
+                  '2012-01-01-0002',
+                  '2012-02-01-0001',
+                  '2012-02-01-0002']
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.snap_dir = os.path.join(self.test_dir, 'snap_dir')
+        self.receive_dir = os.path.join(self.test_dir, 'receive_dir')
+        self.catalog_file = os.path.join(self.test_dir, 'catalog.sqlite')
+        os.mkdir(self.snap_dir)
+        for folder in self.timestamps:
+            os.mkdir(os.path.join(self.snap_dir, folder))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_Catalog_snapshots(self):
+        snap_dir = self.snap_dir
+        timestamps = sorted(self.timestamps, reverse=True)
+        db = catalog.Catalog(self.catalog_file)
+        self.assertEqual(timestamps, db.snapshots(snap_dir))
+        db.close()
+
+        db = catalog.Catalog(self.catalog_file)
+        self.assertEqual(timestamps, db.snapshots(snap_dir),
+                         'catalog should persist between runs')
+        db.close()
+
+    def test_Catalog_reconcile(self):
+        snap_dir = self.snap_dir
+        db = catalog.Catalog(self.catalog_file)
+        db.snapshots(snap_dir)
+
+        os.mkdir(os.path.join(snap_dir, '2012-03-01-0001'))
+        os.rmdir(os.path.join(snap_dir, '2012-01-01-0001'))
+        added, removed = db.reconcile(snap_dir)
+        self.assertEqual(['2012-03-01-0001'], added)
+        self.assertEqual(['2012-01-01-0001'], removed)
+        self.assertEqual(btrsnap.Path(snap_dir).snapshots(),
+                         db.snapshots(snap_dir))
+        db.close()
+
+    def test_Catalog_replicas(self):
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        db = catalog.Catalog(self.catalog_file)
+        db.add_replica(snap_dir, '2012-01-01-0001', receive_dir)
+        self.assertEqual([receive_dir],
+                         db.replicas(snap_dir, '2012-01-01-0001'))
+
+        db.remove(snap_dir, ['2012-01-01-0001'])
+        self.assertEqual([], db.replicas(snap_dir, '2012-01-01-0001'))
+        db.close()
+
+    def test_Catalog_newest(self):
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        db = catalog.Catalog(':memory:')
+        self.assertEqual({}, db.newest())
+        db.snapshots(snap_dir)
+        db.add(receive_dir, '2012-01-01-0001')
+        db.add(receive_dir, '2012-01-01-120000-0001')
+        self.assertEqual({snap_dir: '2012-02-01-0002',
+                          receive_dir: '2012-01-01-120000-0001'},
+                         db.newest())
+        # nothing is read from disk
+        os.mkdir(os.path.join(snap_dir, '2012-03-01-0001'))
+        self.assertEqual('2012-02-01-0002', db.newest()[snap_dir])
+        # kept up to date by reconcile, add and remove
+        db.snapshots(snap_dir)
+        self.assertEqual('2012-03-01-0001', db.newest()[snap_dir])
+        db.remove(snap_dir, ['2012-03-01-0001', '2012-02-01-0002'])
+        self.assertEqual('2012-02-01-0001', db.newest()[snap_dir])
+        db.remove(receive_dir, ['2012-01-01-0001', '2012-01-01-120000-0001'])
+        self.assertNotIn(receive_dir, db.newest())
+        db.add(receive_dir, '2012-01-02-0001')
+        self.assertEqual('2012-01-02-0001', db.newest()[receive_dir])
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
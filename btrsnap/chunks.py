@@ -0,0 +1,331 @@
+'''
+Content-defined chunking and a content-addressed chunk store, so send
+streams archived with send --to-dir --dedup keep each distinct chunk once.
+'''
+
+import contextlib
+import functools
+import os
+import threading
+import time
+
+try:
+    from . import streams
+    from .errors import BtrsnapError
+except ImportError:
+    import streams
+    from errors import BtrsnapError
+
+
+@functools.lru_cache(maxsize=None)
+def _chunker_table():
+    '''
+    Returns:
+        * bytes: the pseudo-random bit of every byte value, see
+          :class:`Chunker`. Must never change, or stored chunks would no
+          longer match new ones.
+    '''
+    import hashlib
+
+    return bytes(hashlib.sha256(b'btrsnap chunker %d' % byte).digest()[0] & 1
+                 for byte in range(256))
+
+
+class Chunker:
+    '''
+    Splits a stream into content-defined chunks, so that data which is
+    shifted by an insertion or deletion still produces the same chunks.
+
+    Every byte is mapped to a pseudo-random bit by a fixed table, and a
+    chunk ends after :attr:`run` consecutive one bits, but not before
+    :attr:`min_size` bytes and not after :attr:`max_size`. Both steps,
+    :meth:`bytes.translate` and :meth:`bytes.find`, run in C, so chunking
+    costs a few milliseconds per megabyte. Chunks average about 64 KiB on
+    random data.
+    '''
+    min_size = 16 << 10
+    max_size = 256 << 10
+    run = 14
+    block_size = 4 << 20
+
+    def split(self, data, final=True):
+        '''
+        Args:
+            * data (bytes): data to split.
+            * final (bool): DATA is the end of the stream. Otherwise a
+              trailing part that might continue in the next block is
+              returned instead of being cut.
+
+        Returns:
+            * tuple: (list of memoryview chunks, bytes left over).
+        '''
+        bits = data.translate(_chunker_table())
+        marker = b'\x01' * self.run
+        view = memoryview(data)
+        chunks = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            limit = pos + self.max_size
+            found = bits.find(marker, pos + self.min_size - self.run,
+                              min(limit, end))
+            if found >= 0:
+                cut = found + self.run
+            elif limit <= end or final:
+                cut = min(limit, end)
+            else:
+                break
+            chunks.append(view[pos:cut])
+            pos = cut
+        return chunks, data[pos:]
+
+    def chunks(self, fd):
+        '''
+        Read FD to the end.
+
+        Yields:
+            * memoryview: consecutive chunks of the stream.
+        '''
+        rest = b''
+        while True:
+            block = streams.read_exactly(fd, self.block_size)
+            chunks, rest = self.split(rest + block, final=not block)
+            yield from chunks
+            if not block:
+                return
+
+
+class ChunkStore:
+    '''
+    Content-addressed store of compressed chunks. Each chunk is kept once,
+    in a file named after the hex SHA-256 of its contents in a
+    subdirectory named after the first two hex digits. A file holds one
+    byte, ``z`` for zlib compressed or ``r`` when compression did not help,
+    followed by the data.
+
+    Chunk files are written under temporary names and renamed into place,
+    so writing the same chunk twice at once is harmless. New chunk files
+    are flushed to disk in batches by :meth:`sync`.
+
+    Args:
+        * path (str): directory of the store, created if needed.
+    '''
+    # of SHA-256
+    digest_size = 32
+    level = 1
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def filename(self, digest):
+        name = digest.hex()
+        return os.path.join(self.path, name[:2], name)
+
+    def has(self, digest):
+        return os.path.exists(self.filename(digest))
+
+    def put(self, digest, data):
+        '''
+        Store a chunk unless it is already there.
+
+        Args:
+            * digest (bytes): SHA-256 of DATA.
+            * data (bytes): chunk.
+
+        Returns:
+            * int: bytes written, 0 if the chunk was already stored.
+        '''
+        import tempfile
+        import zlib
+
+        filename = self.filename(digest)
+        if os.path.exists(filename):
+            return 0
+        packed = zlib.compress(data, self.level)
+        packed = b'z' + packed if len(packed) < len(data) else b'r' + data
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=directory, prefix='.')
+        try:
+            streams.write_all(fd, packed)
+        finally:
+            os.close(fd)
+        os.rename(partial, filename)
+        with self._lock:
+            self._pending.append(filename)
+        return len(packed)
+
+    def get(self, digest):
+        '''
+        Args:
+            * digest (bytes): SHA-256 of the chunk.
+
+        Returns:
+            * bytes: the chunk.
+
+        Raises:
+            * BtrsnapError: the chunk is missing or corrupt.
+        '''
+        import hashlib
+        import zlib
+
+        try:
+            with open(self.filename(digest), 'rb') as f:
+                packed = f.read()
+        except FileNotFoundError:
+            raise BtrsnapError('chunk {} is missing from \'{}\''
+                               .format(digest.hex(), self.path))
+        data = zlib.decompress(packed[1:]) if packed[:1] == b'z' \
+            else packed[1:]
+        if hashlib.sha256(data).digest() != digest:
+            raise BtrsnapError('chunk {} in \'{}\' is corrupt'
+                               .format(digest.hex(), self.path))
+        return data
+
+    def sync(self):
+        '''
+        Flush the chunk files written since the last call to disk.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for filename in pending:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+            finally:
+                os.close(fd)
+        for directory in set(os.path.dirname(f) for f in pending):
+            streams.sync_directory(directory)
+
+    @contextlib.contextmanager
+    def reader(self, index, length):
+        '''
+        Rebuild a stream from the chunks listed in INDEX, written by
+        :class:`Deduplicator`. The chunks are fed into a pipe from a
+        thread, so only one is held in memory at a time.
+
+        Args:
+            * index (str): path of the chunk index of the stream.
+            * length (int): expected length of the stream in bytes.
+
+        Yields:
+            * int: file descriptor the stream can be read from.
+
+        Raises:
+            * BtrsnapError: the index or a chunk is missing or corrupt.
+        '''
+        if not os.path.isfile(index) or \
+                os.path.getsize(index) % self.digest_size:
+            raise BtrsnapError('chunk index \'{}\' is missing or truncated'
+                               .format(index))
+        read_fd, write_fd = os.pipe()
+        streams.set_pipe_size(write_fd, 1 << 20)
+        errors = []
+
+        def writer():
+            written = 0
+            try:
+                with open(index, 'rb') as f:
+                    for digest in iter(lambda: f.read(self.digest_size), b''):
+                        data = self.get(digest)
+                        streams.write_all(write_fd, data)
+                        written += len(data)
+                if written != length:
+                    raise BtrsnapError('stream rebuilt from \'{}\' has {}'
+                                       ' bytes, expected {}'
+                                       .format(index, written, length))
+            except BrokenPipeError:
+                pass
+            except Exception as err:
+                errors.append(err)
+            finally:
+                os.close(write_fd)
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        try:
+            yield read_fd
+        finally:
+            os.close(read_fd)
+            thread.join()
+            if errors:
+                raise errors[0]
+
+
+class Deduplicator:
+    '''
+    Splits a stream into chunks with a :class:`Chunker`, adds the chunks
+    to a :class:`ChunkStore` and writes the SHA-256 of each chunk, in
+    order, to an index. Chunks are hashed and compressed on a pool of
+    threads, at most two chunks per thread in flight.
+
+    Args:
+        * source (int): file descriptor to read the stream from.
+        * store (ChunkStore): store to add the chunks to.
+        * index (int): file descriptor to write the chunk index to.
+        * jobs (int): number of chunks hashed and compressed at the same
+          time.
+
+    Attributes:
+        * bytes_in (int): stream bytes read.
+        * bytes_out (int): bytes written to new chunk files.
+        * chunks (int): chunks in the stream.
+        * new_chunks (int): chunks that were not in the store yet.
+        * seconds (float): duration.
+    '''
+    sync_size = 256 << 20
+
+    def __init__(self, source, store, index, jobs=1):
+        if not isinstance(jobs, int) or jobs < 1:
+            raise BtrsnapError('jobs must be a positive integer')
+        self.source = source
+        self.store = store
+        self.index = index
+        self.jobs = jobs
+        self.chunker = Chunker()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.chunks = 0
+        self.new_chunks = 0
+        self.seconds = 0.0
+        self._unsynced = 0
+
+    def __str__(self):
+        return '{} in {} chunks, {} new ({}) in {:.1f}s'.format(
+            streams.human_bytes(self.bytes_in), self.chunks, self.new_chunks,
+            streams.human_bytes(self.bytes_out), self.seconds)
+
+    def run(self):
+        '''
+        Store the stream until its end, then flush the new chunks to disk.
+        '''
+        import hashlib
+
+        start = time.monotonic()
+
+        def work(chunk):
+            digest = hashlib.sha256(chunk).digest()
+            return digest, len(chunk), self.store.put(digest, chunk)
+
+        try:
+            streams.ordered_map(work, self.chunker.chunks(self.source),
+                                self.jobs, self._output)
+            self.store.sync()
+        finally:
+            self.seconds = time.monotonic() - start
+
+    def _output(self, result):
+        digest, length, stored = result
+        streams.write_all(self.index, digest)
+        self.bytes_in += length
+        self.chunks += 1
+        if stored:
+            self.new_chunks += 1
+            self.bytes_out += stored
+            self._unsynced += stored
+            if self._unsynced >= self.sync_size:
+                self.store.sync()
+                self._unsynced = 0
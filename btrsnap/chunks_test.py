@@ -0,0 +1,56 @@
+'''
+Tests for content-defined chunking. No btrfs is needed.
+'''
+import unittest
+import os
+import threading
+import hashlib
+
+import chunks
+
+
+class Test_Chunker_Class(unittest.TestCase):
+
+    data = os.urandom(4 * 1024 * 1024)
+
+    def digests(self, data):
+        pieces, rest = chunks.Chunker().split(data)
+        self.assertEqual(b'', rest)
+        self.assertEqual(data, b''.join(pieces))
+        return [hashlib.sha256(chunk).digest() for chunk in pieces]
+
+    def test_Chunker_sizes(self):
+        chunker = chunks.Chunker()
+        pieces, rest = chunker.split(self.data)
+        for chunk in pieces[:-1]:
+            self.assertGreaterEqual(len(chunk), chunker.min_size)
+            self.assertLessEqual(len(chunk), chunker.max_size)
+        pieces, rest = chunker.split(bytes(1024 * 1024))
+        self.assertEqual([chunker.max_size] * 4, [len(c) for c in pieces])
+
+    def test_Chunker_content_defined(self):
+        original = self.digests(self.data)
+        shifted = self.digests(b'inserted' + self.data)
+        self.assertNotEqual(original[0], shifted[0])
+        self.assertGreater(len(set(original) & set(shifted)),
+                           len(original) - 3)
+
+    def test_Chunker_blocks(self):
+        chunker = chunks.Chunker()
+        chunker.block_size = 100000
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as source:
+            thread = threading.Thread(target=self.feed, args=(write_fd,))
+            thread.start()
+            digests = [hashlib.sha256(chunk).digest()
+                       for chunk in chunker.chunks(source.fileno())]
+            thread.join()
+        self.assertEqual(self.digests(self.data), digests)
+
+    def feed(self, fd):
+        with open(fd, 'wb') as sink:
+            sink.write(self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+'''
+Compresses btrfs send streams into the btrsnap framed format, and back,
+on several CPUs. Used by the compress and decompress subcommands and by
+send --compress. The codec modules are imported on first use.
+'''
+
+import collections
+import contextlib
+import importlib
+import os
+import struct
+import threading
+import time
+
+try:
+    from . import streams
+    from .errors import BtrsnapError
+except ImportError:
+    import streams
+    from errors import BtrsnapError
+
+# codec name: (id in the stream header, module, name and default of its
+# compression level argument), see _codec
+CODECS = collections.OrderedDict([
+    ('zlib', (1, 'zlib', 'level', 6)),
+    ('bz2', (2, 'bz2', 'compresslevel', 9)),
+    ('lzma', (3, 'lzma', 'preset', None)),
+    ])
+STREAM_MAGIC = b'BTRSNAP1'
+# frame header: compressed length, uncompressed length
+FRAME = struct.Struct('>II')
+
+
+def _codec(name):
+    '''
+    Args:
+        * name (str): one of :data:`CODECS`.
+
+    Returns:
+        * tuple: (id, compress(data, level), decompress(data)), the module
+          of the codec is imported on first use.
+    '''
+    codec_id, module, keyword, default = CODECS[name]
+    module = importlib.import_module(module)
+
+    def compress(data, level):
+        return module.compress(data, **{
+            keyword: default if level is None else level})
+    return codec_id, compress, module.decompress
+
+
+class Compressor:
+    '''
+    Compresses a stream, for example the output of btrfs send, into the
+    btrsnap framed format. The input is cut into chunks that are
+    compressed independently on a pool of threads, so more than one core
+    is used. At most two chunks per thread are held in memory.
+
+    The output starts with the 8 byte magic ``BTRSNAP1`` and a one byte
+    codec id, followed by frames of a 4 byte compressed length, a 4 byte
+    uncompressed length and the compressed data, all big-endian. A frame
+    with both lengths zero ends the stream.
+
+    Args:
+        * source (int): file descriptor to read from.
+        * sink (int): file descriptor to write to.
+        * codec (str): one of :data:`CODECS`, zlib, bz2 or lzma.
+        * level (int): compression level, None for the codec default.
+        * jobs (int): number of chunks compressed at the same time.
+
+    Attributes:
+        * bytes_in (int): uncompressed bytes read.
+        * bytes_out (int): bytes written, including framing.
+        * seconds (float): duration.
+
+    Raises:
+        * BtrsnapError: unknown codec.
+    '''
+    chunk_size = 4 << 20
+
+    def __init__(self, source, sink, codec='zlib', level=None, jobs=1):
+        if codec not in CODECS:
+            raise BtrsnapError('unknown codec \'{}\', choose one of {}'
+                               .format(codec, ', '.join(CODECS)))
+        if not isinstance(jobs, int) or jobs < 1:
+            raise BtrsnapError('jobs must be a positive integer')
+        self.source = source
+        self.sink = sink
+        self.codec = codec
+        self.level = level
+        self.jobs = jobs
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return _summary(self, 'compressed')
+
+    def run(self):
+        '''
+        Compress until the end of the source stream.
+        '''
+        start = time.monotonic()
+        codec_id, compress = _codec(self.codec)[:2]
+        self._write(STREAM_MAGIC + bytes([codec_id]))
+
+        def work(data):
+            return compress(data, self.level), len(data)
+
+        try:
+            streams.ordered_map(work, self._chunks(), self.jobs, self._frame)
+            self._write(FRAME.pack(0, 0))
+        finally:
+            self.seconds = time.monotonic() - start
+
+    def _chunks(self):
+        while True:
+            data = streams.read_exactly(self.source, self.chunk_size)
+            if not data:
+                return
+            self.bytes_in += len(data)
+            yield data
+
+    def _frame(self, result):
+        data, length = result
+        self._write(FRAME.pack(len(data), length) + data)
+
+    def _write(self, data):
+        streams.write_all(self.sink, data)
+        self.bytes_out += len(data)
+
+
+class Decompressor:
+    '''
+    Reverses :class:`Compressor`. Frames are decompressed on a pool of
+    threads and written out in order.
+
+    Args:
+        * source (int): file descriptor to read the framed stream from.
+        * sink (int): file descriptor to write the original stream to.
+        * jobs (int): number of frames decompressed at the same time.
+
+    Attributes:
+        * bytes_in (int): framed bytes read.
+        * bytes_out (int): uncompressed bytes written.
+        * seconds (float): duration.
+
+    Raises:
+        * BtrsnapError: the stream is not in the btrsnap framed format.
+    '''
+    def __init__(self, source, sink, jobs=1):
+        if not isinstance(jobs, int) or jobs < 1:
+            raise BtrsnapError('jobs must be a positive integer')
+        self.source = source
+        self.sink = sink
+        self.jobs = jobs
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return _summary(self, 'decompressed')
+
+    def run(self):
+        '''
+        Decompress until the end of the framed stream.
+        '''
+        start = time.monotonic()
+        try:
+            header = self._read(len(STREAM_MAGIC) + 1)
+            if len(header) != len(STREAM_MAGIC) + 1 or \
+                    header[:len(STREAM_MAGIC)] != STREAM_MAGIC:
+                raise BtrsnapError('not a compressed btrsnap stream')
+            codecs = dict((codec[0], name) for name, codec in CODECS.items())
+            if header[-1] not in codecs:
+                raise BtrsnapError('unknown codec id {} in compressed stream'
+                                   .format(header[-1]))
+            decompress = _codec(codecs[header[-1]])[2]
+
+            def work(frame):
+                data = decompress(frame[0])
+                if len(data) != frame[1]:
+                    raise BtrsnapError('corrupt frame in compressed stream')
+                return data
+
+            streams.ordered_map(work, self._frames(), self.jobs, self._output)
+        finally:
+            self.seconds = time.monotonic() - start
+
+    def _frames(self):
+        while True:
+            header = self._read(FRAME.size)
+            if len(header) != FRAME.size:
+                raise BtrsnapError('compressed stream ended unexpectedly')
+            size, length = FRAME.unpack(header)
+            if not size and not length:
+                return
+            data = self._read(size)
+            if len(data) != size:
+                raise BtrsnapError('compressed stream ended unexpectedly')
+            yield data, length
+
+    def _read(self, size):
+        data = streams.read_exactly(self.source, size)
+        self.bytes_in += len(data)
+        return data
+
+    def _output(self, data):
+        streams.write_all(self.sink, data)
+        self.bytes_out += len(data)
+
+
+def parse(string):
+    '''
+    Args:
+        * string (str): ALGO[:LEVEL], one of :data:`CODECS` and an optional
+          compression level, for example ``zlib`` or ``lzma:6``.
+
+    Returns:
+        * tuple: (codec, level), level is None for the codec default.
+
+    Raises:
+        * BtrsnapError: unknown codec, or a level the codec does not take.
+    '''
+    codec, colon, level = string.partition(':')
+    if codec not in CODECS:
+        raise BtrsnapError('unknown codec \'{}\', choose one of {}'
+                           .format(codec, ', '.join(CODECS)))
+    if not colon:
+        return codec, None
+    try:
+        level = int(level)
+        # let the codec tell which levels it takes, each raises its own
+        # error type
+        _codec(codec)[1](b'', level)
+    except Exception:
+        raise BtrsnapError('\'{}\' is not a compression level of {}'
+                           .format(level, codec))
+    return codec, level
+
+
+@contextlib.contextmanager
+def pipe_from(stage):
+    '''
+    Run a :class:`Compressor` or :class:`Decompressor` in a thread that
+    writes its output into a pipe.
+
+    Args:
+        * stage (callable): called with the write end of the pipe, returns
+          the stage to run.
+
+    Yields:
+        * tuple: (int, stage) the read end of the pipe, and the stage.
+
+    Raises:
+        * BtrsnapError: the stage failed.
+    '''
+    read_fd, write_fd = os.pipe()
+    streams.set_pipe_size(write_fd, 1 << 20)
+    errors = []
+    try:
+        stage = stage(write_fd)
+    except BaseException:
+        os.close(read_fd)
+        os.close(write_fd)
+        raise
+
+    def run():
+        try:
+            stage.run()
+        except BrokenPipeError:
+            # the reader stopped early and reports why
+            pass
+        except Exception as err:
+            errors.append(err)
+        finally:
+            os.close(write_fd)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield read_fd, stage
+    finally:
+        os.close(read_fd)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+
+def _summary(stage, verb):
+    ratio = stage.bytes_out / stage.bytes_in if stage.bytes_in else 0.0
+    return '{} {} to {} ({:.0%}) in {:.1f}s'.format(
+        verb, streams.human_bytes(stage.bytes_in),
+        streams.human_bytes(stage.bytes_out), ratio, stage.seconds)
@@ -0,0 +1,92 @@
+'''
+Tests for compressed streams. No btrfs is needed.
+'''
+import unittest
+import os
+import shutil
+import tempfile
+
+import btrsnap
+import compression
+
+
+class Test_Compressor_Class(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.test_dir, 'source')
+        self.compressed = os.path.join(self.test_dir, 'compressed')
+        self.destination = os.path.join(self.test_dir, 'destination')
+        with open(self.source, 'wb') as f:
+            for number in range(300000):
+                f.write('line {}\n'.format(number).encode())
+            f.write(os.urandom(100000))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def round_trip(self, codec, jobs):
+        with open(self.source, 'rb') as source:
+            with open(self.compressed, 'wb') as sink:
+                compressor = compression.Compressor(source.fileno(),
+                                                    sink.fileno(),
+                                                    codec=codec, jobs=jobs)
+                compressor.chunk_size = 1 << 20
+                compressor.run()
+        with open(self.compressed, 'rb') as source:
+            with open(self.destination, 'wb') as sink:
+                decompressor = compression.Decompressor(source.fileno(),
+                                                        sink.fileno(),
+                                                        jobs=jobs)
+                decompressor.run()
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(expected, f.read())
+        self.assertEqual(len(expected), compressor.bytes_in)
+        self.assertEqual(os.path.getsize(self.compressed),
+                         compressor.bytes_out)
+        self.assertLess(compressor.bytes_out, compressor.bytes_in)
+
+    def test_Compressor_round_trip(self):
+        for codec in compression.CODECS:
+            self.round_trip(codec, jobs=1)
+
+    def test_Compressor_round_trip_parallel(self):
+        self.round_trip('zlib', jobs=4)
+
+    def test_Compressor_unknown_codec(self):
+        self.assertRaises(btrsnap.BtrsnapError, compression.Compressor, 0, 1,
+                          codec='rar')
+
+    def test_parse(self):
+        self.assertEqual(('zlib', None), compression.parse('zlib'))
+        self.assertEqual(('lzma', 6), compression.parse('lzma:6'))
+        for string in ('rar', 'zlib:', 'zlib:x', 'zlib:10', 'bz2:0'):
+            self.assertRaises(btrsnap.BtrsnapError, compression.parse,
+                              string)
+
+    def test_Decompressor_not_compressed(self):
+        with open(self.source, 'rb') as source:
+            with open(self.destination, 'wb') as sink:
+                decompressor = compression.Decompressor(source.fileno(),
+                                                        sink.fileno())
+                self.assertRaises(btrsnap.BtrsnapError, decompressor.run)
+
+    def test_pipe_from(self):
+        with open(self.source, 'rb') as source:
+            with compression.pipe_from(lambda sink: compression.Compressor(
+                    source.fileno(), sink)) as (read_fd, stage):
+                with open(self.destination, 'wb') as sink:
+                    decompressor = compression.Decompressor(read_fd,
+                                                            sink.fileno())
+                    decompressor.run()
+        with open(self.source, 'rb') as f:
+            expected = f.read()
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(expected, f.read())
+        self.assertEqual(len(expected), stage.bytes_in)
+
+
+if __name__ == '__main__':
+    unittest.main()
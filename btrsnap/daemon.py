@@ -0,0 +1,623 @@
+'''
+Runs btrsnap commands on a schedule from one long-running process.
+
+A schedule file holds one job per line: how often to run it, then a btrsnap
+command line without the program name::
+
+    # every  command
+    15m      snap -r --if-changed -k 96 /snapshots
+    1h       send -r -j 2 /snapshots /mnt/backup/snapshots
+    1d       delete -r --keep-daily 30 /mnt/backup/snapshots
+
+Blank lines and everything after a ``#`` are ignored.
+
+With a control socket the daemon answers requests on a Unix domain socket,
+one JSON object per line in each direction::
+
+    {"request": "status"}
+    {"request": "trigger", "command": "snap", "path": "/snapshots"}
+
+A status reply holds every job, the number of jobs running and waiting,
+the newest snapshot of every directory, the deletions and transfers in
+progress. It is built from the state kept in memory, so it never waits on
+btrfs. A trigger makes the jobs running COMMAND, on PATH if given, due at
+once.
+'''
+
+import copy
+import datetime
+import io
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+try:
+    from . import btrsnap, inotify
+    from .catalog import Catalog
+except ImportError:
+    import btrsnap
+    import inotify
+    from catalog import Catalog
+
+INTERVAL_PATTERN = re.compile(r'(\d+)([smhdw])')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# subcommands that make sense without a terminal
+COMMANDS = ('snap', 'delete', 'send', 'restore')
+
+
+def parse_interval(string):
+    '''
+    Args:
+        * string (str): a number of seconds, minutes, hours, days or weeks
+          such as ``90s``, ``15m``, ``1h30m`` or ``1w``.
+
+    Returns:
+        * int: seconds.
+
+    Raises:
+        * BtrsnapError: STRING is not an interval.
+    '''
+    parts = INTERVAL_PATTERN.findall(string.lower())
+    seconds = sum(int(count) * UNITS[unit] for count, unit in parts)
+    if ''.join(count + unit for count, unit in parts) != string.lower() \
+            or not seconds:
+        raise btrsnap.BtrsnapError('invalid interval \'{}\', expected for'
+                                   ' example 30s, 15m, 1h or 1d'
+                                   .format(string))
+    return seconds
+
+
+class Job:
+    '''
+    One line of a schedule.
+
+    Args:
+        * every (float): seconds between the starts of two runs.
+        * argv (list(str)): btrsnap command line without the program name.
+        * args (argparse.Namespace): ARGV parsed by :func:`btrsnap._parser`.
+
+    Attributes:
+        * paths (list(str)): local directories the job works on.
+        * next_run (float): clock time the job is due, set by
+          :class:`Scheduler`.
+        * running (bool): a run has started and not finished yet.
+        * started (datetime.datetime): start of the run in progress.
+        * runs (int): finished runs.
+        * failures (int): finished runs that reported an error.
+        * last_start (datetime.datetime): start of the last finished run.
+        * last_seconds (float): how long it took.
+        * last_output (str): what it printed.
+        * last_failed (bool): whether it reported an error.
+    '''
+
+    def __init__(self, every, argv, args):
+        self.every = every
+        self.argv = list(argv)
+        self.args = args
+        self.paths = _job_paths(args)
+        self.next_run = None
+        self.running = False
+        self.started = None
+        self.runs = 0
+        self.failures = 0
+        self.last_start = None
+        self.last_seconds = None
+        self.last_output = ''
+        self.last_failed = False
+
+    def __str__(self):
+        return ' '.join(shlex.quote(arg) for arg in self.argv)
+
+    def conflicts(self, other):
+        '''
+        Returns:
+            * bool: this job and OTHER work on the same directory, or one
+              works inside a directory of the other, so they must not run
+              at the same time.
+        '''
+        return any(_nested(path, other_path) for path in self.paths
+                   for other_path in other.paths)
+
+    def run(self, catalog=None):
+        '''
+        Run the command once and record the result.
+
+        Args:
+            * catalog (Catalog): catalog to use if the command line does not
+              name one.
+        '''
+        args = copy.copy(self.args)
+        args.output = io.StringIO()
+        args.failed = False
+        if args.catalog is None:
+            args.catalog = catalog
+        start = self.started = datetime.datetime.now()
+        started = time.monotonic()
+        try:
+            args.func(args)
+        except SystemExit:
+            # argparse rejected the combination of options
+            args.failed = True
+        self.last_start = start
+        self.last_seconds = time.monotonic() - started
+        self.last_output = args.output.getvalue()
+        self.last_failed = args.failed
+        self.runs += 1
+        self.failures += args.failed
+
+    def status(self, now):
+        '''
+        Returns:
+            * dict: state of the job at clock time NOW, for JSON.
+        '''
+        return {
+            'command': str(self),
+            'every': self.every,
+            'running': self.running,
+            'started': _isoformat(self.started) if self.running else None,
+            'next_run': round(max(self.next_run - now, 0), 1),
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_start': _isoformat(self.last_start),
+            'last_seconds': None if self.last_seconds is None else
+            round(self.last_seconds, 1),
+            'last_failed': self.last_failed,
+        }
+
+
+def _isoformat(moment):
+    return None if moment is None else moment.isoformat(timespec='seconds')
+
+
+def _job_paths(args):
+    paths = []
+    for name in ('snap_path', 'send_path', 'archive_path'):
+        paths.extend(getattr(args, name, None) or [])
+    if not getattr(args, 'transport', None):
+        # with a transport they are on another machine
+        paths.extend(getattr(args, 'receive_path', None) or [])
+    return [os.path.realpath(path) for path in paths]
+
+
+def _nested(path, other):
+    return path == other or path.startswith(other.rstrip('/') + '/') or \
+        other.startswith(path.rstrip('/') + '/')
+
+
+def load_schedule(filename):
+    '''
+    Read a schedule file, see :mod:`btrsnap.daemon`. Every command line is
+    checked by the btrsnap command line parser before anything runs.
+
+    Args:
+        * filename (str)
+
+    Returns:
+        * list(Job): in the order of the file.
+
+    Raises:
+        * BtrsnapError: the file cannot be read, or a line is not valid.
+    '''
+    parser = btrsnap._parser()
+    jobs = []
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError as err:
+        raise btrsnap.BtrsnapError('cannot read schedule \'{}\': {}'
+                                   .format(filename, err.strerror))
+    for number, line in enumerate(lines, 1):
+        where = '{}:{}'.format(filename, number)
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError as err:
+            raise btrsnap.BtrsnapError('{}: {}'.format(where, err))
+        if not fields:
+            continue
+        if len(fields) < 2 or fields[1] not in COMMANDS:
+            raise btrsnap.BtrsnapError('{}: expected an interval and one of'
+                                       ' the commands {}'.format(
+                                           where, ', '.join(COMMANDS)))
+        try:
+            every = parse_interval(fields[0])
+        except btrsnap.BtrsnapError as err:
+            raise btrsnap.BtrsnapError('{}: {}'.format(where, err))
+        try:
+            args = parser.parse_args(fields[1:])
+        except SystemExit:
+            raise btrsnap.BtrsnapError('{}: invalid command \'{}\''.format(
+                where, ' '.join(fields[1:])))
+        jobs.append(Job(every, fields[1:], args))
+    return jobs
+
+
+class Scheduler:
+    '''
+    Runs JOBS at their cadence from one process, so Python starts and
+    imports once, and the state of snapshot directories is kept between
+    runs in a :class:`Catalog` that only reads a directory again once an
+    :class:`inotify.Watcher` reports a change.
+
+    A job is started when it is due, unless
+
+    * it is still running: a run that takes longer than its interval delays
+      the next one, runs never pile up,
+    * MAX_JOBS jobs are running already, or
+    * a running job works on the same directory, or one inside it or
+      around it. It then starts as soon as that job finishes.
+
+    The number of subdirectories a job works on at once is set with the
+    ``-j`` option of its command line, as on the command line.
+
+    Args:
+        * jobs (list(Job)): see :func:`load_schedule`.
+        * max_jobs (int): jobs running at the same time.
+        * catalog (Catalog): for jobs that do not name one. Defaults to a
+          catalog kept in memory. A catalog without a watcher is given
+          one.
+        * clock (callable): returns the current time in seconds.
+    '''
+
+    def __init__(self, jobs, max_jobs=1, catalog=None, clock=time.monotonic):
+        if not isinstance(max_jobs, int) or max_jobs < 1:
+            raise btrsnap.BtrsnapError('max_jobs must be a positive integer')
+        self.jobs = list(jobs)
+        self.max_jobs = max_jobs
+        self.catalog = catalog if catalog is not None else \
+            Catalog(':memory:')
+        if isinstance(self.catalog, Catalog) and \
+                self.catalog.watcher is None:
+            self.catalog.watcher = inotify.Watcher()
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._print_lock = threading.Lock()
+        self._stopping = False
+        self._threads = []
+        now = clock()
+        for job in self.jobs:
+            job.next_run = now
+
+    def due(self, now):
+        '''
+        Returns:
+            * list(Job): jobs to start at NOW, most overdue first.
+        '''
+        busy = [job for job in self.jobs if job.running]
+        start = []
+        for job in sorted(self.jobs, key=lambda job: job.next_run):
+            if len(busy) >= self.max_jobs:
+                break
+            if job.running or job.next_run > now:
+                continue
+            if any(job.conflicts(other) for other in busy):
+                continue
+            busy.append(job)
+            start.append(job)
+        return start
+
+    def start(self, job, now):
+        '''
+        Run JOB in a thread of its own and work out when it is due next.
+        Runs missed while it waited are skipped.
+        '''
+        job.running = True
+        job.next_run += job.every
+        if job.next_run <= now:
+            job.next_run = now + job.every
+        thread = threading.Thread(target=self._run, args=(job,))
+        self._threads.append(thread)
+        thread.start()
+
+    def _run(self, job):
+        try:
+            job.run(self.catalog)
+        finally:
+            with self._condition:
+                job.running = False
+                self._condition.notify_all()
+        self.report(job)
+
+    def report(self, job):
+        '''
+        Print the result of the last run of JOB.
+        '''
+        lines = ['{:%Y-%m-%d %H:%M:%S} {}: {} in {:.1f}s'.format(
+            job.last_start, job, 'failed' if job.last_failed else 'done',
+            job.last_seconds)]
+        lines.extend('\t' + line for line in job.last_output.splitlines()
+                     if line.strip())
+        with self._print_lock:
+            print('\n'.join(lines), flush=True)
+
+    def run(self):
+        '''
+        Run jobs until :meth:`stop` is called, then wait for the running
+        ones to finish.
+        '''
+        with self._condition:
+            while not self._stopping:
+                now = self._clock()
+                for job in self.due(now):
+                    self.start(job, now)
+                # jobs held back by a running one wait for it to notify
+                waiting = [job.next_run for job in self.jobs
+                           if not job.running and job.next_run > now]
+                timeout = min(waiting) - now if waiting else None
+                self._condition.wait(timeout)
+            while any(job.running for job in self.jobs):
+                self._condition.wait()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def status(self):
+        '''
+        State of the scheduler, from memory only.
+
+        Returns:
+            * dict: ``jobs``, the state of every job, see :meth:`Job.status`,
+              ``queue``, the number of jobs ``running`` and of due jobs
+              ``waiting`` for a slot or a directory, ``snapshots``, the
+              newest snapshot of every directory in the catalog,
+              ``deletions`` and ``transfers`` in progress, see
+              :class:`btrsnap.Activity`.
+        '''
+        with self._condition:
+            now = self._clock()
+            jobs = [job.status(now) for job in self.jobs]
+            waiting = sum(1 for job in self.jobs
+                          if not job.running and job.next_run <= now)
+        return {
+            'jobs': jobs,
+            'queue': {
+                'running': sum(1 for job in jobs if job['running']),
+                'waiting': waiting,
+                'max_jobs': self.max_jobs,
+            },
+            'snapshots': self.catalog.newest(),
+            'deletions': btrsnap.activity.deletions(),
+            'transfers': btrsnap.activity.transfers(),
+        }
+
+    def trigger(self, command, path=None):
+        '''
+        Make the jobs running COMMAND due now. A job that is running
+        already runs again once it finishes.
+
+        Args:
+            * command (str): one of :data:`COMMANDS`.
+            * path (str): only jobs working on PATH, or on a directory
+              around it.
+
+        Returns:
+            * list(Job): the jobs triggered.
+
+        Raises:
+            * BtrsnapError: no job matches.
+        '''
+        if path is not None:
+            path = os.path.realpath(path)
+        with self._condition:
+            now = self._clock()
+            jobs = [job for job in self.jobs if job.argv[0] == command and
+                    (path is None or any(path == job_path or path.startswith(
+                        job_path.rstrip('/') + '/')
+                        for job_path in job.paths))]
+            if not jobs:
+                raise btrsnap.BtrsnapError('no {} job{}'.format(
+                    command, '' if path is None else
+                    ' for \'{}\''.format(path)))
+            for job in jobs:
+                job.next_run = min(job.next_run, now)
+            self._condition.notify_all()
+        return jobs
+
+    def stop(self):
+        '''
+        Make :meth:`run` return once the running jobs have finished. Safe to
+        call from a signal handler.
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(self.server.max_line)
+            if not line:
+                return
+            if not line.endswith(b'\n') and len(line) == self.server.max_line:
+                self.reply({'ok': False, 'error': 'request too long'})
+                return
+            try:
+                reply = self.server.answer(json.loads(line.decode()))
+            except (ValueError, btrsnap.BtrsnapError) as err:
+                reply = {'ok': False, 'error': str(err)}
+            self.reply(reply)
+
+    def reply(self, reply):
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    '''
+    Answers status and trigger requests for SCHEDULER on a Unix domain
+    socket, see :mod:`btrsnap.daemon`. The socket is only accessible to
+    its owner. A socket left behind by a daemon that died is replaced.
+
+    Args:
+        * path (str): socket file.
+        * scheduler (Scheduler)
+
+    Raises:
+        * BtrsnapError: another daemon listens on PATH, or the socket
+          could not be created.
+    '''
+    daemon_threads = True
+    # a request line is a few hundred bytes at most
+    max_line = 1 << 16
+
+    def __init__(self, path, scheduler):
+        self.scheduler = scheduler
+        _remove_stale_socket(path)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _ControlHandler)
+        except OSError as err:
+            raise btrsnap.BtrsnapError('cannot listen on \'{}\': {}'
+                                       .format(path, err.strerror))
+        finally:
+            os.umask(umask)
+
+    def answer(self, message):
+        '''
+        Args:
+            * message (dict): a request.
+
+        Returns:
+            * dict: the reply.
+
+        Raises:
+            * BtrsnapError: the request is not valid.
+        '''
+        if not isinstance(message, dict):
+            raise btrsnap.BtrsnapError('expected a JSON object')
+        request = message.get('request')
+        if request == 'status':
+            return dict(self.scheduler.status(), ok=True)
+        if request == 'trigger':
+            command = message.get('command')
+            if command not in COMMANDS:
+                raise btrsnap.BtrsnapError('command must be one of {}'
+                                           .format(', '.join(COMMANDS)))
+            jobs = self.scheduler.trigger(command, message.get('path'))
+            return {'ok': True, 'triggered': [str(job) for job in jobs]}
+        raise btrsnap.BtrsnapError('unknown request \'{}\''.format(request))
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_stale_socket(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise btrsnap.BtrsnapError('\'{}\' exists and is not a socket'
+                                   .format(path))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise btrsnap.BtrsnapError('a daemon is already listening on \'{}\''
+                               .format(path))
+
+
+def request(path, message, timeout=10):
+    '''
+    Send one request to the control socket of a running daemon.
+
+    Args:
+        * path (str): socket file.
+        * message (dict): the request, see :mod:`btrsnap.daemon`.
+        * timeout (float): seconds to wait for the reply.
+
+    Returns:
+        * dict: the reply.
+
+    Raises:
+        * BtrsnapError: no daemon answers on PATH, or it rejected the
+          request.
+    '''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            with sock.makefile('rwb') as f:
+                f.write(json.dumps(message).encode() + b'\n')
+                f.flush()
+                line = f.readline()
+    except OSError as err:
+        raise btrsnap.BtrsnapError('no daemon answers on \'{}\': {}'
+                                   .format(path, err))
+    try:
+        reply = json.loads(line.decode())
+    except ValueError:
+        raise btrsnap.BtrsnapError('invalid reply from \'{}\''.format(path))
+    if not reply.get('ok'):
+        raise btrsnap.BtrsnapError(reply.get('error', 'request failed'))
+    return reply
+
+
+def control(path, command=None, snap_path=None):
+    '''
+    Command line client of the control socket.
+
+    Args:
+        * path (str): socket file of a running daemon.
+        * command (str): trigger the jobs running this command instead of
+          asking for the status.
+        * snap_path (str): only trigger the jobs working on this directory.
+
+    Returns:
+        * msg (str): the status as indented JSON, or the jobs triggered.
+
+    Raises:
+        * BtrsnapError: see :func:`request`.
+    '''
+    if command is None:
+        reply = request(path, {'request': 'status'})
+        del reply['ok']
+        return json.dumps(reply, indent=2, sort_keys=True)
+    message = {'request': 'trigger', 'command': command}
+    if snap_path is not None:
+        message['path'] = os.path.abspath(snap_path)
+    reply = request(path, message)
+    return '\n'.join('Triggered: ' + job for job in reply['triggered'])
+
+
+def run(filename, max_jobs=1, catalog=None, control=None):
+    '''
+    Load a schedule and run it until SIGTERM or SIGINT.
+
+    Args:
+        * filename (str): schedule file, see :func:`load_schedule`.
+        * max_jobs (int): see :class:`Scheduler`.
+        * catalog (Catalog): see :class:`Scheduler`.
+        * control (str): listen for requests on this socket, see
+          :class:`ControlServer`.
+    '''
+    scheduler = Scheduler(load_schedule(filename), max_jobs=max_jobs,
+                          catalog=catalog)
+    server = None
+    if control is not None:
+        server = ControlServer(control, scheduler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+    print('btrsnap daemon: {} job(s) from \'{}\''.format(
+        len(scheduler.jobs), filename), flush=True)
+    try:
+        scheduler.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,242 @@
+'''
+Tests for the btrsnap daemon scheduler. No btrfs is needed.
+'''
+import unittest
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import btrsnap
+import catalog
+import daemon
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def job(every, *paths, func=None):
+    args = argparse.Namespace(snap_path=list(paths), catalog=None,
+                              func=func or (lambda args: None))
+    return daemon.Job(every, ['snap'] + list(paths), args)
+
+
+class Test_Interval_Function(unittest.TestCase):
+
+    def test_parse_interval(self):
+        self.assertEqual(90, daemon.parse_interval('90s'))
+        self.assertEqual(900, daemon.parse_interval('15m'))
+        self.assertEqual(5400, daemon.parse_interval('1h30m'))
+        self.assertEqual(8 * 86400, daemon.parse_interval('1w1d'))
+
+    def test_parse_interval_invalid(self):
+        for string in ('', '15', 'm', '1x', '0m', '1h 30m', '-1h'):
+            self.assertRaises(btrsnap.BtrsnapError, daemon.parse_interval,
+                              string)
+
+
+class Test_Schedule_Function(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.schedule = os.path.join(self.test_dir, 'schedule')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write(self, text):
+        with open(self.schedule, 'w') as f:
+            f.write(text)
+
+    def test_load_schedule(self):
+        self.write('# every command\n'
+                   '\n'
+                   '15m snap -r --if-changed -k 96 /snapshots  # often\n'
+                   '1d  send -r /snapshots /mnt/backup\n'
+                   "1h  send --transport 'ssh backup' /snapshots /backup\n")
+        jobs = daemon.load_schedule(self.schedule)
+        self.assertEqual([900, 86400, 3600], [j.every for j in jobs])
+        self.assertEqual('snap -r --if-changed -k 96 /snapshots',
+                         str(jobs[0]))
+        self.assertEqual(['/snapshots'], jobs[0].paths)
+        self.assertTrue(jobs[0].args.if_changed)
+        self.assertEqual(['/snapshots', '/mnt/backup'], jobs[1].paths)
+        # the receiving side is on another machine
+        self.assertEqual(['/snapshots'], jobs[2].paths)
+
+    def test_load_schedule_invalid(self):
+        for text in ('15m\n', '15m list /snapshots\n', '15 snap /snapshots\n',
+                     '15m snap --no-such-option /snapshots\n',
+                     "15m snap '/snapshots\n"):
+            self.write(text)
+            self.assertRaises(btrsnap.BtrsnapError, daemon.load_schedule,
+                              self.schedule)
+        self.assertRaises(btrsnap.BtrsnapError, daemon.load_schedule,
+                          os.path.join(self.test_dir, 'missing'))
+
+
+class Test_Scheduler_Class(unittest.TestCase):
+
+    def test_conflicts(self):
+        self.assertTrue(job(60, '/a').conflicts(job(60, '/a')))
+        self.assertTrue(job(60, '/a').conflicts(job(60, '/a/b')))
+        self.assertTrue(job(60, '/a/b').conflicts(job(60, '/c', '/a')))
+        self.assertFalse(job(60, '/a').conflicts(job(60, '/ab')))
+
+    def test_due(self):
+        clock = FakeClock()
+        a, b, c = job(60, '/a'), job(60, '/a/b'), job(60, '/c')
+        scheduler = daemon.Scheduler([a, b, c], max_jobs=2, clock=clock,
+                                     catalog=object())
+        self.assertEqual([a, c], scheduler.due(clock.now))
+        a.running = True
+        self.assertEqual([c], scheduler.due(clock.now))
+        c.running = True
+        self.assertEqual([], scheduler.due(clock.now))
+        a.running = False
+        # b waits for a, which is picked first
+        self.assertEqual([a], scheduler.due(clock.now))
+        c.running = False
+        c.next_run = clock.now + 1
+        a.next_run = clock.now + 1
+        self.assertEqual([b], scheduler.due(clock.now))
+
+    def test_start(self):
+        clock = FakeClock()
+        a = job(60, '/a')
+        scheduler = daemon.Scheduler([a], clock=clock, catalog=object())
+        scheduler.start(a, clock.now)
+        self.assertEqual(clock.now + 60, a.next_run)
+        scheduler.stop()
+        scheduler.run()
+        self.assertEqual(1, a.runs)
+        # runs missed while busy are skipped
+        clock.now += 200
+        scheduler.start(a, clock.now)
+        self.assertEqual(clock.now + 60, a.next_run)
+        scheduler.run()
+
+    def test_run(self):
+        log = []
+        lock = threading.Lock()
+        active = set()
+
+        def work(name, fail=False):
+            def func(args):
+                with lock:
+                    log.append((name, set(active)))
+                    active.add(name)
+                time.sleep(0.02)
+                with lock:
+                    active.discard(name)
+                if fail:
+                    print('Error: failed', file=args.output)
+                    args.failed = True
+            return func
+
+        a = job(0.05, '/a', func=work('a'))
+        b = job(0.05, '/a/b', func=work('b', fail=True))
+        c = job(0.05, '/c', func=work('c'))
+        scheduler = daemon.Scheduler([a, b, c], max_jobs=3, catalog=object())
+        timer = threading.Timer(0.3, scheduler.stop)
+        timer.start()
+        scheduler.run()
+        self.assertFalse(any(job.running for job in (a, b, c)))
+        for name, others in log:
+            # a and b share a directory and never overlap
+            self.assertFalse(name in 'ab' and others & {'a', 'b'})
+        self.assertTrue(all(job.runs >= 2 for job in (a, b, c)))
+        self.assertEqual(b.runs, b.failures)
+        self.assertEqual('Error: failed\n', b.last_output)
+        self.assertFalse(a.last_failed)
+
+
+class Test_Control_Class(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.test_dir, 'control')
+        self.clock = FakeClock()
+        self.a, self.b = job(60, '/a'), job(60, '/b')
+        self.a.argv[0] = 'send'
+        self.catalog = catalog.Catalog(':memory:')
+        self.scheduler = daemon.Scheduler([self.a, self.b], clock=self.clock,
+                                          catalog=self.catalog)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_status(self):
+        self.catalog.add('/a', '2012-01-01-0001')
+        self.a.running = True
+        self.b.next_run = self.clock.now + 30
+        with btrsnap.activity.deleting('/b', ['2012-01-01-0001']):
+            status = self.scheduler.status()
+        self.assertEqual(['send /a', 'snap /b'],
+                         [job['command'] for job in status['jobs']])
+        self.assertEqual(30, status['jobs'][1]['next_run'])
+        self.assertEqual({'running': 1, 'waiting': 0, 'max_jobs': 1},
+                         status['queue'])
+        self.assertEqual({'/a': '2012-01-01-0001'}, status['snapshots'])
+        self.assertEqual({'/b': ['2012-01-01-0001']}, status['deletions'])
+        self.assertEqual([], status['transfers'])
+
+    def test_trigger(self):
+        for job in (self.a, self.b):
+            job.next_run = self.clock.now + 30
+        self.assertEqual([self.b], self.scheduler.trigger('snap', '/b/c'))
+        self.assertEqual(self.clock.now, self.b.next_run)
+        self.assertEqual(self.clock.now + 30, self.a.next_run)
+        for command, path in (('snap', '/a'), ('delete', None)):
+            self.assertRaises(btrsnap.BtrsnapError, self.scheduler.trigger,
+                              command, path)
+
+    def test_socket(self):
+        server = daemon.ControlServer(self.socket, self.scheduler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(0o600, os.stat(self.socket).st_mode & 0o777)
+            reply = daemon.request(self.socket, {'request': 'status'})
+            self.assertEqual(2, len(reply['jobs']))
+            self.assertIn('"queue"', daemon.control(self.socket))
+            self.assertEqual('Triggered: send /a',
+                             daemon.control(self.socket, 'send'))
+            for message in ({'request': 'trigger', 'command': 'list'},
+                            {'request': 'stop'}, []):
+                self.assertRaises(btrsnap.BtrsnapError, daemon.request,
+                                  self.socket, message)
+            # only one daemon listens on a socket
+            self.assertRaises(btrsnap.BtrsnapError, daemon.ControlServer,
+                              self.socket, self.scheduler)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(self.socket))
+        self.assertRaises(btrsnap.BtrsnapError, daemon.request, self.socket,
+                          {'request': 'status'})
+
+    def test_stale_socket(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.socket)
+        server = daemon.ControlServer(self.socket, self.scheduler)
+        server.server_close()
+        with open(self.socket, 'w'):
+            pass
+        self.assertRaises(btrsnap.BtrsnapError, daemon.ControlServer,
+                          self.socket, self.scheduler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+'''
+Date arithmetic for deleting snapshots by age, without third-party
+packages.
+
+``--date`` takes either an age counted back from today, ``?y?m?d?w`` such
+as ``1y6m`` or ``2w``, or a fixed day such as ``2014-01-05``. Both are
+parsed into a :class:`Period` once, which gives the ordinal of the last
+day to delete, see :meth:`datetime.date.toordinal`. Snapshots are then
+compared as integers.
+'''
+
+import datetime
+import re
+
+AGE_PATTERN = re.compile(r'(\d+)([ymwd])', re.IGNORECASE)
+ISO_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def days_in_month(year, month):
+    '''
+    Returns:
+        * int: number of days in MONTH of YEAR.
+    '''
+    if month == 2 and year % 4 == 0 and (year % 100 or year % 400 == 0):
+        return 29
+    return DAYS_IN_MONTH[month - 1]
+
+
+class Period:
+    '''
+    How far back to delete snapshots.
+
+    Args:
+        * years (int)
+        * months (int)
+        * weeks (int)
+        * days (int): an age counted back from the day it is applied to.
+          Years and months go first and land on the last day of the month
+          when it is shorter, so one month before March 31 is the end of
+          February, then weeks and days are counted back. This is what
+          ``dateutil.relativedelta`` does.
+        * date (datetime.date): a fixed last day instead of an age.
+    '''
+
+    def __init__(self, years=0, months=0, weeks=0, days=0, date=None):
+        self.years = years
+        self.months = months
+        self.weeks = weeks
+        self.days = days
+        self.date = date
+
+    def _key(self):
+        return (self.years, self.months, self.weeks, self.days, self.date)
+
+    def __eq__(self, other):
+        if not isinstance(other, Period):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        if self.date is not None:
+            return 'Period(date={!r})'.format(self.date)
+        return 'Period(years={}, months={}, weeks={}, days={})'.format(
+            self.years, self.months, self.weeks, self.days)
+
+    def cutoff(self, today=None):
+        '''
+        Args:
+            * today (datetime.date): day the age is counted back from,
+              defaults to today.
+
+        Returns:
+            * int: ordinal of the last day to delete. 0 when the age goes
+              back further than :attr:`datetime.date.min`, so nothing is
+              that old.
+        '''
+        if self.date is not None:
+            return self.date.toordinal()
+        if today is None:
+            today = datetime.date.today()
+        year, month = divmod(today.year * 12 + today.month - 1 -
+                             self.years * 12 - self.months, 12)
+        month += 1
+        if year < datetime.MINYEAR:
+            return 0
+        day = min(today.day, days_in_month(year, month))
+        ordinal = datetime.date(year, month, day).toordinal()
+        return max(ordinal - self.weeks * 7 - self.days, 0)
+
+    def __rsub__(self, other):
+        # today - period, as with relativedelta
+        if not isinstance(other, datetime.date):
+            return NotImplemented
+        return datetime.date.fromordinal(self.cutoff(other))
+
+
+def parse(string, today=None):
+    '''
+    Args:
+        * string (str): ``YYYY-MM-DD``, a day that is not in the future,
+          or ``?y?m?d?w``, each unit at most once, in any order, such as
+          ``0y2m1d`` or ``3w``.
+        * today (datetime.date): defaults to today.
+
+    Returns:
+        * Period
+
+    Raises:
+        * ValueError: STRING is not a date or an age.
+    '''
+    if today is None:
+        today = datetime.date.today()
+    iso_match = ISO_PATTERN.match(string)
+    if iso_match:
+        try:
+            date = datetime.date(*(int(part) for part in iso_match.groups()))
+        except ValueError as err:
+            raise ValueError('\'{}\' is not a valid date: {}'
+                             .format(string, err))
+        if date > today:
+            raise ValueError('{} is in the future'.format(string))
+        return Period(date=date)
+
+    parts = AGE_PATTERN.findall(string)
+    if not parts or ''.join(count + unit for count, unit in parts) != string:
+        raise ValueError('\'{}\' is not a recognized date format'
+                         .format(string))
+    units = {}
+    for count, unit in parts:
+        unit = unit.lower()
+        if unit in units:
+            raise ValueError('\'{}\' was specified more than once'
+                             .format(unit))
+        units[unit] = int(count)
+    return Period(years=units.get('y', 0), months=units.get('m', 0),
+                  weeks=units.get('w', 0), days=units.get('d', 0))
+
+
+def cutoff(period, today=None):
+    '''
+    Args:
+        * period (Period): or anything that can be subtracted from a
+          :class:`datetime.date`, such as ``dateutil.relativedelta`` or
+          :class:`datetime.timedelta`.
+        * today (datetime.date): defaults to today.
+
+    Returns:
+        * int: ordinal of the last day to delete, see :meth:`Period.cutoff`.
+    '''
+    if today is None:
+        today = datetime.date.today()
+    if isinstance(period, Period):
+        return period.cutoff(today)
+    return (today - period).toordinal()
+
+
+def isoformat(ordinal):
+    '''
+    Returns:
+        * str: the day of ORDINAL as YYYY-MM-DD. Ordinal 0, the day before
+          :attr:`datetime.date.min`, is ``0000-12-31``.
+    '''
+    if ordinal < 1:
+        return '0000-12-31'
+    return datetime.date.fromordinal(ordinal).isoformat()
@@ -0,0 +1,97 @@
+'''
+Tests for the date arithmetic used by delete --date. No btrfs is needed.
+'''
+import unittest
+import datetime
+
+import dates
+
+try:
+    from dateutil.relativedelta import relativedelta
+except ImportError:
+    relativedelta = None
+
+
+class Test_Parse_Function(unittest.TestCase):
+
+    today = datetime.date(2014, 6, 18)
+
+    def test_parse_age(self):
+        self.assertEqual(dates.Period(years=4, months=4, weeks=2, days=1),
+                         dates.parse('4y4m1d2w'))
+        self.assertEqual(dates.Period(weeks=3), dates.parse('3W'))
+        self.assertEqual(dates.Period(years=1000, months=55, days=71),
+                         dates.parse('1000y55m71d'))
+
+    def test_parse_iso(self):
+        self.assertEqual(dates.Period(date=datetime.date(2014, 1, 5)),
+                         dates.parse('2014-01-05', today=self.today))
+        self.assertEqual(self.today.toordinal(),
+                         dates.parse('2014-06-18', today=self.today).cutoff())
+
+    def test_parse_invalid(self):
+        for string in ('', '4', 'y', '99y98y', '1y2', '1y 2m', '-1d', '1x',
+                       '1,', 'garbally-gook', '5555-55-55', '2014-02-30',
+                       '2014-06-19'):
+            self.assertRaises(ValueError, dates.parse, string,
+                              today=self.today)
+
+
+class Test_Period_Class(unittest.TestCase):
+
+    def cutoff(self, today, **kwargs):
+        return datetime.date.fromordinal(dates.Period(**kwargs).cutoff(today))
+
+    def test_cutoff_month_ends(self):
+        self.assertEqual(datetime.date(2014, 2, 28),
+                         self.cutoff(datetime.date(2014, 3, 31), months=1))
+        self.assertEqual(datetime.date(2016, 2, 29),
+                         self.cutoff(datetime.date(2016, 3, 31), months=1))
+        self.assertEqual(datetime.date(2014, 4, 30),
+                         self.cutoff(datetime.date(2014, 5, 31), months=1))
+        self.assertEqual(datetime.date(2015, 2, 28),
+                         self.cutoff(datetime.date(2016, 2, 29), years=1))
+        self.assertEqual(datetime.date(2013, 12, 31),
+                         self.cutoff(datetime.date(2014, 1, 31), months=1))
+        self.assertEqual(datetime.date(2012, 11, 30),
+                         self.cutoff(datetime.date(2014, 1, 31), months=14))
+
+    def test_cutoff_days(self):
+        # months first, then weeks and days
+        self.assertEqual(datetime.date(2014, 2, 18),
+                         self.cutoff(datetime.date(2014, 3, 31), months=1,
+                                     weeks=1, days=3))
+        self.assertEqual(datetime.date(2013, 12, 31),
+                         self.cutoff(datetime.date(2014, 1, 1), days=1))
+
+    def test_cutoff_out_of_range(self):
+        today = datetime.date(2014, 6, 18)
+        self.assertEqual(0, dates.Period(years=3000).cutoff(today))
+        self.assertEqual(0, dates.Period(days=today.toordinal()).cutoff(today))
+        self.assertEqual('0000-12-31', dates.isoformat(0))
+        self.assertEqual('2014-06-18', dates.isoformat(today.toordinal()))
+
+    def test_subtract(self):
+        today = datetime.date(2014, 3, 31)
+        self.assertEqual(datetime.date(2014, 2, 28),
+                         today - dates.Period(months=1))
+        self.assertEqual(dates.cutoff(datetime.timedelta(days=1), today),
+                         dates.cutoff(dates.Period(days=1), today))
+
+    @unittest.skipIf(relativedelta is None, 'python-dateutil not installed')
+    def test_matches_relativedelta(self):
+        start = datetime.date(2011, 12, 25).toordinal()
+        for today in range(start, start + 800, 7):
+            today = datetime.date.fromordinal(today)
+            for years, months, weeks, days in ((0, 1, 0, 0), (1, 0, 0, 0),
+                                               (0, 13, 2, 3), (2, 11, 0, 30),
+                                               (0, 0, 5, 0), (0, 0, 0, 0)):
+                delta = relativedelta(years=years, months=months,
+                                      weeks=weeks, days=days)
+                period = dates.Period(years, months, weeks, days)
+                self.assertEqual((today - delta).toordinal(),
+                                 period.cutoff(today))
+
+
+if __name__ == '__main__':
+    unittest.main()
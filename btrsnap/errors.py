@@ -0,0 +1,39 @@
+'''
+The errors btrsnap raises. They are kept apart from :mod:`btrsnap.btrsnap`
+so that the modules it is split into can raise them without importing it.
+'''
+
+
+class BtrsnapError(Exception):
+    '''
+    Root error for the btrsnap module
+    '''
+    pass
+
+
+class PathError(BtrsnapError):
+    '''
+    Path does not exist on the filesystem
+    '''
+    pass
+
+
+class TargetError(BtrsnapError):
+    '''
+    There is not exactly 1 symlink inside the snapshot directory
+    '''
+    pass
+
+
+class TransportError(BtrsnapError):
+    '''
+    A command run through a receive transport failed
+    '''
+    pass
+
+
+class BtrfsError(BtrsnapError):
+    '''
+    btrfs-progs returned a non zero exit code
+    '''
+    pass
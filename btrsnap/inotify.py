@@ -0,0 +1,230 @@
+'''
+Tells when directories change, so a long-running process such as
+:mod:`btrsnap.daemon` can keep the contents of snapshot directories in
+memory and still notice a snapshot deleted by hand or a symlink pointed
+somewhere else.
+
+Linux inotify is used through :mod:`ctypes`. Where it is not available,
+or a directory cannot be watched, the modification time of the directory
+is compared instead.
+'''
+
+import ctypes
+import errno
+import os
+import struct
+import threading
+import time
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+# entries added, removed or renamed, and the directory itself going away
+MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+        IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+GONE = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    '''
+    Minimal binding of the Linux inotify API. Events are read without
+    blocking.
+
+    Attributes:
+        * fd (int): the inotify file descriptor.
+
+    Raises:
+        * OSError: inotify is not available.
+    '''
+    buffer_size = 1 << 16
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        init.argtypes = [ctypes.c_int]
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self._check(init(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    @staticmethod
+    def _check(result):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+
+    def add_watch(self, path, mask=MASK):
+        '''
+        Returns:
+            * int: watch descriptor of PATH. Watching the same directory
+              again returns the same descriptor.
+
+        Raises:
+            * OSError: PATH cannot be watched.
+        '''
+        return self._check(self._add_watch(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        '''
+        Stop watching WD. A watch the kernel already removed is ignored.
+        '''
+        try:
+            self._check(self._rm_watch(self.fd, wd))
+        except OSError:
+            pass
+
+    def read(self):
+        '''
+        Returns:
+            * list(tuple): (wd, mask, name) of every pending event, name is
+              '' for events on the watched directory itself.
+        '''
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, self.buffer_size)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    '''
+    Tells whether directories changed since they were last read.
+
+    :meth:`stamp` returns a value that changes whenever an entry is added
+    to, removed from or renamed in a directory, or the directory itself is
+    removed, renamed or replaced. A directory is watched, together with
+    its parent, from the first call for it on. A caller takes the stamp
+    before reading the directory, and reads it again only once the stamp
+    differs, so no change is missed.
+
+    Args:
+        * inotify (bool): use inotify where it is available. False always
+          compares modification times.
+
+    Attributes:
+        * inotify (Inotify): None when modification times are compared.
+    '''
+    # a directory modified this close to a check may change again without
+    # its mtime changing, see Catalog.racy_seconds
+    racy_seconds = 2
+
+    def __init__(self, inotify=True):
+        self.inotify = None
+        if inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                pass
+        self._lock = threading.Lock()
+        self._versions = {}
+        # path: (wd, wd of the parent, name in the parent)
+        self._watched = {}
+        self._paths = {}
+        self._children = {}
+
+    def stamp(self, path):
+        '''
+        Args:
+            * path (str): absolute path of a directory.
+
+        Returns:
+            * object: equal for two calls only if PATH did not change in
+              between. None when this cannot be told, for example right
+              after a change that the modification time may not show.
+        '''
+        with self._lock:
+            if self.inotify is not None:
+                self._update()
+                if path in self._watched or self._watch(path):
+                    return self._versions[path]
+        return self._mtime_stamp(path)
+
+    def _mtime_stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime < self.racy_seconds:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+    def _watch(self, path):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError:
+            return False
+        parent, name = os.path.split(path)
+        parent_wd = None
+        if name:
+            try:
+                parent_wd = self.inotify.add_watch(parent)
+            except OSError:
+                pass
+        self._watched[path] = (wd, parent_wd, name)
+        self._paths.setdefault(wd, set()).add(path)
+        if parent_wd is not None:
+            self._children.setdefault(parent_wd, {})[name] = path
+        self._changed(path)
+        return True
+
+    def _changed(self, path):
+        self._versions[path] = self._versions.get(path, 0) + 1
+
+    def _forget(self, path):
+        wd, parent_wd, name = self._watched.pop(path)
+        self._changed(path)
+        self._paths[wd].discard(path)
+        if parent_wd is not None:
+            self._children[parent_wd].pop(name, None)
+        for descriptor in (wd, parent_wd):
+            if descriptor is not None and not self._paths.get(descriptor) \
+                    and not self._children.get(descriptor):
+                self._paths.pop(descriptor, None)
+                self._children.pop(descriptor, None)
+                self.inotify.rm_watch(descriptor)
+
+    def _update(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                for path in list(self._watched):
+                    self._forget(path)
+                continue
+            for path in list(self._paths.get(wd, ())):
+                if mask & GONE:
+                    self._forget(path)
+                else:
+                    self._changed(path)
+            path = self._children.get(wd, {}).get(name)
+            if name and path is not None:
+                # the directory itself was renamed, replaced or removed
+                self._forget(path)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -0,0 +1,130 @@
+'''
+Tests for the directory watcher. No btrfs is needed.
+'''
+import unittest
+import os
+import shutil
+import tempfile
+
+import btrsnap
+import catalog
+import inotify
+
+
+class Test_Watcher_Class(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.snap_dir = os.path.join(self.test_dir, 'snap_dir')
+        self.target = os.path.join(self.test_dir, 'target')
+        os.mkdir(self.snap_dir)
+        os.mkdir(self.target)
+        os.symlink(self.target, os.path.join(self.snap_dir, 'target'))
+        self.watcher = inotify.Watcher()
+        if self.watcher.inotify is None:
+            self.skipTest('inotify is not available')
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.test_dir)
+
+    def assertChanged(self, stamp, changed=True):
+        new = self.watcher.stamp(self.snap_dir)
+        self.assertEqual(changed, new != stamp)
+        return new
+
+    def test_stamp(self):
+        stamp = self.assertChanged(None)
+        stamp = self.assertChanged(stamp, False)
+        os.mkdir(os.path.join(self.snap_dir, '2012-01-01-0001'))
+        stamp = self.assertChanged(stamp)
+        os.rename(os.path.join(self.snap_dir, '2012-01-01-0001'),
+                  os.path.join(self.snap_dir, '2012-01-01-0002'))
+        stamp = self.assertChanged(stamp)
+        os.rmdir(os.path.join(self.snap_dir, '2012-01-01-0002'))
+        stamp = self.assertChanged(stamp)
+        # changes inside a snapshot or the target are not changes
+        os.mkdir(os.path.join(self.target, 'data'))
+        self.assertChanged(stamp, False)
+
+    def test_stamp_replaced(self):
+        stamp = self.watcher.stamp(self.snap_dir)
+        os.rename(self.snap_dir, self.snap_dir + '.old')
+        os.mkdir(self.snap_dir)
+        stamp = self.assertChanged(stamp)
+        self.assertChanged(stamp, False)
+        shutil.rmtree(self.snap_dir)
+        self.assertIsNone(self.watcher.stamp(self.snap_dir))
+
+    def test_mtime_fallback(self):
+        watcher = inotify.Watcher(inotify=False)
+        self.assertIsNone(watcher.inotify)
+        # just modified, the mtime cannot be trusted yet
+        self.assertIsNone(watcher.stamp(self.snap_dir))
+        os.utime(self.snap_dir, (0, 0))
+        stamp = watcher.stamp(self.snap_dir)
+        self.assertIsNotNone(stamp)
+        self.assertEqual(stamp, watcher.stamp(self.snap_dir))
+        os.utime(self.snap_dir, (1, 1))
+        self.assertNotEqual(stamp, watcher.stamp(self.snap_dir))
+
+
+class Test_Catalog_Watcher(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.snap_dir = os.path.join(self.test_dir, 'snap_dir')
+        self.link = os.path.join(self.snap_dir, 'target')
+        os.mkdir(self.snap_dir)
+        for name in ('a', 'b', '2012-01-01-0001'):
+            os.mkdir(os.path.join(self.test_dir, name))
+        os.symlink(os.path.join(self.test_dir, 'a'), self.link)
+        self.watcher = inotify.Watcher()
+        if self.watcher.inotify is None:
+            self.skipTest('inotify is not available')
+        self.catalog = catalog.Catalog(':memory:', watcher=self.watcher)
+
+    def tearDown(self):
+        self.catalog.close()
+        self.watcher.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_snapshots(self):
+        self.assertEqual([], self.catalog.snapshots(self.snap_dir))
+        mtime = os.stat(self.snap_dir).st_mtime_ns
+        os.rename(os.path.join(self.test_dir, '2012-01-01-0001'),
+                  os.path.join(self.snap_dir, '2012-01-01-0001'))
+        # seen even though the mtime does not show it
+        os.utime(self.snap_dir, ns=(mtime, mtime))
+        self.assertEqual(['2012-01-01-0001'],
+                         self.catalog.snapshots(self.snap_dir))
+
+    def test_reconcile_unchanged(self):
+        self.catalog.reconcile(self.snap_dir)
+        stat = os.stat
+        stats = []
+
+        def counting_stat(*args, **kwargs):
+            stats.append(args[0])
+            return stat(*args, **kwargs)
+        os.stat = counting_stat
+        try:
+            self.assertEqual(([], []), self.catalog.reconcile(self.snap_dir))
+        finally:
+            os.stat = stat
+        self.assertEqual([], stats)
+
+    def test_target(self):
+        self.assertEqual(os.path.join(self.test_dir, 'a'),
+                         btrsnap.SnapPath(self.snap_dir, self.catalog).target)
+        os.unlink(self.link)
+        os.symlink(os.path.join(self.test_dir, 'b'), self.link)
+        self.assertEqual(os.path.join(self.test_dir, 'b'),
+                         self.catalog.target(self.snap_dir))
+        os.symlink(os.path.join(self.test_dir, 'a'), self.link + '2')
+        self.assertRaises(btrsnap.TargetError, btrsnap.SnapPath,
+                          self.snap_dir, self.catalog)
+
+
+if __name__ == '__main__':
+    unittest.main()
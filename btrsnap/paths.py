@@ -0,0 +1,249 @@
+'''
+Snapshot directories and the names of the snapshots in them.
+'''
+
+import collections
+import contextlib
+import datetime
+import fcntl
+import os
+import re
+
+try:
+    from .errors import BtrsnapError, PathError, TargetError
+except ImportError:
+    from errors import BtrsnapError, PathError, TargetError
+
+TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}-(\d{4}|\d{6}-\d{4})$')
+
+Scan = collections.namedtuple('Scan', ['snapshots', 'links', 'directories'])
+
+
+def snapshot_key(name):
+    '''
+    Sort key for snapshot names. Snapshots named YYYY-MM-DD-#### sort
+    before precise YYYY-MM-DD-HHMMSS-ffff snapshots from the same day.
+
+    Args:
+        * name (str): snapshot name.
+
+    Returns:
+        * tuple: compares in the order the snapshots were created.
+    '''
+    return (name[:10], len(name), name[11:])
+
+
+def snapshot_date(name):
+    '''
+    Args:
+        * name (str): snapshot name.
+
+    Returns:
+        * datetime.date: the day the snapshot was created.
+    '''
+    return datetime.date(int(name[:4]), int(name[5:7]), int(name[8:10]))
+
+
+class Path:
+    '''
+    Base Class for working with filesystem folders
+    '''
+    def __init__(self, path):
+        '''
+        Verifies that a path exists.
+
+        Args:
+            * path (str): a path on a filesystem.
+
+        Attributes:
+            * path (str): absolute path.
+
+        Raises:
+            * PathError: invalid path.
+        '''
+        if os.path.isdir(os.path.expanduser(path)):
+            self.path = os.path.abspath(os.path.expanduser(path))
+        else:
+            raise PathError('{} is not a valid folder name'.format(path))
+
+    def scan(self):
+        '''
+        Read the contents of *self.path* in a single pass. The entry type
+        cached by :func:`os.scandir` is used, so only symbolic links need
+        an extra stat call.
+
+        Returns:
+            * Scan: a named tuple with the fields
+
+                * snapshots (list(str)): directories that match the btrsnap
+                  timestamp YYYY-MM-DD-#### or YYYY-MM-DD-HHMMSS-ffff,
+                  newest first.
+                * links (list(str)): symbolic links.
+                * directories (list(str)): all directories, including
+                  symbolic links that point to a directory.
+        '''
+        snapshots = []
+        links = []
+        directories = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    links.append(entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    directories.append(entry.name)
+                    if TIMESTAMP_PATTERN.search(entry.name):
+                        snapshots.append(entry.name)
+        snapshots.sort(key=snapshot_key, reverse=True)
+        return Scan(snapshots, links, directories)
+
+    def snapshots(self):
+        '''
+        List all folders in *self.path* whose name matches the
+        btrsnap timestamp format: yyyy-mm-dd-#### or
+        yyyy-mm-dd-hhmmss-ffff.
+
+        Returns:
+            * list(str): a list of directories inside self.path that
+              match the btrsnap timestamp, newest first
+        '''
+        return self.scan().snapshots
+
+    @contextlib.contextmanager
+    def lock(self):
+        '''
+        Context manager holding an exclusive lock on *self.path*. Other
+        btrsnap processes and threads locking the same directory wait until
+        it is released.
+        '''
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def sub_snap_paths_list(self, catalog=None):
+        '''
+        Args:
+            * catalog (Catalog): see :class:`SnapPath`.
+
+        Returns:
+            * list(SnapPath): a list of SnapPath objects for each subdirectory
+            inside of self.path.
+        '''
+        return self._list_of_objects(SnapPath, catalog=catalog)
+
+    def sub_paths_list(self):
+        '''
+        Returns:
+            * list(Path): a list of Path objects for each subdirectory
+            inside of self.path.
+        '''
+        return self._list_of_objects(Path)
+
+    def _list_of_objects(self, obj, **kwargs):
+        objects = []
+        for content in self.scan().directories:
+            try:
+                objects.append(obj(os.path.join(
+                    self.path, content), **kwargs))
+            except Exception:
+                pass
+        return objects
+
+
+class SnapPath(Path):
+    '''
+    Verifies that path exists, and that it contains exactly one symlink.
+
+    Agruments:
+        * path (str): path on filesystem
+        * catalog (Catalog): take the target from this catalog, see
+          :meth:`Catalog.target`.
+
+    Attributes:
+        * target (str): Absolute path where the symlink points.
+        * path (str): Absolute path on the filesystem
+
+    Raises:
+        * TargetError:
+        * PathError:
+    '''
+    def __init__(self, path, catalog=None):
+        Path.__init__(self, path)
+        if catalog is None:
+            self.target = 'initiate'
+        else:
+            self._target = catalog.target(self.path)
+
+    @property
+    def target(self):
+        return self._target
+
+    @target.setter
+    def target(self, garbage):
+        contents = self.scan().links
+        if not len(contents) == 1:
+            raise TargetError('there must be exactly 1 symlink pointing to a'
+                              ' target BTRFS subvolume in snapshot'
+                              ' directory {}'.format(self.path))
+        self._target = os.path.realpath(os.path.abspath(os.path.join(
+                                        self.path, contents[0])))
+
+    def timestamp(self, counter=1, snapshots=None, precise=False):
+        '''
+        Returns the next availible timestamp in self.path
+
+        The sequence number is taken from the newest snapshot created
+        today. Hold :meth:`Path.lock` until the snapshot is created if
+        other processes may snapshot the same directory.
+
+        Arguments:
+            * counter (int): start number for last 4 digits of timestamp.
+            * snapshots (list(str)): result of :meth:`Path.snapshots` to use
+              instead of reading self.path again.
+            * precise (bool): use the format YYYY-MM-DD-HHMMSS-ffff, where
+              ffff are ten-thousandths of a second, instead of
+              YYYY-MM-DD-####.
+
+        Returns:
+            * (str): next availible timestamp. A precise one, even if
+              PRECISE is False, when the newest snapshot was taken today
+              with --precise: a YYYY-MM-DD-#### name would sort before it.
+        '''
+        now = datetime.datetime.now()
+        today = now.date().isoformat()
+        if snapshots is None:
+            snapshots = self.snapshots()
+        newest = snapshots[0] if snapshots else None
+        if newest is not None and newest[:10] > today:
+            raise BtrsnapError('snapshot {} in {} is newer than today.'
+                               ' Is the system clock wrong? Aborting!'
+                               .format(newest, self.path))
+
+        if newest is not None and newest[:10] == today and \
+                len(newest) != len('YYYY-MM-DD-####'):
+            precise = True
+        if precise:
+            timestamp = '{:%Y-%m-%d-%H%M%S}-{:04d}'.format(
+                now, now.microsecond // 100)
+            if (newest is not None
+                    and snapshot_key(timestamp) <= snapshot_key(newest)):
+                # clock went backwards or two snapshots in 100 microseconds
+                fraction = int(newest[18:]) + 1
+                if fraction > 9999:
+                    raise BtrsnapError('More than 10000 snapshots created in'
+                                       ' one second. Aborting!')
+                timestamp = '{}{:04d}'.format(newest[:18], fraction)
+            return timestamp
+
+        if newest is not None and newest[:10] == today:
+            counter = max(counter, int(newest[11:]) + 1)
+        if counter > 9999:
+            raise BtrsnapError('More than 9999 snapshots created today.'
+                               ' Something is probably wrong. Aborting!')
+        return '{}-{:04d}'.format(today, counter)
@@ -0,0 +1,453 @@
+'''
+Helpers shared by the stages that copy, compress and store send streams:
+moving data between file descriptors, pipe buffers, byte counts for
+messages, and the record of transfers and deletions in progress.
+'''
+
+import collections
+import contextlib
+import datetime
+import errno
+import fcntl
+import os
+import select
+import threading
+import time
+
+# fcntl only has a name for this from python 3.10 on
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def ordered_map(func, items, jobs, output):
+    '''
+    Call FUNC on each of ITEMS using JOBS threads and pass the results to
+    OUTPUT in the order of ITEMS. At most 2 * JOBS items are in flight, so
+    memory use is bounded however fast ITEMS is produced.
+    '''
+    if jobs == 1:
+        for item in items:
+            output(func(item))
+        return
+    import concurrent.futures
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * jobs:
+                output(pending.popleft().result())
+        while pending:
+            output(pending.popleft().result())
+
+
+def read_exactly(fd, size):
+    '''
+    Returns:
+        * bytes: SIZE bytes read from FD, fewer only at the end of the file.
+    '''
+    data = os.read(fd, size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        data = os.read(fd, remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def sync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def set_pipe_size(fd, size):
+    '''
+    Grow the kernel buffer of pipe FD to SIZE bytes, or as close to it as
+    /proc/sys/fs/pipe-max-size allows. Does nothing if FD is not a pipe.
+    '''
+    while size >= 65536:
+        try:
+            fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+            return
+        except OSError as err:
+            if err.errno != errno.EPERM:
+                return
+            size //= 2
+
+
+def human_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return '{:.1f} {}'.format(count, unit)
+        count /= 1024
+    return '{:.1f} TiB'.format(count)
+
+
+class Relay:
+    '''
+    Copies a stream from one file descriptor to another and measures the
+    transfer. On Linux the data is moved with :func:`os.splice` through
+    enlarged pipe buffers, so it never passes through Python.
+
+    Args:
+        * source (int): file descriptor to read from.
+        * sink (int): file descriptor to write to.
+        * pipe_size (int): requested size of the pipe buffers in bytes.
+        * sync_size (int): when sink is a file, flush it to disk every
+          SYNC_SIZE bytes and drop the written pages from the page cache.
+          None leaves flushing to the kernel.
+        * limiter (TokenBucket): limit the transfer rate. None copies as
+          fast as possible, with no overhead.
+
+    Attributes:
+        * bytes (int): bytes copied.
+        * seconds (float): duration of the transfer.
+        * read_stall (float): seconds spent waiting for data from source.
+        * write_stall (float): seconds spent waiting for sink to accept data.
+        * throttled (float): seconds spent waiting for the limiter.
+        * compressor (Compressor): the stage source is read from, if the
+          stream is compressed on the way, to report with the transfer.
+    '''
+    chunk_size = 1 << 20
+
+    def __init__(self, source, sink, pipe_size=1 << 20, sync_size=None,
+                 limiter=None):
+        self.source = source
+        self.sink = sink
+        self.sync_size = sync_size
+        self.limiter = limiter
+        self.synced = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.read_stall = 0.0
+        self.write_stall = 0.0
+        self.throttled = 0.0
+        self.compressor = None
+        for fd in (source, sink):
+            set_pipe_size(fd, pipe_size)
+
+    @property
+    def rate(self):
+        '''
+        Returns:
+            * float: average bytes per second.
+        '''
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        msg = ('{} in {:.1f}s ({}/s), waited {:.1f}s for send and {:.1f}s'
+               ' for receive'.format(human_bytes(self.bytes), self.seconds,
+                                     human_bytes(self.rate),
+                                     self.read_stall, self.write_stall))
+        if self.limiter is not None:
+            msg += ', throttled {:.1f}s'.format(self.throttled)
+        if self.compressor is not None:
+            msg += ', {}'.format(self.compressor)
+        return msg
+
+    def run(self):
+        '''
+        Copy until the end of the source stream, or until the sink is
+        closed.
+        '''
+        start = time.monotonic()
+        try:
+            if hasattr(os, 'splice'):
+                try:
+                    self._splice()
+                    return
+                except OSError as err:
+                    # neither end is a pipe, or splice is unsupported there
+                    if (err.errno not in (errno.EINVAL, errno.ENOSYS)
+                            or self.bytes):
+                        raise
+            self._copy()
+        except BrokenPipeError:
+            pass
+        finally:
+            self.seconds = time.monotonic() - start
+
+    def _splice(self):
+        readable = select.poll()
+        readable.register(self.source, select.POLLIN)
+        writable = select.poll()
+        writable.register(self.sink, select.POLLOUT)
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        while True:
+            waited = time.monotonic()
+            readable.poll()
+            self.read_stall += time.monotonic() - waited
+            size = self._acquire()
+            try:
+                while True:
+                    try:
+                        count = os.splice(self.source, self.sink, size,
+                                          flags=flags)
+                        break
+                    except BlockingIOError:
+                        waited = time.monotonic()
+                        writable.poll()
+                        self.write_stall += time.monotonic() - waited
+            except BaseException:
+                self._release(size, 0)
+                raise
+            self._release(size, count)
+            if not count:
+                return
+            self._written(count)
+
+    def _copy(self):
+        while True:
+            size = self._acquire()
+            waited = time.monotonic()
+            data = os.read(self.source, size)
+            self.read_stall += time.monotonic() - waited
+            self._release(size, len(data))
+            if not data:
+                return
+            waited = time.monotonic()
+            write_all(self.sink, data)
+            self.write_stall += time.monotonic() - waited
+            self._written(len(data))
+
+    def _acquire(self):
+        if self.limiter is None:
+            return self.chunk_size
+        waited = time.monotonic()
+        size = self.limiter.acquire(self.chunk_size)
+        self.throttled += time.monotonic() - waited
+        return size
+
+    def _release(self, size, count):
+        if self.limiter is not None and count < size:
+            self.limiter.refund(size - count)
+
+    def _written(self, count):
+        self.bytes += count
+        if self.sync_size and self.bytes - self.synced >= self.sync_size:
+            self.sync()
+
+    def sync(self):
+        '''
+        Flush everything written so far to disk. Only useful when sink is a
+        file.
+        '''
+        waited = time.monotonic()
+        os.fdatasync(self.sink)
+        # the pages are on disk now, keep them from crowding out the cache
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.sink, 0, 0, os.POSIX_FADV_DONTNEED)
+        self.synced = self.bytes
+        self.write_stall += time.monotonic() - waited
+
+
+class Tee:
+    '''
+    Copies a stream to several file descriptors, so one btrfs send can
+    feed more than one btrfs receive. Each sink is written by a thread of
+    its own from a queue of at most :attr:`queue_size` chunks. A slow sink
+    only holds up the others once its queue is full, so memory use stays
+    below ``queue_size * chunk_size`` per sink. A sink that fails is
+    dropped and the others carry on.
+
+    Args:
+        * source (int): file descriptor to read from.
+        * sinks (list(int)): file descriptors to write to.
+        * limiter (TokenBucket): limit the rate the source is read at.
+
+    Attributes:
+        * bytes (int): bytes read from source.
+        * seconds (float): duration of the transfer.
+        * read_stall (float): seconds spent waiting for data from source.
+        * write_stall (list(float)): seconds each sink spent writing.
+        * errors (dict): the OSError of each sink, by index, that failed.
+        * compressor (Compressor): see :class:`Relay`.
+    '''
+    chunk_size = 1 << 20
+    queue_size = 8
+
+    def __init__(self, source, sinks, limiter=None):
+        self.source = source
+        self.sinks = list(sinks)
+        self.limiter = limiter
+        self.bytes = 0
+        self.seconds = 0.0
+        self.read_stall = 0.0
+        self.write_stall = [0.0] * len(self.sinks)
+        self.errors = {}
+        self.compressor = None
+        for fd in [source] + self.sinks:
+            set_pipe_size(fd, self.chunk_size)
+
+    @property
+    def rate(self):
+        '''
+        Returns:
+            * float: average bytes per second.
+        '''
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        msg = ('{} in {:.1f}s ({}/s) to {} destinations, waited {:.1f}s for'
+               ' send and up to {:.1f}s for receive'.format(
+                   human_bytes(self.bytes), self.seconds,
+                   human_bytes(self.rate), len(self.sinks),
+                   self.read_stall, max(self.write_stall, default=0.0)))
+        if self.compressor is not None:
+            msg += ', {}'.format(self.compressor)
+        return msg
+
+    def run(self):
+        '''
+        Copy until the end of the source stream, or until every sink has
+        failed.
+        '''
+        import queue
+
+        start = time.monotonic()
+        queues = [queue.Queue(self.queue_size) for _ in self.sinks]
+        threads = [threading.Thread(target=self._writer, args=(index, q),
+                                    daemon=True)
+                   for index, q in enumerate(queues)]
+        for thread in threads:
+            thread.start()
+        try:
+            while len(self.errors) < len(self.sinks):
+                size = self.chunk_size
+                if self.limiter is not None:
+                    size = self.limiter.acquire(size)
+                waited = time.monotonic()
+                data = os.read(self.source, size)
+                self.read_stall += time.monotonic() - waited
+                if self.limiter is not None and len(data) < size:
+                    self.limiter.refund(size - len(data))
+                if not data:
+                    break
+                self.bytes += len(data)
+                for q in queues:
+                    q.put(data)
+        finally:
+            for q in queues:
+                q.put(None)
+            for thread in threads:
+                thread.join()
+            self.seconds = time.monotonic() - start
+
+    def _writer(self, index, chunks):
+        sink = self.sinks[index]
+        while True:
+            data = chunks.get()
+            if data is None:
+                return
+            if index in self.errors:
+                # keep draining so the reader never blocks on this sink
+                continue
+            waited = time.monotonic()
+            try:
+                write_all(sink, data)
+            except OSError as err:
+                self.errors[index] = err
+            self.write_stall[index] += time.monotonic() - waited
+
+
+class Activity:
+    '''
+    What btrsnap is doing right now: the streams being transferred and the
+    snapshots being deleted. Both register themselves while they run, so
+    the state can be read at any time, for example by the
+    :mod:`btrsnap.daemon` control socket, without waiting on btrfs.
+    The module keeps one instance, :data:`activity`.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transfers = {}
+        self._deletions = {}
+
+    @contextlib.contextmanager
+    def transfer(self, destination, stage, counter='bytes'):
+        '''
+        Register a transfer for the duration of the ``with`` block.
+
+        Args:
+            * destination (str): where the stream goes.
+            * stage (Relay, Tee or Deduplicator): copies the stream.
+            * counter (str): attribute of STAGE counting bytes moved.
+        '''
+        key = object()
+        with self._lock:
+            self._transfers[key] = (destination, stage, counter,
+                                    datetime.datetime.now(),
+                                    time.monotonic())
+        try:
+            yield stage
+        finally:
+            with self._lock:
+                del self._transfers[key]
+
+    @contextlib.contextmanager
+    def deleting(self, path, snapshots):
+        '''
+        Register the deletion of SNAPSHOTS in PATH for the duration of the
+        ``with`` block.
+        '''
+        key = object()
+        with self._lock:
+            self._deletions[key] = (path, list(snapshots))
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._deletions[key]
+
+    def transfers(self):
+        '''
+        Returns:
+            * list(dict): destination, start, bytes, seconds and
+              bytes_per_second of every transfer in progress, oldest first.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            transfers = list(self._transfers.values())
+        result = []
+        for destination, stage, counter, start, started in transfers:
+            count = getattr(stage, counter)
+            seconds = now - started
+            result.append({
+                'destination': destination,
+                'start': start.isoformat(timespec='seconds'),
+                'bytes': count,
+                'seconds': round(seconds, 1),
+                'bytes_per_second': round(count / seconds) if seconds else 0})
+        return result
+
+    def deletions(self):
+        '''
+        Returns:
+            * dict: snapshots being deleted, by directory.
+        '''
+        deletions = {}
+        with self._lock:
+            for path, snapshots in self._deletions.values():
+                deletions.setdefault(path, []).extend(snapshots)
+        return deletions
+
+
+activity = Activity()
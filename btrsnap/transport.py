@@ -0,0 +1,435 @@
+'''
+Where btrfs receive runs: on the local machine, or on another one through
+a command prefix such as ssh.
+'''
+
+import contextlib
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+try:
+    from . import compression
+    from .errors import BtrfsError, TransportError
+    from .paths import TIMESTAMP_PATTERN, Path, snapshot_key
+    from .streams import Relay, Tee, activity
+except ImportError:
+    import compression
+    from errors import BtrfsError, TransportError
+    from paths import TIMESTAMP_PATTERN, Path, snapshot_key
+    from streams import Relay, Tee, activity
+
+
+class Transport:
+    '''
+    Where btrfs receive runs. This base class receives on the local
+    machine; :class:`CommandTransport` runs the receiving side through a
+    command prefix such as ``ssh host``.
+
+    A transport is also a context manager. Transports that can keep a
+    connection open, see :class:`SSHTransport`, do so between entering and
+    leaving it. Entering it more than once is allowed.
+
+    Attributes:
+        * compress (tuple): (codec, level) the stream is compressed with on
+          its way to btrfs receive, see :func:`compression.parse`. None,
+          and only set by :class:`CommandTransport`.
+    '''
+    remote = False
+    compress = None
+    # threads compressing the stream
+    jobs = os.cpu_count() or 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def command(self, args):
+        '''
+        Args:
+            * args (list(str)): command to run on the receiving side.
+
+        Returns:
+            * list(str): the command to run locally.
+        '''
+        return list(args)
+
+    def describe(self, path):
+        '''
+        Returns:
+            * str: PATH on the receiving side, for messages and the catalog.
+        '''
+        return path
+
+    def snapshots(self, path):
+        '''
+        Returns:
+            * list(str): snapshots in PATH on the receiving side, newest
+              first.
+        '''
+        return Path(path).snapshots()
+
+    def run(self, args):
+        '''
+        Run a command on the receiving side.
+
+        Returns:
+            * str: its standard output.
+
+        Raises:
+            * TransportError: the command failed.
+        '''
+        result = subprocess.run(self.command(args), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode:
+            raise TransportError('\'{}\' failed{}: {}'.format(
+                ' '.join(args), self._through(), result.stderr.strip()))
+        return result.stdout
+
+    def _through(self):
+        return ''
+
+    def makedirs(self, paths):
+        '''
+        Create directories on the receiving side if they do not exist.
+
+        Args:
+            * paths (list(str)): directories to create.
+        '''
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+
+    def receive(self, path, p1, limiter=None):
+        '''
+        Receive the output of a btrfs send process into PATH.
+
+        Args:
+            * path (str): directory on the receiving side.
+            * p1 (subprocess.Popen): send process
+            * limiter (TokenBucket): limit the transfer rate.
+
+        Returns:
+            * Relay: statistics of the transfer.
+
+        Raises:
+            * BtrfsError:
+        '''
+        try:
+            relay = self.receive_from(path, p1.stdout.fileno(), limiter)
+        finally:
+            p1.stdout.close()
+            p1.wait()
+        if p1.returncode:
+            raise BtrfsError('BTRFS failed to send \'{}\''
+                             .format(p1.args[-1]))
+        return relay
+
+    def receive_from(self, path, source, limiter=None):
+        '''
+        Receive a stream read from a file descriptor into PATH.
+
+        Args:
+            * path (str): directory on the receiving side.
+            * source (int): file descriptor to read the stream from.
+            * limiter (TokenBucket): limit the transfer rate.
+
+        Returns:
+            * Relay: statistics of the transfer.
+
+        Raises:
+            * BtrfsError:
+        '''
+        with contextlib.ExitStack() as stack:
+            source, compressor = self._compressed(source, stack)
+            receiver = self._start_receive(path, stack)
+            relay = Relay(source, receiver[0].stdin.fileno(), limiter=limiter)
+            relay.compressor = compressor
+            try:
+                with activity.transfer(self.describe(path), relay):
+                    relay.run()
+            finally:
+                receiver[0].stdin.close()
+            error = self._wait_receive(*receiver)
+        if error is not None:
+            raise error
+        return relay
+
+    def receive_many(self, paths, p1, limiter=None):
+        '''
+        Receive the output of one btrfs send process into several
+        directories at once, see :class:`Tee`. A directory that fails to
+        receive does not stop the others.
+
+        Args:
+            * paths (list(str)): directories on the receiving side.
+            * p1 (subprocess.Popen): send process
+            * limiter (TokenBucket): limit the transfer rate.
+
+        Returns:
+            * tuple: (Tee, dict) statistics of the transfer, and the
+              BtrfsError of each path that failed to receive.
+
+        Raises:
+            * BtrfsError: btrfs send failed.
+        '''
+        errors = {}
+        with contextlib.ExitStack() as stack:
+            source, compressor = self._compressed(p1.stdout.fileno(), stack)
+            receivers = [self._start_receive(path, stack) for path in paths]
+            tee = Tee(source,
+                      [receiver[0].stdin.fileno() for receiver in receivers],
+                      limiter=limiter)
+            tee.compressor = compressor
+            try:
+                with activity.transfer(', '.join(self.describe(path)
+                                                 for path in paths), tee):
+                    tee.run()
+            finally:
+                for receiver in receivers:
+                    receiver[0].stdin.close()
+                p1.stdout.close()
+                p1.wait()
+            for path, receiver in zip(paths, receivers):
+                error = self._wait_receive(*receiver)
+                if error is not None:
+                    errors[path] = error
+        # when every receive failed, send was most likely cut off by them
+        if p1.returncode and len(errors) < len(paths):
+            raise BtrfsError('BTRFS failed to send \'{}\''
+                             .format(p1.args[-1]))
+        return tee, errors
+
+    def _compressed(self, source, stack):
+        # the stream to send, compressed once for all receivers
+        if self.compress is None:
+            return source, None
+        codec, level = self.compress
+        return stack.enter_context(compression.pipe_from(
+            lambda sink: compression.Compressor(source, sink, codec=codec,
+                                                level=level, jobs=self.jobs)))
+
+    def _receive_command(self, path):
+        return self.command(['btrfs', 'receive', path])
+
+    def _start_receive(self, path, stack):
+        import tempfile
+
+        out = stack.enter_context(tempfile.TemporaryFile())
+        err = stack.enter_context(tempfile.TemporaryFile())
+        p2 = subprocess.Popen(self._receive_command(path),
+                              stdin=subprocess.PIPE, stdout=out, stderr=err)
+        return p2, out, err
+
+    def _wait_receive(self, p2, out, err):
+        p2.wait()
+        if not p2.returncode:
+            return None
+        out.seek(0)
+        err.seek(0)
+        return BtrfsError('BTRFS Failed send/receive.'
+                          ' Do you have root permissions?'
+                          ' Are you receiving to the top level'
+                          ' of your BTRFS filesystem?',
+                          out.read(), err.read())
+
+
+class CommandTransport(Transport):
+    '''
+    Runs the receiving side through a command prefix. Each command is
+    quoted for a POSIX shell and passed to PREFIX as one final argument,
+    the way ``ssh host`` and ``sh -c`` expect it.
+
+    With compress, the stream is compressed by a
+    :class:`compression.Compressor` before it leaves, and piped through
+    :attr:`decompress_command` into btrfs receive on the far side, so
+    btrsnap must be installed there too. This is checked before the first
+    stream is sent, and the transfer fails if either end of the pipe does.
+
+    Args:
+        * prefix (list(str)): for example ``['ssh', 'backup']``.
+        * compress (tuple): (codec, level), see :func:`compression.parse`.
+
+    Raises:
+        * TransportError: empty prefix.
+    '''
+    remote = True
+    decompress_command = ['btrsnap', 'decompress']
+
+    def __init__(self, prefix, compress=None):
+        if not prefix:
+            raise TransportError('a transport needs a command')
+        self.prefix = list(prefix)
+        self.compress = compress
+        self._decompress_found = False
+
+    def command(self, args):
+        return self._prefix() + [_quote(args)]
+
+    def _compressed(self, source, stack):
+        if self.compress is not None and not self._decompress_found:
+            self._find_decompress()
+        return super()._compressed(source, stack)
+
+    def _find_decompress(self):
+        try:
+            self.run(self.decompress_command + ['--help'])
+        except TransportError as err:
+            raise TransportError('\'{}\' is needed on the receiving side to'
+                                 ' decompress the stream, is btrsnap'
+                                 ' installed there? {}'.format(
+                                     ' '.join(self.decompress_command), err))
+        self._decompress_found = True
+
+    def _receive_command(self, path):
+        receive = ['btrfs', 'receive', path]
+        if self.compress is None:
+            return self.command(receive)
+        # a pipe exits with the status of btrfs receive alone and POSIX sh
+        # has no pipefail, so the status of decompress comes back on fd 3
+        script = ('exec 4>&1; status=$({{ {{ {} 3>&- 4>&-; echo $? >&3; }} |'
+                  ' {} 3>&- >&4; }} 3>&1) || exit; exit "$status"'
+                  .format(_quote(self.decompress_command), _quote(receive)))
+        return self.command(['sh', '-c', script])
+
+    def _prefix(self):
+        return list(self.prefix)
+
+    def describe(self, path):
+        return '{}:{}'.format(' '.join(self.prefix), path)
+
+    def _through(self):
+        return ' through \'{}\''.format(' '.join(self.prefix))
+
+    def snapshots(self, path):
+        # ls -p marks directories with a trailing slash
+        names = self.run(['ls', '-1p', '--', path]).splitlines()
+        snapshots = [name[:-1] for name in names if name.endswith('/') and
+                     TIMESTAMP_PATTERN.match(name[:-1])]
+        snapshots.sort(key=snapshot_key, reverse=True)
+        return snapshots
+
+    def makedirs(self, paths):
+        if paths:
+            self.run(['mkdir', '-p', '--'] + list(paths))
+
+
+class SSHTransport(CommandTransport):
+    '''
+    A :class:`CommandTransport` for a prefix starting with ``ssh``. While
+    the transport is entered, one master connection is kept open and
+    every command is multiplexed over it, instead of connecting and
+    authenticating once per command. Threads may enter and leave it
+    concurrently.
+
+    Args:
+        * prefix (list(str)): ssh and its arguments, ending with the host.
+    '''
+    timeout = 30
+
+    def __init__(self, prefix, compress=None):
+        super().__init__(prefix, compress)
+        # guards _depth, and opening and closing the master connection
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._master = None
+        self._socket_dir = None
+
+    @property
+    def control_path(self):
+        if self._socket_dir is None:
+            return None
+        return os.path.join(self._socket_dir, 'master')
+
+    def _prefix(self):
+        if self._master is None:
+            return list(self.prefix)
+        return ([self.prefix[0], '-o', 'ControlMaster=no',
+                 '-o', 'ControlPath=' + self.control_path] + self.prefix[1:])
+
+    def __enter__(self):
+        with self._lock:
+            if not self._depth:
+                try:
+                    self._open()
+                except BaseException:
+                    self._close()
+                    raise
+            self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._depth -= 1
+            if not self._depth:
+                self._close()
+        return False
+
+    def _open(self):
+        import tempfile
+
+        self._socket_dir = tempfile.mkdtemp(prefix='btrsnap-ssh-')
+        args = ([self.prefix[0], '-o', 'ControlMaster=yes',
+                 '-o', 'ControlPath=' + self.control_path, '-N'] +
+                self.prefix[1:])
+        master = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE)
+        deadline = time.monotonic() + self.timeout
+        while not os.path.exists(self.control_path):
+            if master.poll() is not None or time.monotonic() > deadline:
+                master.kill()
+                _, err = master.communicate()
+                raise TransportError('could not connect with \'{}\': {}'
+                                     .format(' '.join(self.prefix),
+                                             err.decode(errors='replace')
+                                             .strip()))
+            time.sleep(0.05)
+        self._master = master
+
+    def _close(self):
+        if self._master is not None:
+            self._master.terminate()
+            self._master.communicate()
+            self._master = None
+        if self._socket_dir is not None:
+            import shutil
+
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
+
+
+def _quote(args):
+    return ' '.join(shlex.quote(arg) for arg in args)
+
+
+def transport_for(command=None, compress=None):
+    '''
+    Args:
+        * command (str): command prefix for the receiving side, for example
+          ``ssh backup``. None receives locally.
+        * compress (tuple): (codec, level) to compress the stream with on
+          the way, see :class:`CommandTransport`.
+
+    Returns:
+        * Transport: :class:`SSHTransport` when COMMAND runs ssh,
+          otherwise a :class:`CommandTransport`, or a local
+          :class:`Transport` when COMMAND is None.
+
+    Raises:
+        * TransportError: COMPRESS without COMMAND. A local stream is never
+          worth compressing.
+    '''
+    if command is None:
+        if compress is not None:
+            raise TransportError('only streams sent through a transport'
+                                 ' can be compressed')
+        return Transport()
+    prefix = shlex.split(command)
+    if prefix and os.path.basename(prefix[0]) == 'ssh':
+        return SSHTransport(prefix, compress)
+    return CommandTransport(prefix, compress)
@@ -0,0 +1,154 @@
+'''
+Tests for receive transports. No btrfs is needed.
+'''
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import btrsnap
+import transport
+
+
+FAKE_SSH = '''#!{python}
+# stands in for ssh: -N starts a "master" that creates the control socket,
+# anything else runs the command locally
+import os, subprocess, sys, time
+args, options, rest, master = sys.argv[1:], {{}}, [], False
+while args:
+    arg = args.pop(0)
+    if arg == '-o':
+        key, value = args.pop(0).split('=', 1)
+        options[key] = value
+    elif arg == '-N':
+        master = True
+    else:
+        rest.append(arg)
+with open(os.environ['FAKE_SSH_LOG'], 'a') as log:
+    log.write(('master' if master else 'mux' if 'ControlPath' in options
+               else 'direct') + '\\n')
+if master:
+    open(options['ControlPath'], 'w').close()
+    time.sleep(600)
+sys.exit(subprocess.call(['sh', '-c', rest[1]]))
+'''
+
+
+class Test_Transport_Class(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.receive_dir = os.path.join(self.test_dir, 'receive dir')
+        self.ssh = os.path.join(self.test_dir, 'ssh')
+        self.log = os.path.join(self.test_dir, 'ssh.log')
+        os.mkdir(self.receive_dir)
+        for name in ('2016-01-01-0001', '2016-01-02-0001',
+                     '2016-01-02-120000-0001', 'not_a_snapshot'):
+            os.mkdir(os.path.join(self.receive_dir, name))
+        open(os.path.join(self.receive_dir, '2016-01-03-0001'), 'w').close()
+        with open(self.ssh, 'w') as f:
+            f.write(FAKE_SSH.format(python=sys.executable))
+        os.chmod(self.ssh, 0o755)
+        os.environ['FAKE_SSH_LOG'] = self.log
+
+    def tearDown(self):
+        del os.environ['FAKE_SSH_LOG']
+        shutil.rmtree(self.test_dir)
+
+    def calls(self):
+        with open(self.log) as f:
+            return f.read().split()
+
+    def test_Transport_local(self):
+        via = transport.transport_for(None)
+        self.assertFalse(via.remote)
+        self.assertEqual(btrsnap.Path(self.receive_dir).snapshots(),
+                         via.snapshots(self.receive_dir))
+
+    def test_CommandTransport_snapshots(self):
+        via = transport.transport_for('sh -c')
+        self.assertIsInstance(via, transport.CommandTransport)
+        self.assertEqual(['2016-01-02-120000-0001', '2016-01-02-0001',
+                          '2016-01-01-0001'],
+                         via.snapshots(self.receive_dir))
+
+    def test_CommandTransport_makedirs(self):
+        via = transport.CommandTransport(['sh', '-c'])
+        paths = [os.path.join(self.receive_dir, name)
+                 for name in ('a b', "it's")]
+        via.makedirs(paths)
+        for path in paths:
+            self.assertTrue(os.path.isdir(path))
+
+    def test_CommandTransport_Exception(self):
+        via = transport.CommandTransport(['sh', '-c'])
+        self.assertRaises(btrsnap.TransportError, via.snapshots,
+                          os.path.join(self.test_dir, 'missing'))
+        self.assertRaises(btrsnap.TransportError, transport.CommandTransport,
+                          [])
+
+    def test_CommandTransport_compress(self):
+        via = transport.transport_for('sh -c', compress=('zlib', None))
+        # btrfs receive that takes any stream
+        with open(os.path.join(self.test_dir, 'btrfs'), 'w') as f:
+            f.write('#!/bin/sh\ncat > /dev/null\n')
+        os.chmod(os.path.join(self.test_dir, 'btrfs'), 0o755)
+        env = dict(os.environ)
+        env['PATH'] = self.test_dir + os.pathsep + env['PATH']
+        for decompress, status in ((['true'], 0), (['false'], 1),
+                                   (['sh', '-c', 'exit 3'], 3)):
+            via.decompress_command = decompress
+            self.assertEqual(status, subprocess.call(
+                via._receive_command(self.receive_dir), env=env,
+                stdin=subprocess.DEVNULL))
+        self.assertRaises(btrsnap.TransportError, transport.transport_for,
+                          None, ('zlib', None))
+
+    def test_CommandTransport_decompress_missing(self):
+        via = transport.transport_for('sh -c', compress=('zlib', None))
+        via.decompress_command = [os.path.join(self.test_dir, 'missing')]
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        try:
+            self.assertRaises(btrsnap.TransportError, via.receive_from,
+                              self.receive_dir, read_fd)
+        finally:
+            os.close(read_fd)
+
+    def test_SSHTransport_multiplexed(self):
+        via = transport.transport_for(self.ssh + ' backup')
+        self.assertIsInstance(via, transport.SSHTransport)
+        with via:
+            with via:
+                via.snapshots(self.receive_dir)
+            via.snapshots(self.receive_dir)
+            socket_dir = os.path.dirname(via.control_path)
+        self.assertEqual(['master', 'mux', 'mux'], self.calls())
+        self.assertFalse(os.path.exists(socket_dir))
+        via.snapshots(self.receive_dir)
+        self.assertEqual('direct', self.calls()[-1])
+
+    def test_SSHTransport_threads(self):
+        via = transport.transport_for(self.ssh + ' backup')
+        barrier = threading.Barrier(4)
+
+        def work():
+            barrier.wait()
+            with via:
+                via.snapshots(self.receive_dir)
+                barrier.wait()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['master'] + ['mux'] * 4, self.calls())
+        self.assertIsNone(via.control_path)
+
+
+if __name__ == '__main__':
+    unittest.main()